@@ -0,0 +1,200 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+class APICache:
+    """ A dump of an API, converted to properties once and indexed for the lookups of query_cache """
+    TEXT_PROPERTIES = ('title', 'name')
+    _REGEX_CHARACTERS = set('.^$*+?{}[]\\|()')
+
+    def __init__(self, dumps, to_properties, indexes=None, text_indexes=None):
+        """ dumps: {type: [json results]}, to_properties: converts (type, json results) to properties.
+
+        Indexes ({type: [property]}) are built right away, indexes of other lookups on their first use.
+        """
+        self._dumps = dumps
+        self._properties = {type_: to_properties(type_, results) for type_, results in dumps.items()}
+        self._indexes = {}  # (type, property):{key: [positions]}
+        self._text_indexes = {}  # (type, property):({word: [positions]}, {trigram: {words}})
+        for type_, properties in (indexes or {}).items():
+            for property_ in properties:
+                self._get_index(type_, property_)
+        for type_, properties in (text_indexes or {}).items():
+            for property_ in properties:
+                self._get_text_index(type_, property_)
+
+    def __bool__(self):
+        return any(self._dumps.values())
+
+    def find(self, type_, by_property, value):
+        """ Get the properties of all items of "type" with by_property matching value.
+
+        Title and name are searched as regular expressions, like the API does, everything else has to be equal.
+        """
+        if by_property in self.TEXT_PROPERTIES:
+            positions = self._find_text(type_, by_property, value)
+        else:
+            positions = self._get_index(type_, by_property).get(str(value), [])
+        # Copies, so the caller cannot change the cache
+        return [dict(self._properties[type_][i]) for i in positions]
+
+    @staticmethod
+    def _index_keys(raw_value):
+        """ Keys to find a raw value with, nested items like {'name': 'Test Site'} by their name """
+        if isinstance(raw_value, list):
+            return [key for item in raw_value for key in APICache._index_keys(item)]
+        if isinstance(raw_value, dict):
+            return [str(raw_value['name'])] if 'name' in raw_value else []
+        if raw_value is None:
+            return []
+        return [str(raw_value)]
+
+    def _get_index(self, type_, property_):
+        index = self._indexes.get((type_, property_))
+        if index is None:
+            index = {}
+            for i, item in enumerate(self._dumps.get(type_, [])):
+                for key in set(self._index_keys(item.get(property_))):
+                    index.setdefault(key, []).append(i)
+            self._indexes[(type_, property_)] = index
+        return index
+
+    def _get_text_index(self, type_, property_):
+        index = self._text_indexes.get((type_, property_))
+        if index is None:
+            words = {}
+            for i, item in enumerate(self._dumps.get(type_, [])):
+                text = item.get(property_)
+                if isinstance(text, str):
+                    for word in set(re.findall(r'\w+', text)):
+                        words.setdefault(word, []).append(i)
+            trigrams = {}
+            for word in words:
+                for j in range(len(word) - 2):
+                    trigrams.setdefault(word[j:j + 3], set()).add(word)
+            index = words, trigrams
+            self._text_indexes[(type_, property_)] = index
+        return index
+
+    def _find_text(self, type_, property_, value):
+        items = self._dumps.get(type_, [])
+        pattern = re.compile(value)
+        words = re.findall(r'\w+', value) if not self._REGEX_CHARACTERS.intersection(value) else []
+        if words:
+            # A word of a plain search lies within one word of every match, so only look at items having such words
+            word = max(words, key=len)
+            positions, trigrams = self._get_text_index(type_, property_)
+            indexed_words = positions
+            if len(word) >= 3:
+                # Only words having all trigrams of the searched word can contain it
+                words_trigrams = sorted((trigrams.get(word[j:j + 3], set()) for j in range(len(word) - 2)), key=len)
+                indexed_words = words_trigrams[0].intersection(*words_trigrams[1:])
+            candidates = sorted({i for indexed_word in indexed_words if word in indexed_word
+                                 for i in positions[indexed_word]})
+        else:
+            candidates = range(len(items))
+
+        return [i for i in candidates
+                if isinstance(items[i].get(property_), str) and pattern.search(items[i][property_])]
+
+
+class QueryMemo:
+    """ A bounded LRU of query results, which expire after a time depending on the type of the query """
+    DEFAULT_TTL = 24 * 60 * 60
+    # Results without any existing item (e.g. a 404) are asked for again sooner
+    NEGATIVE_TTL = 60 * 60
+
+    def __init__(self, max_size=10000, ttls=None):
+        self.max_size = max_size
+        self.ttls = ttls if ttls is not None else {}
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key:(expiry time, results)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """ Worker processes get an empty memo, they have no need for it """
+        return {'max_size': self.max_size, 'ttls': self.ttls}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, type_, results):
+        if self._is_negative(results):
+            ttl = min(self.NEGATIVE_TTL, self.ttls.get(type_, self.DEFAULT_TTL))
+        else:
+            ttl = self.ttls.get(type_, self.DEFAULT_TTL)
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, results)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _is_negative(results):
+        if isinstance(results, list):
+            return all(isinstance(r_, dict) and r_.get('exists', True) is False for r_ in results)
+        return not results
+
+    def get_statistics(self):
+        total = self.hits + self.misses
+        return '{} hits, {} misses ({:.0%} hit rate), {} entries'.format(
+            self.hits, self.misses, self.hits / total if total else 0, len(self._entries))
+
+    def load(self, path):
+        """ Add the unexpired results persisted by an earlier run """
+        if not os.path.exists(path):
+            return
+        try:
+            with gzip.open(path, 'rt') as f:
+                entries = json.load(f, object_hook=self._decode)
+        except Exception as e:
+            logging.warning('Query-cache "{}" possibly corrupted (Error: "{}"), ignoring it'.format(path, e))
+            return
+        now = time.time()
+        with self._lock:
+            for key, expiry, results in entries:
+                if expiry >= now:
+                    self._entries[tuple(key)] = (expiry, results)
+
+    def save(self, path):
+        """ Persist the unexpired results as JSON, as [key, expiry time, results] in LRU-order """
+        now = time.time()
+        with self._lock:
+            entries = [[list(key), entry[0], entry[1]] for key, entry in self._entries.items() if entry[0] >= now]
+        temp_path = path + '.tmp'
+        try:
+            with gzip.open(temp_path, 'wt', compresslevel=1) as f:
+                json.dump(entries, f, default=self._encode)
+            os.replace(temp_path, path)
+        except (OSError, TypeError) as e:
+            logging.warning('Could not persist the query-cache to "{}": {}'.format(path, e))
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, datetime.date):
+            return {'__date__': value.isoformat()}
+        raise TypeError('{} is not serializable'.format(type(value).__name__))
+
+    @staticmethod
+    def _decode(value):
+        if '__date__' in value:
+            return datetime.datetime.strptime(value['__date__'], '%Y-%m-%d').date()
+        return value
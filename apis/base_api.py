@@ -1,27 +1,73 @@
 import requests
 import logging
 import json
+import gzip
+import os
+import random
+import re
 import threading
 import time
+import concurrent.futures
+
+from apis.api_cache import QueryMemo
 
 
 class BaseAPI:
     name = 'BaseAPI'
     base_url = ''
+    request_timeout = 2
+    request_retries = 3
+    # Seconds to wait at most before the first retry, doubles with every retry
+    request_backoff = 0.5
+    # Types of the dumps making up the cache, see _get_dump_url
+    dump_types = ()
+    # Seconds a persisted dump is used without asking the API for a newer one
+    cache_max_age = 24 * 60 * 60
+    # Seconds the results of direct or API-queries are remembered, per type
+    query_ttls = {'shoots': 24 * 60 * 60, 'performers': 24 * 60 * 60, 'sites': 7 * 24 * 60 * 60}
 
-    def __init__(self, use_api=True):
+    def __init__(self, use_api=True, pool_size=10, cache_dir=None):
         logging.getLogger("requests").setLevel(logging.WARNING)
         self._site_capabilities = None
         self._cookies = None
         self._headers = {}
         self._use_api = use_api
+        self._pool_size = pool_size
+        self._session = None
 
         self._cache_updating = False
         self._cache_thread = None
         self._cache = {}
+        self._cache_dir = cache_dir
+        self._cache_dumps = {}  # type:[json results], the raw dumps of the cache
+        self._cache_validators = {}  # type:{'etag': ..., 'last_modified': ...} of the dumps
+        self._memo = QueryMemo(ttls=self.query_ttls)
+        memo_path = self._get_memo_path()
+        if memo_path is not None:
+            self._memo.load(memo_path)
 
         self.set_headers()
 
+    def __getstate__(self):
+        """ Only hand the configuration to worker processes, not the cache and its thread """
+        state = self.__dict__.copy()
+        state['_cache_updating'] = False
+        state['_cache_thread'] = None
+        state['_cache'] = {}
+        state['_cache_dumps'] = {}
+        state['_session'] = None
+        return state
+
+    def _get_session(self):
+        """ The session keeps the connections to the sites alive, shared by all threads """
+        if self._session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=self._pool_size, pool_maxsize=self._pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
     def set_headers(self):
         """ Set any HTTP-headers required """
         # TODO: randomized user-agent?
@@ -31,39 +77,158 @@ class BaseAPI:
         """ Set any HTTP-cookies required """
         self._cookies = None
 
-    def use_cache(self):
-        """ Enable the usage and the creation of the API-cache """
+    def use_cache(self, download=True):
+        """ Enable the usage and the creation of the API-cache.
+
+        A persisted cache is used right away and refreshed in the background when it is too old.
+        Without download, only a persisted cache is used.
+        """
         if not self._use_api or self._cache or self._cache_updating:
             return
 
+        fetched = self._load_persisted_cache()
+        if fetched is None and not download:
+            return
+        if fetched is not None and time.time() - fetched < self.cache_max_age:
+            return
+
         self._cache_updating = True
         self._cache_thread = threading.Thread(target=self._update_cache)
         self._cache_thread.start()
 
     def _update_cache(self):
-        """ Get a dump of the API to use as a cache """
+        """ Get a dump of the API to use as a cache, only downloading the dumps which changed """
+        dumps, validators = {}, {}
+        for type_ in self.dump_types:
+            validator = self._cache_validators.get(type_, {}) if type_ in self._cache_dumps else {}
+            headers = {}
+            if validator.get('etag'):
+                headers['If-None-Match'] = validator['etag']
+            if validator.get('last_modified'):
+                headers['If-Modified-Since'] = validator['last_modified']
+
+            response = self._make_request(self._get_dump_url(type_), headers=headers)
+            results = None
+            if response is not None and response.status_code == 200:
+                results = self._to_json(response.text)
+                results = results.get('results') if isinstance(results, dict) else None
+            if response is not None and response.status_code == 304 and type_ in self._cache_dumps:
+                logging.debug('API-dump "{}" did not change'.format(type_))
+                dumps[type_], validators[type_] = self._cache_dumps[type_], validator
+            elif isinstance(results, list):
+                dumps[type_] = results
+                validators[type_] = {'etag': response.headers.get('ETag'),
+                                     'last_modified': response.headers.get('Last-Modified')}
+            else:
+                # No internet, an error of the API or an interrupted thread: keep the dumps we have
+                logging.debug('API-dump "{}" could not be downloaded'.format(type_))
+                self._cache_updating = False
+                return
+
+        self._cache = self._build_cache(dumps)
+        self._cache_dumps, self._cache_validators = dumps, validators
         self._cache_updating = False
-        return NotImplementedError
+        self._save_persisted_cache()
+
+    def _get_dump_url(self, type_):
+        """ Get the URL of the dump of all items of "type" """
+        return ''
+
+    def _build_cache(self, dumps):
+        """ Build the cache out of the dumps """
+        return dumps
+
+    def _get_persisted_cache_path(self):
+        if self._cache_dir is None:
+            return None
+        return os.path.join(self._cache_dir, '.kinksorter_api_{}.json.gz'.format(re.sub(r'\W', '', self.name)))
+
+    def _get_memo_path(self):
+        if self._cache_dir is None:
+            return None
+        return os.path.join(self._cache_dir, '.kinksorter_api_{}_queries.json.gz'.format(re.sub(r'\W', '', self.name)))
+
+    def save_memo(self):
+        """ Persist the remembered query results for the next run """
+        logging.info('{}: Query-cache had {}'.format(self.name, self._memo.get_statistics()))
+        memo_path = self._get_memo_path()
+        if memo_path is not None:
+            self._memo.save(memo_path)
+
+    def _memoized(self, key, type_, query_function):
+        """ Get the results of the query from the memo, or run the query and remember its results """
+        results = self._memo.get(key)
+        if results is None:
+            results = query_function()
+            if self._is_memoizable(results):
+                self._memo.put(key, type_, results)
+        # Copies, as the callers sort and change the results
+        if isinstance(results, list):
+            return [dict(r_) if isinstance(r_, dict) else r_ for r_ in results]
+        return results
+
+    def _is_memoizable(self, results):
+        """ Check if the results are an answer (including "does not exist"), not a failure to get one """
+        return results is not None
+
+    def _load_persisted_cache(self):
+        """ Use the dumps persisted by an earlier run, returns when they were fetched or None """
+        cache_path = self._get_persisted_cache_path()
+        if cache_path is None or not os.path.exists(cache_path):
+            return None
+        try:
+            with gzip.open(cache_path, 'rt') as f:
+                persisted = json.load(f)
+            dumps = persisted['dumps']
+            self._cache = self._build_cache(dumps)
+        except Exception as e:
+            logging.warning('API-cache "{}" possibly corrupted (Error: "{}"), ignoring it'.format(cache_path, e))
+            return None
+
+        self._cache_dumps, self._cache_validators = dumps, persisted.get('validators', {})
+        return persisted.get('fetched', 0)
+
+    def _save_persisted_cache(self):
+        cache_path = self._get_persisted_cache_path()
+        if cache_path is None:
+            return
+        temp_path = cache_path + '.tmp'
+        try:
+            with gzip.open(temp_path, 'wt', compresslevel=1) as f:
+                json.dump({'fetched': time.time(), 'validators': self._cache_validators,
+                           'dumps': self._cache_dumps}, f)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            logging.warning('Could not persist the API-cache to "{}": {}'.format(cache_path, e))
 
     def make_request_get(self, url, data=None):
         """ Do a GET request, take care of the cookies, timeouts and exceptions """
+        response = self._make_request(url, data=data)
+        return response.text if response is not None else ''
+
+    def _make_request(self, url, data=None, headers=None):
+        """ Do a GET request with retries, returns the response or None """
         if data is None:
             data = {}
         if not self._cookies:
             self.set_cookies()
-        ret = ''
-        retries = 3
-        while not ret and retries > 0:
+        response = None
+        for retry in range(self.request_retries):
+            if retry:
+                # Exponential backoff with full jitter, to not hammer the site in lockstep with the other threads
+                time.sleep(random.uniform(0, self.request_backoff * 2 ** (retry - 1)))
             try:
-                r_ = requests.get(url, data=data, cookies=self._cookies, headers=self._headers, timeout=2)
-                ret = r_.text
+                response = self._get_session().get(url, data=data, cookies=self._cookies,
+                                                   headers=dict(self._headers, **(headers or {})),
+                                                   timeout=self.request_timeout)
             except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-                retries -= 1
-                time.sleep(1)
+                continue
             except Exception as e:
                 logging.debug('Caught Exception "{}" while making a get-request to "{}"'.format(e.__class__, url))
                 break
-        return ret
+            if response.text or response.status_code == 304:
+                break
+        return response
 
     def get_site_responsibilities(self):
         """ Get responsibilities, e.g. which directory-name (==subsite) this API is capable of """
@@ -71,9 +236,9 @@ class BaseAPI:
             return self._site_capabilities
 
         if self._use_api:
-            resps = self._get_api_site_responsibilities()
+            resps = self._memoized(('sites', 'api'), 'sites', self._get_api_site_responsibilities)
         else:
-            resps = self._get_direct_site_responsibilities()
+            resps = self._memoized(('sites', 'direct'), 'sites', self._get_direct_site_responsibilities)
         self._site_capabilities = resps
 
         return resps if resps is not None else []
@@ -99,13 +264,14 @@ class BaseAPI:
     def query(self, type_, by_property_, value_):
         """ Query the API, the cache or the site directly for $type matching $query """
         if not self._use_api:
-            if type_ == 'shoots' and by_property_ == 'id':
-                return self.query_direct_shoot_id(value_)
+            if type_ == 'shoots' and by_property_ in ['id', 'shootid']:
+                return self._memoized(('direct', type_, by_property_, str(value_)), type_,
+                                      lambda: self.query_direct_shoot_id(value_))
             else:
                 logging.warning('Not using the API makes it unable to query for {}!'.format(type))
                 return []
 
-        if self._cache_updating:
+        if self._cache_updating and not self._cache:
             self._wait_for_cache()
 
         if self._cache:
@@ -113,6 +279,11 @@ class BaseAPI:
         else:
             return self.query_api(type_, by_property_, value_)
 
+    def query_many(self, queries):
+        """ Run many queries of (type, by_property, value) concurrently, returns their results in order """
+        with concurrent.futures.ThreadPoolExecutor(self._pool_size) as executor:
+            return list(executor.map(lambda query_: self.query(*query_), queries))
+
     def _wait_for_cache(self):
         i = 0
         while self._cache_updating:
@@ -130,9 +301,15 @@ class BaseAPI:
         """ Use the API-cache to get an item of "type" with by_property matching with query"""
         return
 
-    @NotImplementedError
     def query_api(self, type_, by_property_, value_):
         """ Use the API to get an item of "type" with by_property matching with query"""
+        results = self._memoized(('api', type_, by_property_, str(value_)), type_,
+                                 lambda: self._query_api(type_, by_property_, value_))
+        return results if results is not None else []
+
+    @NotImplementedError
+    def _query_api(self, type_, by_property_, value_):
+        """ Query the API itself, without remembering the results. None if the API did not answer """
         return
 
     def query_direct_shoot_id(self, id_):
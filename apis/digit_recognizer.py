@@ -0,0 +1,139 @@
+import logging
+import os
+
+import cv2
+import numpy as np
+
+
+class DigitRecognizer:
+    """ Reads the digits of the shootid-overlay in-process, with a nearest-neighbour match of glyphs.
+
+    The overlay is always set in the same font on black, so few samples per digit suffice. They are loaded from
+    glyph-images or learned from the digits the fallback (tesseract) recognized.
+    """
+    GLYPH_SIZE = (16, 24)  # width, height of the normalized glyphs
+    THRESHOLD = 100
+    # Glyphs less similar (normalized correlation) to any known glyph make the whole recognition fail
+    MIN_SIMILARITY = 0.8
+    # Samples this similar to a known glyph of the same digit are nothing new
+    MAX_SIMILARITY = 0.97
+    MAX_GLYPHS_PER_DIGIT = 10
+    MAX_DIGITS = 6
+
+    def __init__(self, glyphs=None, path=None):
+        """ glyphs: {digit: [images of the digit]}, path: where learned glyphs are persisted """
+        self._path = path
+        self._glyphs = np.empty((0, self.GLYPH_SIZE[0] * self.GLYPH_SIZE[1]), np.float32)
+        self._labels = np.empty(0, np.int8)
+        if path is not None:
+            self.load(path)
+        for digit, images in (glyphs or {}).items():
+            for image in images:
+                for segment in self._segment(image)[:1]:
+                    self._add_glyph(int(digit), self._normalize(segment))
+
+    def __bool__(self):
+        return bool(self._labels.size)
+
+    def recognize(self, image):
+        """ Get the number in the image, None if any of its glyphs is unknown """
+        if not self:
+            return None
+        segments = self._segment(image)
+        if not segments or len(segments) > self.MAX_DIGITS:
+            return None
+
+        samples = np.stack([self._normalize(segment) for segment in segments])
+        similarities = samples @ self._glyphs.T
+        best = similarities.argmax(axis=1)
+        if (similarities[np.arange(len(best)), best] < self.MIN_SIMILARITY).any():
+            return None
+        return int(''.join(str(digit) for digit in self._labels[best]))
+
+    def learn(self, image, number):
+        """ Remember the glyphs of an image showing the (otherwise recognized) number, returns if any were new """
+        digits = str(number)
+        segments = self._segment(image)
+        if len(segments) != len(digits):
+            return False
+
+        learned = False
+        for digit, segment in zip(digits, segments):
+            learned |= self._add_glyph(int(digit), self._normalize(segment))
+        if learned and self._path is not None:
+            self.save(self._path)
+        return learned
+
+    def _add_glyph(self, digit, glyph):
+        known = self._glyphs[self._labels == digit]
+        if len(known) >= self.MAX_GLYPHS_PER_DIGIT or (len(known) and (known @ glyph).max() >= self.MAX_SIMILARITY):
+            return False
+        self._glyphs = np.vstack([self._glyphs, glyph])
+        self._labels = np.append(self._labels, np.int8(digit))
+        return True
+
+    def _segment(self, image):
+        """ Cut the image into the glyphs, at the columns without any bright pixel """
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        binary = image > self.THRESHOLD
+        columns = binary.any(axis=0)
+        # Starts and ends of the runs of bright columns
+        edges = np.flatnonzero(np.diff(np.concatenate([[False], columns, [False]]).astype(np.int8)))
+        height = image.shape[0]
+        runs = []
+        for start, end in zip(edges[::2], edges[1::2]):
+            rows = np.flatnonzero(binary[:, start:end].any(axis=1))
+            # Ignore specks of compression-noise
+            if rows[-1] - rows[0] + 1 >= height / 4:
+                runs.append((start, end, rows[0], rows[-1] + 1))
+        if not runs:
+            return []
+
+        # The overlay is monospaced, so runs wider than the advance of the separate digits are touching digits
+        advances = [next_[0] - run[0] for run, next_ in zip(runs, runs[1:]) if run[1] - run[0] <= run[3] - run[2]]
+        advance = np.median(advances) if advances else max(run[3] - run[2] for run in runs)
+        segments = []
+        for start, end, top, bottom in runs:
+            parts = max(1, int(round((end - start) / advance)))
+            for part in np.array_split(binary[top:bottom, start:end], parts, axis=1):
+                rows = np.flatnonzero(part.any(axis=1))
+                if rows.size:
+                    segments.append(part[rows[0]:rows[-1] + 1])
+        return segments
+
+    def _normalize(self, segment):
+        """ Scale the glyph to the glyph height, center it, and make it zero-mean and unit-length """
+        width, height = self.GLYPH_SIZE
+        scale = height / segment.shape[0]
+        scaled_width = max(1, min(width, int(round(segment.shape[1] * scale))))
+        scaled = cv2.resize(segment.astype(np.float32), (scaled_width, height), interpolation=cv2.INTER_AREA)
+        glyph = np.zeros((height, width), np.float32)
+        offset = (width - scaled_width) // 2
+        glyph[:, offset:offset + scaled_width] = scaled
+        glyph = glyph.ravel() - glyph.mean()
+        norm = np.linalg.norm(glyph)
+        return glyph / norm if norm else glyph
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with np.load(path) as data:
+                glyphs, labels = data['glyphs'], data['labels']
+        except Exception as e:
+            logging.warning('Digit-glyphs "{}" possibly corrupted (Error: "{}"), ignoring them'.format(path, e))
+            return
+        for digit, glyph in zip(labels, glyphs):
+            self._add_glyph(int(digit), glyph.astype(np.float32))
+
+    def save(self, path):
+        """ Persist the glyphs, together with the ones other processes saved meanwhile """
+        self.load(path)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, glyphs=self._glyphs, labels=self._labels)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.warning('Could not persist the digit-glyphs to "{}": {}'.format(path, e))
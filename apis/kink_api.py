@@ -1,38 +1,89 @@
-import requests
 import bs4
+import concurrent.futures
 import logging
 import datetime
 import cv2
 import numpy as np
 import subprocess
 import os
-import json
 import re
-import tempfile
+import shutil
 
 
+from apis.api_cache import APICache
 from apis.base_api import BaseAPI
+from apis.digit_recognizer import DigitRecognizer
+import media
+
+# The APIs of a recognition worker process, by their name
+_worker_apis = {}
+
+
+def init_recognition_worker(*apis):
+    """ Set up a worker process for recognition: the processes are the parallelism, so OpenCV gets one thread.
+
+    The APIs are handed over once, so the digits they learn and the templates they scale are kept for all tasks.
+    """
+    global _worker_apis
+    cv2.setNumThreads(1)
+    _worker_apis = {api.name: api for api in apis}
+
+
+def get_worker_api(name):
+    """ Get the API of this name which was handed to the worker process """
+    return _worker_apis[name]
+
+
+def _recognize_shootid_in_worker(api_name, file_path, confirming_shootids=()):
+    api = _worker_apis[api_name]
+    try:
+        # Probe once for both
+        media_info = media.probe(file_path)
+        shootid = api.get_shootid_through_image_recognition(file_path, media_info=media_info,
+                                                            confirming_shootids=confirming_shootids)
+        if shootid <= 0:
+            shootid = api.get_shootid_through_metadata(file_path, media_info=media_info) or shootid
+    except Exception as e:
+        logging.warning('Could not recognize the shootid of file "{}", exception was: {}'.format(file_path, e))
+        shootid = -1
+    return shootid
 
 
 class KinkAPI(BaseAPI):
     name = 'Kink.com'
     base_url = 'https://www.kink.com'
     api_url = 'https://www.kinkyapi.site/kinkcom'
-
-    def __init__(self, templates=None, use_api=True):
-        super().__init__(use_api=use_api)
+    dump_types = ('shoots', 'performers')
+    # The shootid is searched in this many seconds at the end of the movie, in this many frames per second
+    SHOOTID_FRAME_SECONDS = 3
+    SHOOTID_FRAME_RATE = 3
+    # The shootid is shown in the lower right, right of (left, top) as fractions of the frame
+    SHOOTID_REGION = (0.4, 0.5)
+    # Templates are for 720p frames, they are matched at a resolution where they are about this high first
+    COARSE_TEMPLATE_HEIGHT = 20
+    MATCH_THRESHOLD = 0.6
+    COARSE_MATCH_THRESHOLD = 0.5
+
+    def __init__(self, templates=None, use_api=True, pool_size=10, cache_dir=None, digit_templates=None):
+        super().__init__(use_api=use_api, pool_size=pool_size, cache_dir=cache_dir)
 
         self.shootid_templates = []
-        for t in templates:
+        for t in templates or []:
             if t.dtype != np.dtype('uint8'):
                 t = cv2.cvtColor(t, cv2.COLOR_BGR2GRAY)
             self.shootid_templates.append(t)
+        self._scaled_templates = {}  # frame height:[(template, coarse template, coarse factor)]
+
+        digits_path = None
+        if cache_dir is not None:
+            digits_path = os.path.join(cache_dir, '.kinksorter_api_{}_digits.npz'.format(re.sub(r'\W', '', self.name)))
+        self.digit_recognizer = DigitRecognizer(digit_templates, path=digits_path)
 
     def set_cookies(self):
         if self._use_api:
             return
 
-        _ret = requests.get(self.base_url)
+        _ret = self._get_session().get(self.base_url, timeout=self.request_timeout)
         _cookies = _ret.cookies
         _cookies['viewing-preferences'] = 'straight,gay'
         self._cookies = _cookies
@@ -68,21 +119,13 @@ class KinkAPI(BaseAPI):
 
         return channel_names if channel_names else None
 
-    def _update_cache(self):
-        shoots = self.make_request_get(self.api_url + '/dump_shoots')
-        if not shoots:
-            # Don't continue, as if we get empty here, our thread was interrupted / no internet => no cache available
-            return
-
-        performers = self.make_request_get(self.api_url + '/dump_performers')
-        if not performers:
-            return
-
-        shoots_j = self._to_json(shoots)
-        performers_j = self._to_json(performers)
+    def _get_dump_url(self, type_):
+        return self.api_url + '/dump_' + type_
 
-        self._cache = {'shoots': shoots_j.get('results', []), 'performers': performers_j.get('results', [])}
-        self._cache_updating = False
+    def _build_cache(self, dumps):
+        return APICache(dumps, self._api_results_to_properties,
+                        indexes={'shoots': ['shootid', 'date', 'site']},
+                        text_indexes={'shoots': ['title'], 'performers': ['name']})
 
     @staticmethod
     def _api_results_to_properties(type_, json_results):
@@ -101,28 +144,27 @@ class KinkAPI(BaseAPI):
 
         return []
 
+    def _is_memoizable(self, results):
+        # query_direct_shoot_id answers a failed connection with just the shootid
+        return super()._is_memoizable(results) and \
+            all('exists' in r_ for r_ in results if isinstance(r_, dict) and 'shootid' in r_)
+
     def query_cache(self, type_, by_property, value):
-        results = []
-        if by_property == 'date':
-            print(type_, by_property, value)
-            print(len(self._cache.get('shoots', [])))
-            print(len(self._cache.get(type_, [])))
-            print(self._cache.keys())
-            print(self._cache.get(type_, [])[1])
-            print(self._cache.get(type_, [])[1].get('date', ''))
-            print(value)
-        for t_ in self._cache.get(type_, []):
-            if by_property in ['title', 'name'] and re.search(value, t_.get(by_property, '')) or \
-               value == t_.get(by_property, ''):
-                results.append(t_)
-
-        return self._api_results_to_properties(type_, results)
-
-    def query_api(self, type_, by_property_, value_):
-        results = self.make_request_get(self.api_url + '/{}_{}/{}'.format(type_[:-1], by_property_, value_))
-        results_j = self._to_json(results)
-
-        if results_j.get('errors', True):
+        if not self._cache:
+            # The download failed or is not done
+            return []
+        return self._cache.find(type_, by_property, value)
+
+    def _query_api(self, type_, by_property_, value_):
+        response = self._make_request(self.api_url + '/{}_{}/{}'.format(type_[:-1], by_property_, value_))
+        if response is None or response.status_code != 200:
+            # No answer of the API, e.g. offline or a proxy's error page, so nothing to remember
+            return None
+        results_j = self._to_json(response.text)
+        if not isinstance(results_j, dict) or 'errors' not in results_j:
+            return None
+
+        if results_j['errors']:
             return []
 
         return self._api_results_to_properties(type_, results_j.get('results', []))
@@ -181,62 +223,174 @@ class KinkAPI(BaseAPI):
         return [properties]
 
     @staticmethod
-    def get_shootid_through_metadata(file_path):
+    def get_shootid_through_metadata(file_path, media_info=None):
         """ Works only on Kink.com movies from around 3500-4500 """
-        o = subprocess.run(['ffprobe', '-show_format', '-v', 'quiet', '-of', 'json', file_path], stdout=subprocess.PIPE)
+        if media_info is None:
+            media_info = media.probe(file_path)
         try:
-            json_output = json.loads(o.stdout.decode())
-            title = json_output.get('format').get('tags').get('title')
+            title = media_info.get('tags').get('title')
             return int(title.split('.')[0].split()[-1])
-        except (ValueError, IndexError, AttributeError, json.JSONDecodeError):
+        except (ValueError, IndexError, AttributeError):
             return 0
 
-    def get_shootid_through_image_recognition(self, file_path):
-        """ Works only on Kink.com movies after ~2007 """
-        red_frame = self._get_fitting_frame(file_path)
+    def get_shootid_through_image_recognition(self, file_path, media_info=None, confirming_shootids=()):
+        """ Works only on Kink.com movies after ~2007. Learns unknown digits only of the confirming shootids """
+        red_frame = self._get_fitting_frame(file_path, media_info=media_info)
         if red_frame is None:
             return -1
 
-        shootid_crop = None
-        for template in self.shootid_templates:
-            template_shape, max_loc = self._match_template(red_frame, template)
-            if max_loc is not None:
-                shootid_crop = red_frame[max_loc[1]:max_loc[1] + template_shape[0], max_loc[0] + template_shape[1]:]
-
+        shootid_crop = self._crop_shootid(red_frame)
         if shootid_crop is None:
             logging.debug('Templates for shootid did not match file "{}"'.format(file_path))
             return 0
 
-        shootid = self.recognize_shootid(shootid_crop)
+        shootid = self.recognize_shootid(shootid_crop, confirming_shootids=confirming_shootids)
         if not shootid:
-            logging.debug('Tesseract couldn\'t recognize digits for file "{}"'.format(file_path))
+            logging.debug('Could not recognize digits for file "{}"'.format(file_path))
             if logging.getLogger(self.__class__.__name__).level == logging.DEBUG:
                 self.debug_frame(shootid_crop)
 
         return shootid
 
-    def _match_template(self, red_frame, template):
+    def recognize_shootids_batch(self, file_paths, jobs=None, confirming_shootids=None):
+        """ Recognize the shootids of many files with a pool of processes, yields (file_path, shootid) when done.
+
+        The shootid is searched in the image and then in the metadata, 0 if none was found, -1 for broken files.
+        confirming_shootids ({file_path: [shootids]}) are the ones of which unknown digits may be learned.
+        """
+        confirming_shootids = confirming_shootids or {}
+        jobs = jobs or os.cpu_count() or 1
+        processes = concurrent.futures.ProcessPoolExecutor(jobs, initializer=init_recognition_worker, initargs=(self,))
+        pending = {}  # future:file_path
+        file_paths = iter(file_paths)
+        try:
+            exhausted = False
+            while not exhausted or pending:
+                # Keep the workers busy, but do not queue up all files
+                while not exhausted and len(pending) < 2 * jobs:
+                    file_path = next(file_paths, None)
+                    if file_path is None:
+                        exhausted = True
+                    else:
+                        future = processes.submit(_recognize_shootid_in_worker, self.name, file_path,
+                                                  confirming_shootids.get(file_path, ()))
+                        pending[future] = file_path
+
+                if not pending:
+                    continue
+
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        finally:
+            processes.shutdown(wait=False, cancel_futures=True)
+
+    def _crop_shootid(self, red_frame):
+        """ Get the part of the frame right of the matching shootid-template, where the digits are """
         height, width = red_frame.shape
-        # Template is for 720p image, so scale it accordingly
-        scale = height / 720.0
-        template_scaled = cv2.resize(template.copy(), (0, 0), fx=scale, fy=scale)
-        result = cv2.matchTemplate(red_frame, template_scaled, cv2.TM_CCOEFF_NORMED)
+        region = red_frame[int(height * self.SHOOTID_REGION[1]):, int(width * self.SHOOTID_REGION[0]):]
+        coarse_regions = {}
+        for template, coarse_template, factor in self._get_scaled_templates(height):
+            if factor > 1 and factor not in coarse_regions:
+                coarse_regions[factor] = cv2.resize(region, (0, 0), fx=1 / factor, fy=1 / factor,
+                                                    interpolation=cv2.INTER_AREA)
+            max_loc = self._match_template(region, template, coarse_regions.get(factor), coarse_template, factor)
+            if max_loc is not None:
+                # The first confident match is it, the templates are alternatives
+                return region[max_loc[1]:max_loc[1] + template.shape[0], max_loc[0] + template.shape[1]:]
+        return None
+
+    def _get_scaled_templates(self, height):
+        """ The templates scaled to the frame height, and downscaled for the coarse search, once per resolution """
+        scaled_templates = self._scaled_templates.get(height)
+        if scaled_templates is None:
+            scaled_templates = []
+            # Template is for 720p image, so scale it accordingly
+            scale = height / 720.0
+            for template in self.shootid_templates:
+                template_scaled = cv2.resize(template, (0, 0), fx=scale, fy=scale)
+                factor = max(1, template_scaled.shape[0] // self.COARSE_TEMPLATE_HEIGHT)
+                template_coarse = cv2.resize(template_scaled, (0, 0), fx=1 / factor, fy=1 / factor,
+                                             interpolation=cv2.INTER_AREA) if factor > 1 else None
+                scaled_templates.append((template_scaled, template_coarse, factor))
+            self._scaled_templates[height] = scaled_templates
+        return scaled_templates
+
+    def _match_template(self, region, template, coarse_region=None, coarse_template=None, factor=1):
+        """ Get the location of the template in the region, if it matches.
+
+        With a coarse template, it is searched in the downscaled region first and only confirmed in full resolution
+        around where it matched best.
+        """
+        if region.shape[0] < template.shape[0] or region.shape[1] < template.shape[1]:
+            return None
+
+        x, y = 0, 0
+        if coarse_template is not None:
+            result = cv2.matchTemplate(coarse_region, coarse_template, cv2.TM_CCOEFF_NORMED)
+            _, max_val, _, max_loc = cv2.minMaxLoc(result)
+            if max_val < self.COARSE_MATCH_THRESHOLD:
+                return None
+            x, y = max(0, (max_loc[0] - 1) * factor), max(0, (max_loc[1] - 1) * factor)
+            region = region[y:y + template.shape[0] + 2 * factor, x:x + template.shape[1] + 2 * factor]
+            if region.shape[0] < template.shape[0] or region.shape[1] < template.shape[1]:
+                return None
+
+        result = cv2.matchTemplate(region, template, cv2.TM_CCOEFF_NORMED)
         _, max_val, _, max_loc = cv2.minMaxLoc(result)
-        return template_scaled.shape, max_loc if max_val > 0.6 else None
+        return (x + max_loc[0], y + max_loc[1]) if max_val > self.MATCH_THRESHOLD else None
 
-    def _get_fitting_frame(self, file_path):
+    def _get_fitting_frame(self, file_path, media_info=None):
         if not self.shootid_templates:
             logging.debug('No template to recognize shootids')
             return None
 
+        if media_info is None:
+            media_info = media.probe(file_path)
+        if not media_info:
+            logging.debug('File "{}" is not readable'.format(file_path))
+            return None
+
+        if shutil.which('ffmpeg') and media_info.get('width') and media_info.get('height'):
+            red_frame = self._get_fitting_frame_streaming(file_path, media_info)
+        else:
+            red_frame = self._get_fitting_frame_seeking(file_path, media_info)
+
+        if red_frame is None:
+            logging.debug('No suitable frames found in the last seconds of file "{}"'.format(file_path))
+        return red_frame
+
+    def _get_fitting_frame_streaming(self, file_path, media_info):
+        """ Decode the end of the file once with ffmpeg and test the frames while they stream in """
+        width, height = media_info['width'], media_info['height']
+        command = ['ffmpeg', '-v', 'quiet', '-noautorotate', '-sseof', '-{}'.format(self.SHOOTID_FRAME_SECONDS),
+                   '-i', file_path, '-an', '-sn', '-vf', 'fps={}'.format(self.SHOOTID_FRAME_RATE),
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-']
+        frame_size = width * height * 3
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as process:
+            try:
+                while True:
+                    data = process.stdout.read(frame_size)
+                    if len(data) < frame_size:
+                        return None
+                    frame_ = np.frombuffer(data, np.uint8).reshape(height, width, 3)
+                    if self._is_fitting_frame(frame_):
+                        return np.ascontiguousarray(frame_[:, :, 2])
+            finally:
+                # Stop decoding right at the first fitting frame
+                process.kill()
+
+    def _get_fitting_frame_seeking(self, file_path, media_info):
+        """ Seek through the end of the file with OpenCV, in case ffmpeg is not available """
         capture = cv2.VideoCapture(file_path)
-        fps, frame_count = self._prepare_capture(capture)
+        fps, frame_count = self._prepare_capture(capture, media_info)
         if not frame_count:
             logging.debug('No frames to recognize found for file "{}"'.format(file_path))
+            capture.release()
             return None
 
-        analysis_range = int(frame_count - 3 * fps)
-        frame_steps = int(fps / 3)
+        analysis_range = int(frame_count - self.SHOOTID_FRAME_SECONDS * fps)
+        frame_steps = max(1, int(fps / self.SHOOTID_FRAME_RATE))
         next_frame = frame_count - 1
         red_frame = None
         while red_frame is None and next_frame >= analysis_range:
@@ -244,11 +398,14 @@ class KinkAPI(BaseAPI):
             next_frame -= frame_steps
 
         capture.release()
-        if red_frame is None:
-            logging.debug('No suitable frames found in the last seconds of file "{}"'.format(file_path))
         return red_frame
 
-    def _prepare_capture(self, capture):
+    @staticmethod
+    def _prepare_capture(capture, media_info):
+        if media_info.get('fps') and media_info.get('frame_count'):
+            # Already probed
+            return media_info['fps'], media_info['frame_count']
+
         # TODO: ignore errors of capture.set of partial files
         frame_count = capture.get(cv2.CAP_PROP_FRAME_COUNT)
         fps = capture.get(cv2.CAP_PROP_FPS)
@@ -260,17 +417,34 @@ class KinkAPI(BaseAPI):
     def _get_next_frame(self, capture, next_frame):
         capture.set(cv2.CAP_PROP_POS_FRAMES, next_frame)
         ret, frame_ = capture.read()
-        if ret and frame_.any() and (frame_[:, :] > 0).sum() / frame_.size < 0.1:
-            red_frame = cv2.inRange(cv2.cvtColor(frame_, cv2.COLOR_BGR2HSV), (0, 50, 50), (30, 255, 255))
+        if ret and self._is_fitting_frame(frame_):
             return frame_[:, :, 2]
 
     @staticmethod
-    def recognize_shootid(shootid_img):
-        with tempfile.NamedTemporaryFile(suffix='.png') as f_:
-            tmp_path = f_.name
+    def _is_fitting_frame(frame):
+        """ The shootid is shown on a (mostly) black frame """
+        return frame.any() and (frame > 0).sum() / frame.size < 0.1
+
+    def recognize_shootid(self, shootid_img, confirming_shootids=()):
+        shootid = self.digit_recognizer.recognize(shootid_img)
+        if shootid:
+            return shootid
+
+        # Unknown glyphs, ask tesseract. A misread would be learned for good, so only learn confirmed answers
+        shootid = self.recognize_shootid_tesseract(shootid_img)
+        if shootid and shootid in confirming_shootids:
+            self.digit_recognizer.learn(shootid_img, shootid)
+        return shootid
+
+    @staticmethod
+    def recognize_shootid_tesseract(shootid_img):
+        if not shutil.which('tesseract'):
+            logging.debug('No tesseract to recognize unknown digits')
+            return 0
         _, t_ = cv2.threshold(shootid_img, 100, 255, cv2.THRESH_BINARY)
-        cv2.imwrite(tmp_path, t_)
-        out = subprocess.run(['tesseract', tmp_path, 'stdout', 'digits'], stdout=subprocess.PIPE)
+        _, png = cv2.imencode('.png', t_)
+        out = subprocess.run(['tesseract', 'stdin', 'stdout', 'digits'], input=png.tobytes(),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
         output = out.stdout.decode()
         if ' ' in output:
             output = output.replace(' ', '')
@@ -284,32 +458,51 @@ class KinkAPI(BaseAPI):
         os.system('eog /tmp/test.jpeg 2>/dev/null')
 
 if __name__ == '__main__':
-    from utils import Settings
-    settings = Settings({'shootid_template_dir': 'apis/templates/'})
-    api_ = settings.apis['Kink.com']
+    import argparse
     import sys
+    import time
+    import tqdm
+
+    import media
     from movie import Movie
+    from utils import Settings
+
+    argparser = argparse.ArgumentParser(description="Validate the recognized shootids of a directory of Kink.com "
+                                                    "movies against their filenames, or debug a single movie")
+    argparser.add_argument('path', help="Directory of movies, or a single movie")
+    argparser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="Number of worker processes")
+    argparser.add_argument('-o', '--output', default='list.txt',
+                           help="Where to list the movies whose shootid differs from the filename")
+    args = argparser.parse_args()
+
+    # Use the caches (e.g. the learned digits) of the directory, if it was sorted before
+    settings = Settings({'shootid_template_dir': os.path.join(os.path.dirname(__file__), 'templates'),
+                         'storage_root_path': args.path if os.path.isdir(args.path) else os.path.dirname(args.path)})
+    api_ = settings.apis['Kink.com']
     Movie.settings = settings
-    path_ = sys.argv[1]
-    if os.path.isdir(path_):
+    if not os.path.isdir(args.path):
         logging.basicConfig(format='%(funcName)s: %(message)s',
-                            level=logging.WARNING)
-        with open('list.txt', 'w') as f:
-            for entry in os.scandir(path_):
-                print(entry.name)
-                mov = Movie(os.path.join(path_, entry.path), api=api_)
-                shootid_cv = api_.get_shootid_through_image_recognition(entry.path)
-                if shootid_cv <= 0:
-                    shootid_cv = api_.get_shootid_through_metadata(entry.path)
-                shootid_nr = mov.get_shootids_from_filename(entry.path)
-                if len(shootid_nr) == 1 and shootid_cv == shootid_nr[0] or \
-                        not shootid_nr and shootid_cv:
-                    continue
-                f.write("{} -> {}\n".format(entry.path, shootid_cv))
+                            level=logging.DEBUG)
+        print(api_.get_shootid_through_image_recognition(args.path))
         sys.exit(0)
 
     logging.basicConfig(format='%(funcName)s: %(message)s',
-                        level=logging.DEBUG)
-
-    print(api_.get_shootid_through_image_recognition(path_))
-
+                        level=logging.WARNING)
+    paths_ = [os.path.join(root_, name_) for root_, _, names_ in os.walk(args.path) for name_ in sorted(names_)
+              if media.is_video_file(os.path.join(root_, name_))]
+    shootids_nr = dict(zip(paths_, Movie.get_shootids_from_filenames(paths_)))
+    mismatches = 0
+    start = time.perf_counter()
+    with open(args.output, 'w') as f:
+        recognized = api_.recognize_shootids_batch(paths_, jobs=args.jobs, confirming_shootids=shootids_nr)
+        for path_, shootid_cv in tqdm.tqdm(recognized, total=len(paths_)):
+            shootid_nr = shootids_nr[path_]
+            if len(shootid_nr) == 1 and shootid_cv == shootid_nr[0] or \
+                    not shootid_nr and shootid_cv > 0:
+                continue
+            mismatches += 1
+            f.write("{} -> {}\n".format(path_, shootid_cv))
+
+    duration = time.perf_counter() - start
+    print('{} movies in {:.1f}s ({:.1f}/s), {} differ from their filename, see "{}"'.format(
+        len(paths_), duration, len(paths_) / duration if duration else 0, mismatches, args.output))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+""" Lookups/second of the API-client against a local stub server, fresh connections vs. pooled and concurrent """
+
+import argparse
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from apis.kink_api import KinkAPI
+
+
+class StubAPIHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    latency = 0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        body = json.dumps({'errors': False, 'results': [
+            {'shootid': self.path.split('/')[-1], 'exists': True, 'site': {'name': 'Test Site'}, 'title': 'test',
+             'performers': [{'name': 'Testy Mc. Test'}], 'date': 1167609600}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def lookups_per_second(function, count):
+    start = time.perf_counter()
+    function(count)
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('-n', '--lookups', type=int, default=500)
+    argparser.add_argument('-l', '--latency', type=float, default=0.01, help="Seconds the stub takes per answer")
+    argparser.add_argument('-p', '--pool_size', type=int, default=10)
+    args = argparser.parse_args()
+
+    StubAPIHandler.latency = args.latency
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubAPIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api = KinkAPI([], pool_size=args.pool_size)
+    api.api_url = 'http://127.0.0.1:{}/kinkcom'.format(server.server_port)
+
+    def fresh_connections(count):
+        # What make_request_get did before: module-level requests.get, one connection per lookup
+        for shootid in range(count):
+            requests.get(api.api_url + '/shoot_shootid/{}'.format(shootid), timeout=2)
+
+    def pooled(count):
+        for shootid in range(count):
+            api.query('shoots', 'shootid', shootid)
+
+    def concurrent(count):
+        api.query_many([('shoots', 'shootid', shootid) for shootid in range(count)])
+
+    for name, function in [('fresh connections', fresh_connections), ('pooled session', pooled),
+                           ('query_many', concurrent)]:
+        print('{:<18}: {:>8.1f} lookups/s'.format(name, lookups_per_second(function, args.lookups)))
+    server.shutdown()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+""" Memory and time of loading a big database, as every run starts with Database.read() """
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from database import Database
+import utils
+
+SITES = ['Hogtied', 'Device Bondage', 'Water Bondage', 'Sex And Submission', 'Public Disgrace', 'Bound Gods']
+PERFORMERS = ['Performer {}'.format(i) for i in range(2000)]
+
+
+def build_serialized_movies(root, count):
+    movies = {}
+    for i in range(count):
+        site = SITES[i % len(SITES)]
+        file_path = os.path.join(root, site, '{} - Scene {} ({}).mp4'.format(site, i, 1000 + i))
+        movies[file_path] = {
+            'api': 'Kink.com',
+            'file_properties': {'file_path': file_path, 'storage_root_path': root,
+                                'signature': [i, 1 << 30, 1500000000 * 10 ** 9 + i], 'fingerprint': None,
+                                'media_info': None},
+            'scene_properties': {'title': 'Scene {}'.format(i), 'site': site, 'shootid': 1000 + i,
+                                 'performers': [PERFORMERS[i % len(PERFORMERS)], PERFORMERS[(i * 7) % len(PERFORMERS)]],
+                                 'date': 1200000000 + i * 3600}}
+    return movies
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('-n', '--movies', type=int, default=100000, help="Size of the synthetic database")
+    args = argparser.parse_args()
+
+    settings = utils.Settings({})
+    with tempfile.TemporaryDirectory() as root:
+        database = Database(root, settings)
+        database._storage.write(False, build_serialized_movies(root, args.movies), {}, full=True)
+        del database
+        gc.collect()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        database = Database(root, settings)
+        database.read()
+        duration = time.perf_counter() - start
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print('{} movies loaded in {:.2f}s'.format(len(database.movies), duration))
+        print('retained: {:>7.1f} MB ({:.0f} bytes/movie), peak: {:.1f} MB'.format(
+            retained / 2 ** 20, retained / len(database.movies), peak / 2 ** 20))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+""" Seconds to find the duplicates of an archive, hashing every movie vs. size buckets, fingerprints, full hashes """
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dedupe
+
+
+def build_archive(root, count, duplicates, size):
+    paths = []
+    for i in range(count):
+        # Sizes vary like the ones of movies, so only few are equally big by chance
+        content = os.urandom(size + random.randrange(size))
+        paths.append(os.path.join(root, 'movie_{}.mp4'.format(i)))
+        with open(paths[-1], 'wb') as f:
+            f.write(content)
+    for i in range(duplicates):
+        with open(paths[i], 'rb') as f:
+            content = f.read()
+        paths.append(os.path.join(root, 'copy_{}.mp4'.format(i)))
+        with open(paths[-1], 'wb') as f:
+            f.write(content)
+    return paths
+
+
+def hash_everything(paths):
+    groups = {}
+    for path in paths:
+        groups.setdefault(dedupe.full_hash(path), []).append(path)
+    return [paths_ for paths_ in groups.values() if len(paths_) > 1]
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('-n', '--movies', type=int, default=200, help="Number of synthetic movies")
+    argparser.add_argument('-d', '--duplicates', type=int, default=20, help="Number of them copied once more")
+    argparser.add_argument('-s', '--size', type=int, default=16, help="Minimal size of a movie in MiB")
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        paths = build_archive(root, args.movies, args.duplicates, args.size << 20)
+
+        start = time.perf_counter()
+        groups = hash_everything(paths)
+        print('hash everything: {:>7.2f}s, {} groups'.format(time.perf_counter() - start, len(groups)))
+
+        start = time.perf_counter()
+        duplicates, _ = dedupe.find_duplicates({path: (None, None) for path in paths})
+        print('find_duplicates: {:>7.2f}s, {} groups, {} MiB reclaimable'.format(
+            time.perf_counter() - start, len(duplicates), dedupe.reclaimable_bytes(duplicates) >> 20))
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+""" MB/second of copying a movie, shutil.copy vs. fileops (reflink, copy_file_range, sendfile) """
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fileops
+
+
+def measure(copy, source, target, size):
+    start = time.perf_counter()
+    copy(source, target)
+    duration = time.perf_counter() - start
+    os.remove(target)
+    return size / duration / 2 ** 20
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('-s', '--size', type=int, default=1024, help="Size of the synthetic movie in MiB")
+    argparser.add_argument('--source_dir', default=None, help="Filesystem to copy from (default: temp)")
+    argparser.add_argument('--target_dir', default=None, help="Filesystem to copy to (default: the source one)")
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.source_dir) as source_dir, \
+            tempfile.TemporaryDirectory(dir=args.target_dir or args.source_dir) as target_dir:
+        source = os.path.join(source_dir, 'movie.mp4')
+        with open(source, 'wb') as f:
+            for _ in range(args.size):
+                f.write(os.urandom(1 << 20))
+        target = os.path.join(target_dir, 'movie.mp4')
+        size = args.size << 20
+
+        print('shutil.copy:         {:>8.0f} MB/s'.format(measure(shutil.copy, source, target, size)))
+        print('fileops.copy_file:   {:>8.0f} MB/s'.format(measure(fileops.copy_file, source, target, size)))
+        fileops._reflink = lambda *args_: False
+        print('  without reflink:   {:>8.0f} MB/s'.format(measure(fileops.copy_file, source, target, size)))
+        del os.copy_file_range
+        print('  only sendfile:     {:>8.0f} MB/s'.format(measure(fileops.copy_file, source, target, size)))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+""" Filenames/second of finding the shootids in filenames, the search-loop before vs. the single-pass tokenizer """
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import movie
+from movie import Movie
+
+UNLIKELY_DATE_RE = re.compile(r'([01]\d)({})({})'.format('|'.join(['{:02}'.format(i) for i in range(1, 13)]),
+                                                          '|'.join(['{:02}'.format(i) for i in range(1, 32)])))
+UNLIKELY_NUMBERS = {'quality': [360, 480, 720, 1080, 1440, 2160], 'date': list(range(1970, 2030))}
+SITES = ['Hogtied', 'Device Bondage', 'Water Bondage', 'Sex And Submission', 'Public Disgrace']
+
+
+def get_shootids_search_loop(file_path):
+    """ The extraction before, re-slicing the name and searching again after every number """
+    search_name = '%' + os.path.basename(file_path) + '%'
+    search_shootid = []
+    search_match = 1
+    while search_match:
+        search_name = search_name[search_match.end() - 1:] if search_match != 1 else search_name
+        search_match = re.search(r"(\D)(\d{2,6})(\D)", search_name)
+        if search_match:
+            pre_, k, post_ = search_match.groups()
+            shootid = int(k)
+            if shootid in UNLIKELY_NUMBERS['date'] or UNLIKELY_DATE_RE.search(k) or shootid < 200:
+                continue
+            if shootid in UNLIKELY_NUMBERS['quality'] and (pre_ != '(' or post_ != ')'):
+                continue
+            if pre_ in ['(', '['] and post_ in [')', ']']:
+                return [shootid]
+            search_shootid.append(shootid)
+    return search_shootid
+
+
+def build_filenames(count):
+    random.seed(count)
+    names = []
+    for i in range(count):
+        site = random.choice(SITES)
+        date = '{}-{:02}-{:02}'.format(random.randint(2005, 2020), random.randint(1, 12), random.randint(1, 28))
+        shootid = random.randint(200, 99999)
+        style = i % 4
+        if style == 0:
+            name = '{} - {} - Scene {} [{}].mp4'.format(site, date, i, shootid)
+        elif style == 1:
+            name = '{}_{}_{}_720p.wmv'.format(site.replace(' ', ''), shootid, random.choice([480, 720, 1080]))
+        elif style == 2:
+            name = '{:02}{:02}{:02} {} {} {}.mp4'.format(random.randint(5, 19), random.randint(1, 12),
+                                                        random.randint(1, 28), site, shootid, i)
+        else:
+            name = 'Scene {} ({}).avi'.format(i, shootid)
+        names.append('/storage/{}/{}'.format(site, name))
+    return names
+
+
+def measure(function, names):
+    start = time.perf_counter()
+    results = function(names)
+    return results, len(names) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('-n', '--filenames', type=int, default=1000000, help="Synthetic filenames")
+    args = argparser.parse_args()
+
+    names = build_filenames(args.filenames)
+    expected, rate = measure(lambda names_: [get_shootids_search_loop(n_) for n_ in names_], names)
+    print('search-loop:      {:>10.0f} filenames/s'.format(rate))
+    results, rate = measure(Movie.get_shootids_from_filenames, names)
+    print('tokenizer (cold): {:>10.0f} filenames/s'.format(rate))
+    assert results == expected, 'Results differ'
+    for size in (1 << 10, 1 << 16):
+        repeated = [names[i % size] for i in range(args.filenames)]
+        movie._get_shootids_from_base_name.cache_clear()
+        _, rate = measure(Movie.get_shootids_from_filenames, repeated)
+        print('tokenizer ({:>5} distinct names): {:>10.0f} filenames/s'.format(size, rate))
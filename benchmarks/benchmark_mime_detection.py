@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+""" Files/second of the video detection of the scanner, `file`-subprocess vs. in-process sniffing """
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import media
+
+HEADERS = [('.mp4', b'\x00\x00\x00\x18ftypisom\x00\x00\x02\x00'),
+           ('', b'\x1a\x45\xdf\xa3\x01\x00\x00\x00'),
+           ('', b'RIFF\x00\x00\x00\x00AVI LIST'),
+           ('.nfo', b'Shoot ID: 1337\n'),
+           ('.jpg', b'\xff\xd8\xff\xe0\x00\x10JFIF')]
+
+
+def is_video_file_subprocess(full_path):
+    """ The detection before, one `file` per scanned file """
+    mime_type = subprocess.check_output(['file', '-b', '--mime-type', full_path]).decode('utf-8')
+    return mime_type.startswith('video/') or mime_type.startswith('application/vnd.rn-realmedia')
+
+
+def build_tree(root, count):
+    paths = []
+    for i in range(count):
+        directory = os.path.join(root, 'site{}'.format(i % 50))
+        os.makedirs(directory, exist_ok=True)
+        extension, header = HEADERS[i % len(HEADERS)]
+        path = os.path.join(directory, 'movie{}{}'.format(i, extension))
+        with open(path, 'wb') as f:
+            f.write(header + bytes(512))
+        paths.append(path)
+    return paths
+
+
+def measure(detector, paths):
+    start = time.perf_counter()
+    found = sum(1 for path in paths if detector(path))
+    return found, len(paths) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('-n', '--files', type=int, default=100000, help="Size of the synthetic tree")
+    argparser.add_argument('--subprocess_files', type=int, default=2000,
+                           help="Only run the slow `file`-detection on this many files")
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        paths = build_tree(root, args.files)
+        found, rate = measure(media.is_video_file, paths)
+        print('in-process: {:>10.0f} files/s ({} videos)'.format(rate, found))
+        found, rate = measure(is_video_file_subprocess, paths[:args.subprocess_files])
+        print('subprocess: {:>10.0f} files/s ({} videos)'.format(rate, found))
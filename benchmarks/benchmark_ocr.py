@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+""" Accuracy and crops/second of the shootid-OCR, in-process digit recognizer vs. tesseract-subprocess.
+
+With --movies, the crops are the shootid-overlays of real Kink.com movies, whose filename has exactly one
+shootid to check against. The recognizer learns its glyphs from the first few of them, like it does from the
+confirmed answers of tesseract, and is measured on the others.
+
+Without, the frames are rendered from the bundled templates in apis/templates with an OpenCV font, in all common
+resolutions and JPEG-compressed like a movie. As the recognizer learns the very same font, this is only a
+synthetic self-check of the speed and of the segmentation, not of the accuracy on real overlays.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from apis.kink_api import KinkAPI
+import media
+from movie import Movie
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apis', 'templates')
+RESOLUTIONS = [(854, 480), (1280, 720), (1920, 1080), (3840, 2160)]
+
+
+def render_frame(template, shootid, width, height):
+    frame = np.zeros((height, width, 3), np.uint8)
+    scale = height / 720.0
+    template = cv2.resize(template, (0, 0), fx=scale, fy=scale)
+    y, x = int(height * 0.8), int(width * 0.5)
+    frame[y:y + template.shape[0], x:x + template.shape[1]] = template[:, :, None]
+    cv2.putText(frame, str(shootid), (x + template.shape[1] + int(10 * scale), y + int(35 * scale)),
+                cv2.FONT_HERSHEY_SIMPLEX, 1.3 * scale, (255, 255, 255), max(1, int(3 * scale)))
+    _, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 75])
+    return cv2.imdecode(jpeg, cv2.IMREAD_COLOR)[:, :, 2]
+
+
+def build_crops(api, templates, count):
+    crops = []
+    for i in range(count):
+        shootid = random.randint(1000, 99999)
+        width, height = RESOLUTIONS[i % len(RESOLUTIONS)]
+        red_frame = render_frame(templates[i % len(templates)], shootid, width, height)
+        crops.append((api._crop_shootid(red_frame), shootid))
+    return crops
+
+
+def build_movie_crops(api, directory):
+    crops = []
+    for root_, _, names_ in os.walk(directory):
+        for name_ in sorted(names_):
+            path_ = os.path.join(root_, name_)
+            if not media.is_video_file(path_):
+                continue
+            shootids = Movie.get_shootids_from_filenames([path_])[0]
+            red_frame = api._get_fitting_frame(path_) if len(shootids) == 1 else None
+            crop = api._crop_shootid(red_frame) if red_frame is not None else None
+            if crop is not None:
+                crops.append((crop, shootids[0]))
+    return crops
+
+
+def measure(recognize, crops):
+    start = time.perf_counter()
+    correct = sum(1 for crop, shootid in crops if crop is not None and recognize(crop) == shootid)
+    return correct / len(crops), len(crops) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('-n', '--crops', type=int, default=200, help="Number of synthetic shootid-crops")
+    argparser.add_argument('--movies', help="Directory of real movies to take the crops from instead")
+    argparser.add_argument('--training_crops', type=int, default=8, help="Crops to learn the glyphs from")
+    argparser.add_argument('--tesseract_crops', type=int, default=100,
+                           help="Only run the slow tesseract-recognition on this many crops")
+    args = argparser.parse_args()
+
+    random.seed(1337)
+    templates = [cv2.imread(os.path.join(TEMPLATE_DIR, name), 0) for name in sorted(os.listdir(TEMPLATE_DIR))
+                 if name.endswith('.jpeg')]
+    api = KinkAPI(templates)
+    if args.movies:
+        crops = build_movie_crops(api, args.movies)
+        training_crops, crops = crops[:args.training_crops], crops[args.training_crops:]
+        if not crops:
+            sys.exit('No movies with a recognizable overlay and a shootid in their filename')
+    else:
+        training_crops = build_crops(api, templates, args.training_crops)
+        crops = build_crops(api, templates, args.crops)
+    for crop, shootid in training_crops:
+        if crop is not None:
+            api.digit_recognizer.learn(crop, shootid)
+
+    accuracy, rate = measure(api.digit_recognizer.recognize, crops)
+    print('in-process: {:>8.0f} crops/s ({:.1%} correct)'.format(rate, accuracy))
+    if shutil.which('tesseract'):
+        accuracy, rate = measure(api.recognize_shootid_tesseract, crops[:args.tesseract_crops])
+        print('tesseract:  {:>8.0f} crops/s ({:.1%} correct)'.format(rate, accuracy))
+    else:
+        print('tesseract:  not installed')
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+""" Frames/second of finding the shootid-template, full frame with all templates vs. cached template pyramid """
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from apis.kink_api import KinkAPI
+from benchmark_ocr import TEMPLATE_DIR, RESOLUTIONS, render_frame
+
+
+def crop_shootid_full_frame(api, red_frame):
+    """ The matching before, every template rescaled and searched in the whole frame, for every frame """
+    shootid_crop = None
+    for template in api.shootid_templates:
+        scale = red_frame.shape[0] / 720.0
+        template_scaled = cv2.resize(template.copy(), (0, 0), fx=scale, fy=scale)
+        result = cv2.matchTemplate(red_frame, template_scaled, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, max_loc = cv2.minMaxLoc(result)
+        if max_val > 0.6:
+            shootid_crop = red_frame[max_loc[1]:max_loc[1] + template_scaled.shape[0],
+                                     max_loc[0] + template_scaled.shape[1]:]
+    return shootid_crop
+
+
+def measure(crop_shootid, frames):
+    start = time.perf_counter()
+    found = sum(1 for red_frame in frames if crop_shootid(red_frame) is not None)
+    return found, len(frames) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument('-n', '--frames', type=int, default=20, help="Synthetic frames per resolution")
+    args = argparser.parse_args()
+
+    random.seed(1337)
+    templates = [cv2.imread(os.path.join(TEMPLATE_DIR, name), 0) for name in sorted(os.listdir(TEMPLATE_DIR))
+                 if name.endswith('.jpeg')]
+    api = KinkAPI(templates)
+    for width, height in RESOLUTIONS:
+        frames = [render_frame(templates[i % len(templates)], random.randint(1000, 99999), width, height)
+                  for i in range(args.frames)]
+        found_before, rate_before = measure(lambda f: crop_shootid_full_frame(api, f), frames)
+        found, rate = measure(api._crop_shootid, frames)
+        print('{:>5}p: full frame {:>7.1f} frames/s ({} found), pyramid {:>7.1f} frames/s ({} found)'.format(
+            height, rate_before, found_before, rate, found))
@@ -1,53 +1,95 @@
 import logging
-import json
 
 from collections import OrderedDict
 from os import path, access, W_OK, R_OK
 
 from movie import Movie
+from storages.json_storage import JSONStorage
+from storages.sqlite_storage import SQLiteStorage
 import utils
 
 
 class Database:
+    STORAGES = {JSONStorage.name: JSONStorage, SQLiteStorage.name: SQLiteStorage}
 
     def __init__(self, database_dir, settings):
-        database_path = path.join(database_dir, '.kinksorter_db')
-        self._path = database_path
+        self._database_dir = database_dir
+        self._storage = self.STORAGES[settings.database_backend](database_dir)
+        self._path = self._storage.path
         self._settings = settings
         self.movies = {}  # filename:Movie(),
+        self.directories = {}  # directory:{'mtime': mtime, 'files': [names], 'directories': [names]}
+        self._signatures = {}  # FileProperties.signature:filename
         self._own_movies = {}
         self.merge_diff_list = []
+        self._merge_diff_set = set()
         self.original = True
+        self._changed_movies = set()  # filenames of movies changed since the last write
+        self._changed_directories = set()
+        self._full_write = True
+
+    @property
+    def directory(self):
+        return self._database_dir
 
     def add_movie(self, movie):
         """ Add the movie to the database, if it is not already in there. """
         if not self.check_movie_duplicates(movie):
             self.movies[movie.file_properties.file_path] = movie
+            self.set_signature(movie, movie.file_properties.signature)
+            self._changed_movies.add(movie.file_properties.file_path)
 
     def del_movie(self, movie_path):
         """ Remove the movie from the database """
         item = self.movies.pop(movie_path, None)
+        if item is not None:
+            self._changed_movies.add(movie_path)
+            if self._signatures.get(item.file_properties.signature) == movie_path:
+                del self._signatures[item.file_properties.signature]
         del item
 
-    def get_movies(self, scene_properties):
-        """ Get all movies matching the scene properties """
-        movies = []
-        for movie in self.movies.values():
-            if movie.scene_properties == scene_properties:
-                movies.append(movie)
-        return movies
+    def update_movie(self, movie):
+        """ Write the movie with the next write, after its scene properties or inspections changed """
+        if movie.file_properties.file_path in self.movies:
+            self._changed_movies.add(movie.file_properties.file_path)
+
+    def set_signature(self, movie, signature):
+        """ Set the file signature of the movie and index it """
+        if movie.file_properties.signature != signature:
+            # The content may have changed as well
+            movie.file_properties.fingerprint = None
+            movie.file_properties.media_info = None
+        movie.file_properties.signature = signature
+        if signature is not None:
+            self._signatures[signature] = movie.file_properties.file_path
+        self._changed_movies.add(movie.file_properties.file_path)
+
+    def set_directory(self, directory, entries):
+        """ Remember the entries of a scanned directory """
+        self.directories[directory] = entries
+        self._changed_directories.add(directory)
+
+    def del_directory(self, directory):
+        """ Forget a scanned directory, returns its entries """
+        self._changed_directories.add(directory)
+        return self.directories.pop(directory, None)
+
+    def get_movie_by_signature(self, signature):
+        """ Get the movie whose file had that signature when scanned, if any """
+        file_path = self._signatures.get(signature)
+        return self.movies.get(file_path) if file_path is not None else None
 
     def check_movie_duplicates(self, movie):
         """ Checks for duplicate files, not duplicate movies. """
-        for m_ in self.movies.keys():
-            if movie.file_properties.file_path == m_:
-                logging.debug('Movie "{}" was already in the database'.format(m_))
-                return True
+        if movie.file_properties.file_path in self.movies:
+            logging.debug('Movie "{}" was already in the database'.format(movie.file_properties.file_path))
+            return True
 
     def add_to_merge_diff_list(self, movie_path):
         """ Add external movies to the diff-list, if they are no duplicates and external """
-        if movie_path not in self.merge_diff_list and movie_path not in self._own_movies.keys():
+        if movie_path not in self._merge_diff_set and movie_path not in self._own_movies:
             self.merge_diff_list.append(movie_path)
+            self._merge_diff_set.add(movie_path)
 
     def print_merge_diff_list(self):
         """ Outputs the diff-list """
@@ -59,47 +101,89 @@ class Database:
 
     def read(self):
         """ Read in/Create the database from file"""
-        if not path.exists(self._path):
+        if not self._storage.exists():
             logging.info("No database found at '{}', recreating!".format(self._path))
             return
 
-        if not access(self._path, W_OK):
+        if path.exists(self._path) and not access(self._path, W_OK):
             logging.error("No write-permissions for database '{}'!".format(self._path))
             return
-        if not access(self._path, R_OK):
+        if path.exists(self._path) and not access(self._path, R_OK):
             logging.error("No read-permissions for database '{}'!".format(self._path))
             return
 
         try:
-            with open(self._path, 'r') as f:
-                _data = f.read()
-
-            if not _data:
+            data = self._storage.read()
+            if data is None:
                 logging.info("Database at '{}' was empty, recreating!".format(self._path))
                 return
 
-            _decoded = json.loads(_data)
-            self.original = _decoded.pop('original', False)
-
-            Movie.settings = self._settings
-            _movies = OrderedDict()
-            for file_path, serialized in _decoded.items():
-                api = self._settings.apis.get(serialized.pop('api', None), None)
-                file_properties = utils.FileProperties(**serialized.pop('file_properties', {}))
-                scene_properties = utils.SceneProperties(**serialized.get('scene_properties',{}))
-
-                m_ = Movie(file_properties, api, scene_properties=scene_properties)
-                _movies[file_path] = m_
-
+            original, serialized_movies, _directories = data
+            _movies = self._deserialize_movies(serialized_movies)
         except Exception as e:
             logging.error("Database '{}' possibly corrupted (Error: '{}'), recreating!".format(self._path, e))
             return
+        self.original = original
         self.movies = _movies
+        self.directories = _directories
+        self._signatures = {m_.file_properties.signature: file_path for file_path, m_ in _movies.items()
+                            if m_.file_properties.signature is not None}
+        self._changed_movies, self._changed_directories = set(), set()
+        self._full_write = False
+
+    def _deserialize_movies(self, serialized_movies):
+        Movie.settings = self._settings
+        _movies = OrderedDict()
+        for file_path, serialized in serialized_movies.items():
+            _movies[file_path] = self.deserialize_movie(serialized)
+        return _movies
+
+    def deserialize_movie(self, serialized):
+        """ Get the movie back from Movie.serialize() """
+        api = self._settings.apis.get(serialized.get('api', None), None)
+        file_properties = utils.FileProperties(**serialized.get('file_properties', {}))
+        scene_properties = utils.SceneProperties(**serialized.get('scene_properties', {}))
+        return Movie(file_properties, api, scene_properties=scene_properties)
 
     def write(self):
-        """ Write the database to file """
-        dict_to_write = {k_: m_.serialize() for k_, m_ in self.movies.items()}
-        dict_to_write['original'] = self.original
-        _encoded = json.dumps(dict_to_write)
-        with open(self._path, 'w') as f:
-            f.write(_encoded)
+        """ Write the database to file, only the changes if the storage supports that.
+
+        Cheap enough with journaled or incremental storages to be used as a checkpoint after every movie.
+        """
+        if self._storage.incremental and not self._full_write:
+            if not self._changed_movies and not self._changed_directories:
+                return
+            movies = {k_: self.movies[k_].serialize() if k_ in self.movies else None for k_ in self._changed_movies}
+            directories = {k_: self.directories.get(k_) for k_ in self._changed_directories}
+            self._storage.write(self.original, movies, directories, full=False)
+        else:
+            movies = {k_: m_.serialize() for k_, m_ in self.movies.items()}
+            self._storage.write(self.original, movies, self.directories, full=True)
+        self._changed_movies, self._changed_directories = set(), set()
+        self._full_write = False
+        if self._storage.wants_compaction():
+            self.compact()
+
+    def compact(self):
+        """ Write the database and fold the journal of the storage into it, e.g. on a clean exit """
+        self._full_write = self._full_write or self._storage.journaled
+        self.write()
+        self._storage.compact()
+
+    def migrate(self, storage_name):
+        """ Convert the database from another storage into the one of this database """
+        source_storage = self.STORAGES[storage_name](self._database_dir)
+        if not source_storage.exists():
+            logging.error("No database found at '{}' to migrate!".format(source_storage.path))
+            return
+        logging.info("Migrating database '{}' to '{}'...".format(source_storage.path, self._path))
+        self._storage, storage = source_storage, self._storage
+        self.read()
+        self._storage = storage
+        self._full_write = True
+        self.write()
+        source_storage.close()
+
+    def close(self):
+        """ Release the storage of the database """
+        self._storage.close()
@@ -0,0 +1,118 @@
+import concurrent.futures
+import hashlib
+import logging
+import os
+
+import media
+
+# Reads of the full hash, big enough for few syscalls, small enough for many parallel workers
+FULL_HASH_CHUNK_SIZE = 1 << 20
+
+
+def find_duplicates(files, of=None, executor=None):
+    """ Find the files with the same content, returns ([(size, [paths])], {path: fingerprint computed}).
+
+    files is {path: (size, fingerprint)}, either None if not known. The files are bucketed by size first, which
+    rules out almost all of them without reading. Only in buckets with more than one file, the fingerprints (hashes
+    of start, middle and end) are compared, and only equal fingerprints are confirmed by hashing the whole files.
+    Paths of the same file (hardlinks, symlinks) are no duplicates of each other. If of is given, only the groups
+    with one of these and any other file are found. Hashing runs in the executor, a process pool if not given.
+    """
+    of = set(of) if of is not None else None
+    buckets = {}
+    for path, (size, _) in files.items():
+        if size is None:
+            size = _get_size(path)
+        if size is not None:
+            buckets.setdefault(size, []).append(path)
+    buckets = _filter_groups(buckets, of)
+    buckets = _filter_groups({key: _unique_files(paths) for key, paths in buckets.items()}, of)
+    if not buckets:
+        return [], {}
+
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor()
+    try:
+        unknown = [path for paths in buckets.values() for path in paths if files[path][1] is None]
+        fingerprints = {path: files[path][1] for paths in buckets.values() for path in paths}
+        computed = dict(zip(unknown, executor.map(media.fingerprint, unknown, chunksize=16)))
+        fingerprints.update(computed)
+
+        groups = {}
+        for size, paths in buckets.items():
+            for path in paths:
+                if fingerprints[path] is not None:
+                    groups.setdefault((size, fingerprints[path]), []).append(path)
+        groups = _filter_groups(groups, of)
+
+        # The fingerprint of a small file is a hash of its whole content already
+        to_hash = [path for (size, _), paths in groups.items() if size > 3 * media.FINGERPRINT_CHUNK_SIZE
+                   for path in paths]
+        full_hashes = dict(zip(to_hash, executor.map(full_hash, to_hash)))
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    confirmed = {}
+    for (size, fingerprint), paths in groups.items():
+        for path in paths:
+            if path in full_hashes and full_hashes[path] is None:
+                continue
+            confirmed.setdefault((size, fingerprint, full_hashes.get(path)), []).append(path)
+    confirmed = _filter_groups(confirmed, of)
+
+    # Most reclaimable first
+    duplicates = sorted(((key[0], paths) for key, paths in confirmed.items()),
+                        key=lambda g_: -g_[0] * (len(g_[1]) - 1))
+    return duplicates, {path: fingerprint for path, fingerprint in computed.items() if fingerprint is not None}
+
+
+def reclaimable_bytes(duplicates):
+    """ The bytes freed by keeping only one file of each group of duplicates """
+    return sum(size * (len(paths) - 1) for size, paths in duplicates)
+
+
+def full_hash(file_path, chunk_size=FULL_HASH_CHUNK_SIZE):
+    """ Hash the whole content of the file, streamed through a reused buffer. None if the file is not readable """
+    hash_ = hashlib.blake2b(digest_size=16)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    try:
+        with open(file_path, 'rb', buffering=0) as f:
+            while True:
+                count = f.readinto(buffer)
+                if not count:
+                    break
+                hash_.update(view[:count])
+    except OSError as e:
+        logging.debug('Could not read file "{}": {}'.format(file_path, e))
+        return None
+    return hash_.hexdigest()
+
+
+def _filter_groups(groups, of):
+    """ Keep the groups of more than one file, and with one of and one other than of, if given """
+    return {key: paths for key, paths in groups.items()
+            if len(paths) > 1 and (of is None or any(p_ in of for p_ in paths) and not all(p_ in of for p_ in paths))}
+
+
+def _unique_files(paths):
+    """ The paths without further ones of the same file """
+    seen, unique = set(), []
+    for path in paths:
+        try:
+            stat_ = os.stat(path)
+        except OSError:
+            continue
+        if (stat_.st_dev, stat_.st_ino) not in seen:
+            seen.add((stat_.st_dev, stat_.st_ino))
+            unique.append(path)
+    return unique
+
+
+def _get_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
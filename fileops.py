@@ -0,0 +1,128 @@
+import errno
+import logging
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl(2) to share the extents of a file (reflink) on btrfs, XFS and others, from linux/fs.h
+FICLONE = 0x40049409
+CHUNK_SIZE = 8 << 20
+# Errors of copy_file_range and sendfile meaning "not between these files", not "the copy failed"
+_UNSUPPORTED_ERRNOS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+
+def move_file(source, target, progress=None):
+    """ Move the file, a rename on the same filesystem, else a copy to the target and a removal of the source """
+    try:
+        os.rename(source, target)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    copy_file(source, target, progress=progress, metadata=True)
+    os.remove(source)
+
+
+def copy_file(source, target, progress=None, metadata=False):
+    """ Copy the file with the fastest way the filesystems allow, calls progress(bytes) as it goes.
+
+    A reflink shares the content instantly, copy_file_range copies in the kernel (or on the server of a network
+    share), sendfile at least without copying through Python. The copy only appears at the target when complete,
+    so an interrupted copy is never mistaken for a copied movie.
+    """
+    temp_path = '{}.{}.part'.format(target, os.getpid())
+    try:
+        source_fd = os.open(source, os.O_RDONLY)
+        try:
+            target_fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                size = os.fstat(source_fd).st_size
+                if _reflink(source_fd, target_fd):
+                    if progress is not None:
+                        progress(size)
+                else:
+                    _copy_content(source_fd, target_fd, size, progress)
+            finally:
+                os.close(target_fd)
+        finally:
+            os.close(source_fd)
+        (shutil.copystat if metadata else shutil.copymode)(source, temp_path)
+        os.replace(temp_path, target)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def link_file(source, target, hard=False):
+    """ Link the file, with a hardlink if wanted and possible (same filesystem), else with a symlink """
+    if hard:
+        try:
+            os.link(source, target)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            logging.debug('Cannot hardlink "{}" ({}), symlinking it'.format(source, e.strerror))
+    os.symlink(source, target)
+
+
+def _reflink(source_fd, target_fd):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(target_fd, FICLONE, source_fd)
+        return True
+    except OSError:
+        return False
+
+
+def _copy_content(source_fd, target_fd, size, progress=None):
+    """ Copy with the first of copy_file_range, sendfile and read/write working between the files """
+    methods = []
+    if hasattr(os, 'copy_file_range'):
+        methods.append(_copy_chunk_range)
+    if hasattr(os, 'sendfile'):
+        methods.append(_copy_chunk_sendfile)
+    methods.append(_copy_chunk_read)
+    copied = 0
+    while copied < size:
+        try:
+            count = methods[0](source_fd, target_fd, copied, min(CHUNK_SIZE, size - copied))
+        except OSError as e:
+            if len(methods) == 1 or e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            methods.pop(0)
+            continue
+        if not count:
+            # copy_file_range and sendfile copy nothing on some filesystems, instead of failing
+            if len(methods) == 1:
+                raise OSError(errno.EIO, 'Copied only {} of {} bytes'.format(copied, size))
+            methods.pop(0)
+            continue
+        copied += count
+        if progress is not None:
+            progress(count)
+
+
+def _copy_chunk_range(source_fd, target_fd, offset, count):
+    return os.copy_file_range(source_fd, target_fd, count, offset, offset)
+
+
+def _copy_chunk_sendfile(source_fd, target_fd, offset, count):
+    # sendfile writes at the position of the target, the other ways at explicit offsets
+    os.lseek(target_fd, offset, os.SEEK_SET)
+    return os.sendfile(target_fd, source_fd, offset, count)
+
+
+def _copy_chunk_read(source_fd, target_fd, offset, count):
+    data = os.pread(source_fd, count, offset)
+    written = 0
+    while written < len(data):
+        written += os.pwrite(target_fd, data[written:], offset + written)
+    return len(data)
+
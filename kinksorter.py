@@ -1,34 +1,55 @@
 #!/usr/bin/env python3
 
+import collections
+import concurrent.futures
+import errno
+import functools
+import itertools
+import json
 import logging
 import os
 import re
-import shutil
-import subprocess
+import time
 import tqdm
 
+from apis.kink_api import init_recognition_worker, get_worker_api
 from database import Database
+import dedupe
+import fileops
+import media
 from movie import Movie
 import utils
+import watcher
+
+
+def _recognize_shootids_in_worker(api_name, file_path, media_info):
+    return Movie.recognize_shootids(get_worker_api(api_name), file_path, media_info)
 
 
 class KinkSorter:
     SORTED_STORAGE_SUFFIX = '_kinksorted'
     LINKED_SORTED_STORAGE_SUFFIX = '_kinksorted_linked'
     UNSORTED_DIRECTORY_NAME = '#kinksorter_unsorted'
+    # Threads doing the filesystem-calls of sorting
+    PLACEMENT_WORKERS = 16
 
     def __init__(self, storage_root_path, settings_):
         self.storage_root_path = storage_root_path
         self._current_site_api = None
+        self._vanished_paths = set()
+        self._watched_site_apis = {}  # site-directory name:API, for the files reported by the watcher
         self.settings = settings_
         Movie.settings = settings_
 
         self.database = Database(self.storage_root_path, self.settings)
         self.database.read()
+        # The placements of this run are journaled in the manifest, to revert them, or only e.g. a site of them
+        self.run_id = time.strftime('%Y%m%d-%H%M%S')
+        self.manifest = utils.Manifest(self.storage_root_path)
 
     def update_database(self, merge_addresses):
         old_db_len_ = len(self.database.movies)
-        self._scan_directory(self.storage_root_path, self.settings.RECURSION_DEPTH)
+        self.scan_address(self.storage_root_path)
         new_own_movies_len_ = len(self.database.movies) - old_db_len_
         self._remove_deleted()
         self.database._own_movies = self.database.movies.copy()
@@ -36,6 +57,8 @@ class KinkSorter:
 
         for merge_address in merge_addresses:
             self.scan_address(merge_address)
+        if merge_addresses:
+            self._remove_owned_duplicates()
 
         new_db_len_ = len(self.database.movies)
         new_external_movies_len_ = new_db_len_ - new_own_movies_len_ - old_db_len_
@@ -47,51 +70,232 @@ class KinkSorter:
         if untagged_movies > 50:
             logging.info('Many new movies found, downloading the whole API first')
             self.settings.apis_use_cache()
+        else:
+            # Still use the API-dump of an earlier run, if there is one
+            self.settings.apis_use_cache(download=False)
 
         try:
             self.update_all_movies()
         except (KeyboardInterrupt, EOFError):
             logging.info('Saving Database and exiting...')
-            self.database.write()
+            self.database.compact()
+            self.settings.save_caches()
             import sys
             sys.exit(0)
         except Exception as e:
             raise e
 
-        self.database.write()
+        self.database.compact()
+        self.settings.save_caches()
 
     def update_all_movies(self):
         log = logging.getLogger(__name__)
         log.addHandler(utils.TqdmLoggingHandler())
-        for i, movie in enumerate(tqdm.tqdm(self.database.movies.values())):
-            logging.debug(' ------------------------ '.format(movie.file_properties.base_name))
-            logging.debug('"{}" - Working movie...'.format(movie.file_properties.print_base_name()))
-            if not i % 10:
+        movies = list(self.database.movies.values())
+        with tqdm.tqdm(total=len(movies)) as progress:
+            for movie in self._tag_movies(movies):
+                progress.update()
+                # Only writes the changes, so checkpoint every movie
                 self.database.write()
 
+    def _tag_movies(self, movies):
+        """ Tag all movies, yields each movie when it is finished. Tagged movies are written with the next write """
+        if self.settings.jobs > 1:
+            yield from self._tag_movies_parallel(movies)
+            return
+
+        for movie in movies:
+            logging.debug(' ------------------------ ')
+            logging.debug('"{}" - Working movie...'.format(movie.file_properties.print_base_name()))
             if movie:
                 logging.debug('Movie already completely tagged, skip.')
-                continue
+            else:
+                logging.info('"{}" - Tagging movie...'.format(movie.file_properties.print_base_name()))
+                movie.update_details()
+                self.database.update_movie(movie)
+            yield movie
+
+    def _tag_movies_parallel(self, movies):
+        """ Tag all movies with a pool of workers, yields each movie when it is finished.
+
+        Image recognition is CPU-bound and runs in processes, the inspection of the files (fingerprint and probe)
+        and the API-lookups in threads. Movies whose content was recognized before skip the recognition.
+        Everything touching the movies, the database or the user (interactive prompts) stays in this thread.
+        """
+        jobs = self.settings.jobs
+        # The APIs go to every worker once, not with every movie
+        apis = [api for api in set(self.settings.apis.values()) if api is not None]
+        processes = concurrent.futures.ProcessPoolExecutor(jobs, initializer=init_recognition_worker, initargs=apis)
+        threads = concurrent.futures.ThreadPoolExecutor(jobs)
+        pending = {}  # future:(movie, stage, sure)
+        movies = iter(movies)
+        try:
+            exhausted = False
+            while not exhausted or pending:
+                # Keep the workers busy, but do not queue up the whole database
+                while not exhausted and len(pending) < 2 * jobs:
+                    movie = next(movies, None)
+                    if movie is None:
+                        exhausted = True
+                    elif movie:
+                        logging.debug('"{}" - Movie already completely tagged, skip.'.format(
+                            movie.file_properties.print_base_name()))
+                        yield movie
+                    elif movie.api is None:
+                        logging.info('"{}" - No API, skipped.'.format(movie.file_properties.print_base_name()))
+                        yield movie
+                    else:
+                        logging.info('"{}" - Tagging movie...'.format(movie.file_properties.print_base_name()))
+                        if not self._submit_tagging(pending, movie, processes, threads):
+                            movie.apply_results([])
+                            self.database.update_movie(movie)
+                            yield movie
+
+                if not pending:
+                    continue
+
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    movie, stage, sure = pending.pop(future)
+                    if stage == 'query':
+                        results = future.result()
+                    else:
+                        if stage == 'inspection':
+                            movie.file_properties.fingerprint, movie.file_properties.media_info = future.result()
+                            submitted = self._submit_tagging(pending, movie, processes, threads, inspected=True)
+                        else:
+                            submitted = self._submit_tagging(pending, movie, processes, threads,
+                                                             recognized_shootids=future.result())
+                        if submitted:
+                            continue
+                        results = []
+
+                    movie.apply_results(results, sure=sure)
+                    self.database.update_movie(movie)
+                    yield movie
+        finally:
+            processes.shutdown(wait=False, cancel_futures=True)
+            threads.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _submit_tagging(pending, movie, processes, threads, inspected=False, recognized_shootids=None):
+        """ Submit the next stage of tagging the movie to the workers, False if none is left as no shootid was found """
+        file_properties = movie.file_properties
+        file_path = file_properties.file_path
+        if recognized_shootids is None:
+            if not inspected and (file_properties.fingerprint is None or file_properties.media_info is None):
+                future = threads.submit(KinkSorter._inspect_file, file_properties)
+                pending[future] = (movie, 'inspection', False)
+                return True
+            if movie.get_cached_recognition() is None:
+                future = processes.submit(_recognize_shootids_in_worker, movie.api.name, file_path,
+                                          file_properties.media_info)
+                pending[future] = (movie, 'recognition', False)
+                return True
+
+        shootid, sure = movie.get_shootid(file_path, recognized_shootids)
+        if not shootid:
+            return False
+        pending[threads.submit(movie.api.query, 'shoots', 'shootid', shootid)] = (movie, 'query', sure)
+        return True
+
+    @staticmethod
+    def _inspect_file(file_properties):
+        """ Fingerprint and probe the file, as far as not done before. Does not touch the movie, for worker threads """
+        fingerprint = file_properties.fingerprint or media.fingerprint(file_properties.file_path)
+        media_info = file_properties.media_info or media.probe(file_properties.file_path)
+        return fingerprint, media_info
 
-            logging.info('"{}" - Tagging movie...'.format(movie.file_properties.print_base_name()))
-            movie.update_details()
+    def report_duplicates(self, report_path=None):
+        """ Find the movies with the same content, whatever they are tagged as, and log how much they waste.
+
+        Only reports, nothing is removed. With a report-path, each group of duplicates is saved there as a line of
+        {'size', 'reclaimable', 'paths'}, the most reclaimable first.
+        """
+        movies = [m_ for m_ in self.database.movies.values() if self._is_local(m_.file_properties.file_path)]
+        logging.info('Searching duplicates in {} movies...'.format(len(movies)))
+        duplicates, fingerprints = dedupe.find_duplicates(self._get_dedupe_files(movies))
+        self._store_fingerprints(fingerprints)
+
+        for size, paths in duplicates:
+            logging.info('{} movies of {} bytes are the same:\n\t{}'.format(len(paths), size, '\n\t'.join(paths)))
+        logging.info('{} groups of duplicates found, {} bytes reclaimable'.format(
+            len(duplicates), dedupe.reclaimable_bytes(duplicates)))
+
+        if report_path is not None:
+            temp_path = report_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                for size, paths in duplicates:
+                    f.write(json.dumps({'size': size, 'reclaimable': size * (len(paths) - 1), 'paths': paths}) + '\n')
+            os.replace(temp_path, report_path)
+        return duplicates
+
+    def _remove_owned_duplicates(self):
+        """ Remove the merged movies from the database which we own already, if differently named or tagged """
+        own_paths = self.database._own_movies
+        movies = [m_ for path_, m_ in self.database.movies.items() if self._is_local(path_)]
+        merged_paths = [m_.file_properties.file_path for m_ in movies if m_.file_properties.file_path not in own_paths]
+        if not merged_paths:
+            return
+        duplicates, fingerprints = dedupe.find_duplicates(self._get_dedupe_files(movies), of=merged_paths)
+        self._store_fingerprints(fingerprints)
+
+        removed = 0
+        for size, paths in duplicates:
+            owned = [p_ for p_ in paths if p_ in own_paths]
+            for path_ in paths:
+                if path_ not in own_paths:
+                    logging.debug('"{}" is already owned as "{}", skipping it'.format(path_, owned[0]))
+                    self.database.del_movie(path_)
+                    removed += 1
+        if removed:
+            logging.info('{} movies of the other archives are already owned, skipping them'.format(removed))
+
+    @staticmethod
+    def _get_dedupe_files(movies):
+        """ {path: (size, fingerprint)} of the movies, as far as known from the scan and earlier inspections """
+        files = {}
+        for movie in movies:
+            file_properties = movie.file_properties
+            size = file_properties.signature[1] if file_properties.signature is not None else None
+            files[file_properties.file_path] = (size, file_properties.fingerprint)
+        return files
+
+    def _store_fingerprints(self, fingerprints):
+        """ Keep the fingerprints computed by the search of duplicates, for the recognition and the next search """
+        for path_, fingerprint in fingerprints.items():
+            movie = self.database.movies.get(path_)
+            if movie is not None and movie.file_properties.fingerprint is None:
+                movie.file_properties.fingerprint = fingerprint
+                self.database.update_movie(movie)
+
+    @staticmethod
+    def _is_local(path_):
+        return not re.match(r'(ftp|http)s?://', path_)
 
     def _remove_deleted(self):
         if self.database.original:
             # Do not clean the original database, as that needs to be able to be reverted
             return
 
-        movies_to_delete = [file_path for file_path in self.database.movies.keys() if not path.exists(file_path)]
-        map(lambda f: self.database.del_movie(f), movies_to_delete)
+        # Only changed directories are rescanned, so the scan already knows all files which are gone
+        for file_path in self._vanished_paths:
+            self.database.del_movie(file_path)
+        self._vanished_paths.clear()
 
     def scan_address(self, address):
         """ Add all movies at the address to the database """
+        for _ in self.iter_address(address):
+            pass
+
+    def iter_address(self, address):
+        """ Add all movies at the address to the database, yields every movie there (new or known) when scanned """
         if re.match(r'ftps?://', address):
             pass
         elif re.match(r'https?://', address):
             pass
         else:
-            self._scan_directory(address.replace('file://', ''), self.settings.RECURSION_DEPTH)
+            yield from self._scan_directory(address.replace('file://', ''), self.settings.RECURSION_DEPTH)
 
     def _scan_directory(self, dir_, recursion_depth=0, root_path=None):
         # TODO: make dictionary tree structure, to have every directory with an API.
@@ -99,64 +303,468 @@ class KinkSorter:
         if root_path is None:
             root_path = dir_
         recursion_depth -= 1
+        try:
+            mtime = os.stat(dir_).st_mtime_ns
+        except OSError as e:
+            logging.warning('Could not scan directory "{}": {}'.format(dir_, e))
+            return
+
+        cached = self.database.directories.get(dir_)
+        if cached is not None and cached['mtime'] == mtime:
+            # No entry was added, (re)moved or renamed here, so only the subdirectories can have changes
+            directory_names = cached['directories']
+            for name in cached['files']:
+                movie = self.database.movies.get(os.path.join(dir_, name))
+                if movie is not None:
+                    yield movie
+        else:
+            directory_names = yield from self._scan_directory_entries(dir_, mtime, root_path, cached)
+
+        for name in directory_names:
+            full_path = os.path.join(dir_, name)
+            if recursion_depth == self.settings.RECURSION_DEPTH - 1 or \
+               os.path.dirname(full_path) == self.UNSORTED_DIRECTORY_NAME:
+                self._current_site_api = utils.get_correct_api(self.settings.apis, name)
+                name_ = self._current_site_api.name if self._current_site_api else '<None>'
+                logging.info('Scanning site-directory (API: {}) {}...'.format(name_, full_path))
+
+            if recursion_depth > 0:
+                yield from self._scan_directory(full_path, recursion_depth, root_path=root_path)
+
+    def _scan_directory_entries(self, dir_, mtime, root_path, cached):
+        """ Scan the files of a new or changed directory and remember its entries, yields its movies.
+
+        Returns the names of its subdirectories.
+        """
+        file_names, directory_names = [], []
         for entry in os.scandir(dir_):
-            full_path = os.path.join(self.storage_root_path, dir_, entry.path)
             if entry.is_file() or entry.is_symlink():
-                logging.debug('\tScanning file {}...'.format(entry.path[:100]))
-                if os.access(full_path, os.R_OK):
-                    if self._is_video_file(full_path):
-                        logging.debug('\tAdding movie {}...'.format(entry.path[:100]))
-                        file_properties = utils.FileProperties(full_path, root_path)
-                        m_ = Movie(file_properties, api=self._current_site_api)
-                        self.database.add_movie(m_)
+                file_names.append(entry.name)
+                movie = self._scan_file(entry.path, root_path)
+                if movie is not None:
+                    yield movie
             if entry.is_dir():
-                if recursion_depth == self.settings.RECURSION_DEPTH - 1 or \
-                   os.path.dirname(full_path) == self.UNSORTED_DIRECTORY_NAME:
-                    self._current_site_api = utils.get_correct_api(self.settings.apis, entry.name)
-                    name_ = self._current_site_api.name if self._current_site_api else '<None>'
-                    logging.info('Scanning site-directory (API: {}) {}...'.format(name_, entry.path))
+                directory_names.append(entry.name)
+
+        if cached is not None:
+            self._vanished_paths.update(os.path.join(dir_, name) for name in
+                                        set(cached['files']).difference(file_names))
+            for name in set(cached['directories']).difference(directory_names):
+                self._forget_directory(os.path.join(dir_, name))
 
-                if recursion_depth > 0:
-                    self._scan_directory(full_path, recursion_depth, root_path=root_path)
+        self.database.set_directory(dir_, {'mtime': mtime, 'files': file_names, 'directories': directory_names})
+        return directory_names
+
+    def _forget_directory(self, dir_):
+        """ Drop a vanished directory from the directory cache, and mark all its files as vanished """
+        cached = self.database.del_directory(dir_)
+        if cached is None:
+            return
+        self._vanished_paths.update(os.path.join(dir_, name) for name in cached['files'])
+        for name in cached['directories']:
+            self._forget_directory(os.path.join(dir_, name))
+
+    def _scan_file(self, file_path, root_path):
+        """ Add the file to the database if it is a new movie, returns its movie """
+        logging.debug('\tScanning file {}...'.format(file_path[:100]))
+        try:
+            stat_ = os.stat(file_path)
+            signature = (stat_.st_ino, stat_.st_size, stat_.st_mtime_ns)
+        except OSError:
+            signature = None
+
+        known_movie = self.database.movies.get(file_path)
+        if known_movie is not None:
+            if known_movie.file_properties.signature != signature:
+                self.database.set_signature(known_movie, signature)
+            return known_movie
+
+        if not os.access(file_path, os.R_OK) or not self._is_video_file(file_path):
+            return
+
+        file_properties = utils.FileProperties(file_path, root_path, signature=signature)
+        moved_movie = self.database.get_movie_by_signature(signature) if signature is not None else None
+        if moved_movie is not None and not os.path.exists(moved_movie.file_properties.file_path):
+            logging.debug('\tAdding moved movie {}...'.format(file_path[:100]))
+            file_properties.fingerprint = moved_movie.file_properties.fingerprint
+            file_properties.media_info = moved_movie.file_properties.media_info
+            api = self._current_site_api if self._current_site_api is not None else moved_movie.api
+            m_ = Movie(file_properties, api=api, scene_properties=moved_movie.scene_properties.serialize())
+        else:
+            logging.debug('\tAdding movie {}...'.format(file_path[:100]))
+            m_ = Movie(file_properties, api=self._current_site_api)
+        self.database.add_movie(m_)
+        return m_
 
     @staticmethod
     def _is_video_file(full_path):
-        mime_type = subprocess.check_output(['file', '-b', '--mime-type', full_path])
-        if mime_type:
-            mime_type = mime_type.decode('utf-8')
-            if mime_type.startswith('video/') or mime_type.startswith('application/vnd.rn-realmedia'):
-                return True
-        return False
+        return media.is_video_file(full_path)
 
     def sort(self):
-        logging.info('Sorting storage {}...'.format(self.storage_root_path))
+        logging.info('Sorting storage {} (run {})...'.format(self.storage_root_path, self.run_id))
 
         new_storage_path = self._build_new_storage_path()
+        new_storage_database = self._get_new_storage_database(new_storage_path)
+
+        # The filesystem-calls are mostly waiting (e.g. for the round trips to a network share), so many threads
+        with concurrent.futures.ThreadPoolExecutor(self.PLACEMENT_WORKERS) as executor:
+            placements = self._plan_placements(list(self.database.movies.values()), new_storage_path, executor)
+            self._apply_placements(placements, new_storage_database, executor)
+        self.manifest.close()
 
+        self._close_new_storage_database(new_storage_database)
+        del new_storage_database
+
+        self.database.print_merge_diff_list()
+
+    def plan(self, plan_path):
+        """ Save how sort() would sort the storage to the plan-file, to be reviewed and applied later """
+        new_storage_path = self._build_new_storage_path(create=False)
+        with concurrent.futures.ThreadPoolExecutor(self.PLACEMENT_WORKERS) as executor:
+            placements = self._plan_placements(list(self.database.movies.values()), new_storage_path, executor)
+
+        header = {'storage_root_path': self.storage_root_path, 'new_storage_path': new_storage_path,
+                  'simulation': self.settings.simulation}
+        temp_path = plan_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            # One placement per line, to be easy to review, edit and diff
+            f.write(json.dumps(header) + '\n')
+            for placement in placements:
+                # Own movies are no files to get, also when applied by a run which did not scan
+                own = placement['source'] in self.database._own_movies
+                f.write(json.dumps(dict(placement, movie=placement['movie'].serialize(), own=own)) + '\n')
+        os.replace(temp_path, plan_path)
+
+        actions = collections.Counter(placement['action'] for placement in placements)
+        logging.info('Planned {} placements ({}) into "{}"'.format(
+            len(placements), ', '.join('{} {}'.format(n_, a_) for a_, n_ in sorted(actions.items())), plan_path))
+
+    def apply_plan(self, plan_path):
+        """ Sort as planned in the plan-file, without scanning or tagging. Can be repeated to resume it """
+        with open(plan_path) as f:
+            header = json.loads(f.readline())
+            placements = [json.loads(line) for line in f if line.strip()]
+        for placement in placements:
+            placement['movie'] = self.database.deserialize_movie(placement['movie'])
+            if placement.get('own', False):
+                self.database._own_movies[placement['source']] = placement['movie']
+        # The plan was made for moving or for linking, independent of how this run was started
+        self.settings.simulation = header['simulation']
+
+        new_storage_path = header['new_storage_path']
+        os.makedirs(new_storage_path, exist_ok=True)
+        new_storage_database = self._get_new_storage_database(new_storage_path)
+        if new_storage_database is not self.database:
+            # Keep what an interrupted earlier apply added
+            new_storage_database.read()
+
+        logging.info('Applying {} placements of "{}" (run {})...'.format(len(placements), plan_path, self.run_id))
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.PLACEMENT_WORKERS) as executor:
+                self._apply_placements(placements, new_storage_database, executor)
+        finally:
+            self.manifest.close()
+            self._close_new_storage_database(new_storage_database)
+
+        self.database.print_merge_diff_list()
+
+    def _get_new_storage_database(self, new_storage_path):
+        """ Get the database of the sorted storage. Sorted in place (-t), it is the one of this storage """
+        if new_storage_path == self.storage_root_path:
+            # Their storages would be one file, and the full write of one would replace the other
+            return self.database
         new_storage_database = Database(new_storage_path, self.settings)
         new_storage_database.original = False
+        return new_storage_database
+
+    def _close_new_storage_database(self, new_storage_database):
+        """ Compact the database of the sorted storage and release it, unless it is the one of this storage """
+        new_storage_database.compact()
+        if new_storage_database is not self.database:
+            new_storage_database.close()
 
-        for old_movie_path, movie in self.database.movies.items():
-            logging.debug('Sorting movie {}...'.format(old_movie_path))
-            if not os.path.exists(old_movie_path):
+    def _sort_movie(self, movie, new_storage_path, new_storage_database):
+        """ Move the movie to its place in the new storage and add it to the database there """
+        logging.debug('Sorting movie {}...'.format(movie.file_properties.file_path))
+        self._apply_placements(self._plan_placements([movie], new_storage_path), new_storage_database)
+
+    def _plan_placements(self, movies, new_storage_path, executor=None):
+        """ Decide where the movies go, returns the placements.
+
+        A placement is {'movie', 'source', 'target', 'action', 'reason', 'replace'} and its action is "link" or
+        "hardlink" (simulation), "move", "copy" (of sources not writable) or "skip-duplicate" (of smaller duplicates).
+        Nothing is written: duplicates are found by the targets in memory, the sizes are the ones of the scan if
+        known, and target-directories are listed at most once. With the executor if given.
+        """
+        map_ = executor.map if executor is not None else map
+        candidates = {}  # target:[(size, writable, movie)]
+        for movie, (size, writable) in zip(movies, map_(self._get_source_state, movies)):
+            if size is None:
                 continue
+            target = self._build_new_movie_path(movie, new_storage_path)
+            if target == movie.file_properties.file_path:
+                # Already sorted, do not mistake it for its own duplicate
+                continue
+            candidates.setdefault(target, []).append((size, writable, movie))
+
+        # Directories of many targets are listed once, single targets (e.g. of a pipeline) are looked up alone
+        targets_by_directory = collections.defaultdict(list)
+        for target in candidates:
+            targets_by_directory[os.path.dirname(target)].append(target)
+        directories = sorted(d_ for d_, targets in targets_by_directory.items() if len(targets) > 1)
+        existing_names = dict(zip(directories, map_(self._list_directory, directories)))
+        single_targets = [targets[0] for targets in targets_by_directory.values() if len(targets) == 1]
+        existing_targets = dict(zip(single_targets, map_(os.path.lexists, single_targets)))
 
-            new_movie_path = self._build_new_movie_path(movie, new_storage_path)
+        placements = []
+        for target, movies_ in candidates.items():
+            if target in existing_targets:
+                exists = existing_targets[target]
+            else:
+                exists = os.path.basename(target) in existing_names[os.path.dirname(target)]
+            # Keep the biggest one, the last of equally big ones
+            winner = max(range(len(movies_)), key=lambda i_: (movies_[i_][0], i_))
+            size, writable, movie = movies_[winner]
+            existing_size = self._get_size(target) if exists else None
+            if existing_size is not None and existing_size > size:
+                winner = None
+                reason = 'a bigger movie is already at the target'
+            else:
+                if self.settings.simulation:
+                    action = 'hardlink' if self.settings.hardlinks else 'link'
+                else:
+                    action = 'move' if writable else 'copy'
+                placements.append({'movie': movie, 'source': movie.file_properties.file_path, 'target': target,
+                                   'action': action, 'reason': 'replaces a smaller movie' if exists else 'new',
+                                   'replace': exists})
+                reason = 'a bigger movie is moved to the target'
+
+            for i_, (_, _, duplicate) in enumerate(movies_):
+                if i_ != winner:
+                    logging.debug('"{}": "{}" is a duplicate of "{}", but is smaller and therefore skipped'.format(
+                        duplicate, duplicate.file_properties.file_path, target))
+                    placements.append({'movie': duplicate, 'source': duplicate.file_properties.file_path,
+                                       'target': target, 'action': 'skip-duplicate', 'reason': reason,
+                                       'replace': False})
+        return placements
+
+    def _apply_placements(self, placements, new_storage_database, executor=None):
+        """ Carry out the placements and add the placed movies to the database of the new storage.
+
+        Carried out placements are recognized, so an interrupted apply can be resumed. Duplicates are only dropped
+        once the movie they duplicate is in place. Directories left empty are removed at the end, not checked after
+        every movie. Every placed movie is journaled in the manifest, to be reverted.
+        """
+        map_ = executor.map if executor is not None else map
+        transfers = [placement for placement in placements if placement['action'] != 'skip-duplicate']
+        for _ in map_(self._make_directory, sorted({os.path.dirname(p_['target']) for p_ in transfers})):
+            pass
 
-            if not self._check_duplicate(movie, new_movie_path, old_movie_path):
-                self._move_movie(old_movie_path, new_movie_path)
-                self._cleanup_old_movie(old_movie_path)
+        placed_targets = set()
+        old_directories = set()
+        # Only copies between filesystems take long enough to show their progress
+        with tqdm.tqdm(unit='B', unit_scale=True, desc='Copied', disable=executor is None, leave=False) as progress:
+            place_movie = functools.partial(self._place_movie, progress=progress.update)
+            for placement, real_path in zip(transfers, map_(place_movie, transfers)):
+                if real_path is None:
+                    continue
+                movie, target = placement['movie'], placement['target']
+                if placement['action'] in ('link', 'hardlink'):
+                    self.database.add_to_merge_diff_list(real_path)
+                self.manifest.append({'run': self.run_id, 'site': movie.scene_properties.site,
+                                      'action': placement['action'], 'source': placement['source'],
+                                      'real_path': real_path, 'target': target,
+                                      'storage': new_storage_database.directory})
+                old_directories.add(os.path.dirname(placement['source']))
+                placed_targets.add(target)
 
-                new_movie_file_properties = utils.FileProperties(new_movie_path, movie.file_properties.storage_root_path)
+                new_movie_file_properties = utils.FileProperties(target, movie.file_properties.storage_root_path)
                 new_movie = Movie(new_movie_file_properties, movie.api, scene_properties=movie.scene_properties)
+                if new_storage_database is self.database:
+                    # Sorted in place, only the path of the movie changed
+                    self.database.del_movie(placement['source'])
                 new_storage_database.add_movie(new_movie)
 
-        new_storage_database.write()
-        del new_storage_database
+        drops = [placement for placement in placements if placement['action'] == 'skip-duplicate' and
+                 (placement['target'] in placed_targets or os.path.exists(placement['target']))]
+        for placement, _ in zip(drops, map_(self._place_movie, drops)):
+            old_directories.add(os.path.dirname(placement['source']))
+
+        self._remove_empty_directories(old_directories)
+
+    def _place_movie(self, placement, progress=None):
+        """ Carry out a placement, if not done before. Only touches the filesystem, for worker threads.
+
+        Returns the real path of the placed movie, None if it was not placed.
+        """
+        source, target, action = placement['source'], placement['target'], placement['action']
+        try:
+            if action == 'skip-duplicate':
+                self._remove_old_movie(source)
+                return None
+            # realpath, to be able to sort linked directories.
+            real_path = os.path.realpath(source)
+            if self._is_placed(action, source, real_path, target):
+                return real_path
+            if placement['replace'] and os.path.lexists(target):
+                os.remove(target)
+            self._transfer_movie(action, source, real_path, target, progress=progress)
+        except OSError as e:
+            logging.warning('Could not sort "{}" to "{}": {}'.format(source, target, e))
+            return None
+
+        # The movie is placed, whether its old file can be removed (e.g. of a read-only archive) or not
+        try:
+            self._remove_old_movie(source)
+        except OSError as e:
+            logging.warning('Sorted "{}" to "{}", but could not remove it there: {}'.format(source, target, e))
+        return real_path
+
+    def _get_source_state(self, movie):
+        """ (size, writable) of the movie, (None, False) if it is gone. Uses the signature of the scan if possible """
+        signature = movie.file_properties.signature
+        if self.settings.simulation and signature is not None:
+            # The original database keeps vanished movies, so still look if the file is there
+            if not os.path.exists(movie.file_properties.file_path):
+                return None, False
+            return signature[1], True
+        size = self._get_size(movie.file_properties.file_path)
+        if size is None or self.settings.simulation:
+            return size, size is not None
+        return size, os.access(os.path.realpath(movie.file_properties.file_path), os.W_OK)
+
+    @staticmethod
+    def _get_size(path):
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return None
+
+    @staticmethod
+    def _list_directory(directory):
+        try:
+            return set(os.listdir(directory))
+        except FileNotFoundError:
+            return set()
+
+    @staticmethod
+    def _make_directory(directory):
+        os.makedirs(directory, exist_ok=True)
+
+    def run_pipeline(self, merge_addresses):
+        """ Scan, tag and sort at once: every movie is sorted right after it is tagged, not after the whole archive.
+
+        The tagging pulls the movies from the scan only as fast as it finishes them, so the scan never runs ahead.
+        Returns False if it was interrupted.
+        """
+        logging.info('Sorting storage {} while scanning and tagging it...'.format(self.storage_root_path))
+        new_storage_path = self._build_new_storage_path()
+        new_storage_database = self._get_new_storage_database(new_storage_path)
+        # Do not wait for the download of the API-dump, but use the one of an earlier run
+        self.settings.apis_use_cache(download=False)
+
+        log = logging.getLogger(__name__)
+        log.addHandler(utils.TqdmLoggingHandler())
+        finished = False
+        try:
+            with tqdm.tqdm(unit=' movies') as progress:
+                for _ in self._tag_and_sort(self._iter_all_addresses(merge_addresses), new_storage_path,
+                                            new_storage_database):
+                    progress.update()
+            self._remove_deleted()
+            finished = True
+        except (KeyboardInterrupt, EOFError):
+            logging.info('Saving Database and exiting...')
+        finally:
+            self.manifest.close()
+            self._close_new_storage_database(new_storage_database)
+            if new_storage_database is not self.database:
+                self.database.compact()
+            self.settings.save_caches()
 
         self.database.print_merge_diff_list()
+        return finished
+
+    def _tag_and_sort(self, movies, new_storage_path, new_storage_database):
+        """ Tag the movies and sort each one as soon as it is tagged, yields each movie when it is sorted """
+        for movie in self._tag_movies(movies):
+            self._sort_movie(movie, new_storage_path, new_storage_database)
+            # Only writes the changes, so checkpoint every movie
+            self.database.write()
+            if new_storage_database is not self.database:
+                new_storage_database.write()
+            yield movie
+
+    def watch(self, merge_addresses):
+        """ Keep sorting new movies in the storage and the (local) merge-addresses, until interrupted.
+
+        Catches up once with a pipeline-run, then only the files created in or moved into the watched directories
+        are tagged and sorted, as soon as they are completely written. There are no further scans, unless the
+        watcher lost events.
+        """
+        if not self.run_pipeline(merge_addresses):
+            return
+
+        directories = [self.storage_root_path] + [address.replace('file://', '') for address in merge_addresses
+                                                  if not re.match(r'(ftp|http)s?://', address)]
+        new_storage_path = self._build_new_storage_path()
+        new_storage_database = self._get_new_storage_database(new_storage_path)
+        if new_storage_database is not self.database:
+            new_storage_database.read()
 
-    def _build_new_storage_path(self):
+        # Sorted in place (-t), the new storage is the watched one, so only the movies just sorted are skipped
+        excluded = [new_storage_path] if new_storage_path not in directories else []
+        watcher_ = watcher.create_watcher(directories, excluded=excluded)
+        logging.info('Watching {} for new movies...'.format(', '.join(directories)))
+        try:
+            while True:
+                file_paths = [path_ for path_ in watcher_.get_completed_files()
+                              if path_ not in new_storage_database.movies]
+                if watcher_.overflowed:
+                    watcher_.overflowed = False
+                    movies = itertools.chain.from_iterable(self.iter_address(d_) for d_ in directories)
+                else:
+                    movies = [m_ for m_ in (self._scan_watched_file(path_, directories) for path_ in file_paths)
+                              if m_ is not None]
+                for movie in self._tag_and_sort(movies, new_storage_path, new_storage_database):
+                    logging.info('"{}" - Sorted as "{}"'.format(movie.file_properties.print_base_name(), movie))
+        except (KeyboardInterrupt, EOFError):
+            logging.info('Saving Database and exiting...')
+        finally:
+            watcher_.close()
+            self.manifest.close()
+            self._close_new_storage_database(new_storage_database)
+            if new_storage_database is not self.database:
+                self.database.compact()
+            self.settings.save_caches()
+
+    def _scan_watched_file(self, file_path, directories):
+        """ Add the new file in one of the watched directories to the database, returns its movie """
+        root_path = next((d_ for d_ in directories if file_path.startswith(os.path.join(d_, ''))), None)
+        if root_path is None:
+            return None
+        # Movies directly in the site-directories get its API, like on a scan
+        site_name = os.path.relpath(file_path, root_path).split(os.sep)[0]
+        if site_name != os.path.basename(file_path):
+            if site_name not in self._watched_site_apis:
+                self._watched_site_apis[site_name] = utils.get_correct_api(self.settings.apis, site_name)
+            self._current_site_api = self._watched_site_apis[site_name]
+        else:
+            self._current_site_api = None
+        movie = self._scan_file(file_path, root_path)
+        if movie is not None and root_path == self.storage_root_path:
+            self.database._own_movies[file_path] = movie
+        return movie
+
+    def _iter_all_addresses(self, merge_addresses):
+        for movie in self.iter_address(self.storage_root_path):
+            self.database._own_movies[movie.file_properties.file_path] = movie
+            yield movie
+
+        for merge_address in merge_addresses:
+            yield from self.iter_address(merge_address)
+
+    def _build_new_storage_path(self, create=True):
         storage_path, old_storage_name = os.path.split(self.storage_root_path)
         if self.settings.simulation and not old_storage_name.endswith(self.LINKED_SORTED_STORAGE_SUFFIX):
             suffix = self.LINKED_SORTED_STORAGE_SUFFIX
@@ -167,58 +775,171 @@ class KinkSorter:
 
         new_storage_path = self.storage_root_path + suffix
 
-        if not os.path.exists(new_storage_path):
+        if create and not os.path.exists(new_storage_path):
             os.mkdir(new_storage_path)
 
         return new_storage_path
 
-    def _check_duplicate(self, movie, new_movie_path, old_movie_path):
-        if os.path.exists(new_movie_path):
-            # Duplicate! Keep the one with bigger file size ;)
-            old_movie_size_ = os.stat(new_movie_path).st_size
-            new_movie_size_ = os.stat(movie.file_properties.file_path).st_size
-            if old_movie_size_ > new_movie_size_:
-                duplicates = [m.file_properties.file_path for m in self.database.get_movies(movie.scene_properties)
-                              if m.file_properties.file_path != old_movie_path]
-                logging.debug('"{}": "{}" is a duplicate of "{}", but is smaller and therefore skipped'.format(
-                    movie, old_movie_path, duplicates))
-
-                self._cleanup_old_movie(old_movie_path)
-                return True
-            else:
-                os.remove(new_movie_path)
-
     def _build_new_movie_path(self, movie, new_storage_path):
         site_ = movie.scene_properties.site
         if not site_:
             site_ = os.path.join(self.UNSORTED_DIRECTORY_NAME, movie.file_properties.subdirectory_path)
         new_site_path = os.path.join(new_storage_path, site_)
-        os.makedirs(new_site_path, exist_ok=True)
         new_movie_path = os.path.join(new_site_path, str(movie))
         return new_movie_path
 
-    def _cleanup_old_movie(self, old_movie_path):
+    def _remove_old_movie(self, old_movie_path):
         if not self.settings.simulation and not re.match(r'https?://|ftps?://', old_movie_path):
             if os.path.exists(old_movie_path):
                 os.remove(old_movie_path)
-            if not os.listdir(os.path.dirname(old_movie_path)):
-                os.removedirs(os.path.dirname(old_movie_path))
 
-    def _move_movie(self, old_movie_path, new_movie_path):
-        # realpath, to be able to sort linked directories.
-        real_path = os.path.realpath(old_movie_path)
+    def _remove_empty_directories(self, directories):
         if self.settings.simulation:
-            if os.path.islink(old_movie_path):
-                os.remove(old_movie_path)
-            os.symlink(real_path, new_movie_path)
-            self.database.add_to_merge_diff_list(real_path)
+            return
+        # Deepest first, as removing them can empty their parents
+        for directory in sorted(directories, key=len, reverse=True):
+            if re.match(r'https?://|ftps?://', directory) or not os.path.isdir(directory):
+                continue
+            if not os.listdir(directory):
+                os.removedirs(directory)
+
+    @staticmethod
+    def _is_placed(action, source, real_path, target):
+        """ Check if the placement was already carried out, e.g. by an interrupted apply """
+        if action == 'link':
+            return os.path.islink(target) and (os.path.realpath(target) == real_path or not os.path.lexists(source))
+        if action == 'hardlink':
+            # Or a symlink, if it could not be hardlinked
+            return os.path.exists(target) and os.path.exists(real_path) and os.path.samefile(target, real_path)
+        if action == 'copy':
+            # The source stays if it could not be removed, the copy is complete once it is at the target
+            return os.path.exists(target) and (not os.path.lexists(source) or
+                                               KinkSorter._get_size(target) == KinkSorter._get_size(real_path))
+        return not os.path.lexists(source) and os.path.exists(target)
+
+    @staticmethod
+    def _transfer_movie(action, source, real_path, target, progress=None):
+        if action in ('link', 'hardlink'):
+            if not os.path.exists(real_path):
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), real_path)
+            if os.path.islink(source):
+                os.remove(source)
+            fileops.link_file(real_path, target, hard=action == 'hardlink')
+        elif action == 'move':
+            fileops.move_file(real_path, target, progress=progress)
         else:
-            if os.access(real_path, os.W_OK):
-                shutil.move(real_path, new_movie_path)
+            fileops.copy_file(real_path, target, progress=progress)
+
+    def revert(self, site=None, run=None):
+        """ Revert the sorted movies, only those of the site and/or the run (or 'last') if given.
+
+        The placements are undone in reverse order of the manifest, in batches without common paths, each batch with
+        parallel renames. Directories left empty are pruned at the end. Storages sorted before the manifest existed
+        are reverted by their database.
+        """
+        entries = self.manifest.read()
+        if not entries:
+            if site is not None or run is not None:
+                logging.error('Cannot revert only a site or run of "{}": no manifest "{}" found!'.format(
+                    self.storage_root_path, self.manifest.path))
+                return
+            return self._revert_by_database()
+
+        if run == 'last':
+            run = entries[-1]['run']
+        selected = [i_ for i_, entry in enumerate(entries) if (site is None or entry['site'] == site)
+                    and (run is None or entry['run'] == run)]
+        logging.info('Reverting {} of {} sorted movies of "{}"...'.format(
+            len(selected), len(entries), self.storage_root_path))
+
+        reverted = set()
+        with concurrent.futures.ThreadPoolExecutor(self.PLACEMENT_WORKERS) as executor:
+            for batch in self._batch_entries([(i_, entries[i_]) for i_ in reversed(selected)]):
+                for (i_, _), done in zip(batch, executor.map(self._revert_entry, (e_ for _, e_ in batch))):
+                    if done:
+                        reverted.add(i_)
+
+        reverted_entries = [entry for i_, entry in enumerate(entries) if i_ in reverted]
+        self._remove_reverted_from_databases(reverted_entries)
+        self._prune_directories(reverted_entries)
+        self.manifest.rewrite([entry for i_, entry in enumerate(entries) if i_ not in reverted])
+
+        logging.info('Finished reversion of {} movies'.format(len(reverted)))
+
+    @staticmethod
+    def _batch_entries(entries):
+        """ Split the (index, entry) of the entries into batches without common paths, which can run in parallel """
+        batch, paths = [], set()
+        for i_, entry in entries:
+            entry_paths = {entry['source'], entry['real_path'], entry['target']}
+            if paths & entry_paths:
+                yield batch
+                batch, paths = [], set()
+            batch.append((i_, entry))
+            paths |= entry_paths
+        if batch:
+            yield batch
+
+    def _revert_entry(self, entry):
+        """ Undo a placement of the manifest, returns if it is reverted. Only touches the filesystem, for threads """
+        action, source, real_path, target = entry['action'], entry['source'], entry['real_path'], entry['target']
+        try:
+            if action in ('link', 'hardlink'):
+                if os.path.lexists(target):
+                    os.remove(target)
+            elif os.path.lexists(target):
+                if os.path.exists(real_path):
+                    if action == 'move':
+                        logging.warning('Cannot revert "{}": "{}" exists'.format(target, real_path))
+                        return False
+                    # A copy, of which the original is still there
+                    os.remove(target)
+                else:
+                    os.makedirs(os.path.dirname(real_path), exist_ok=True)
+                    fileops.move_file(target, real_path)
+            elif not os.path.exists(real_path):
+                logging.warning('Cannot revert "{}": it is gone'.format(target))
+                return False
+
+            # The symlink through which the movie was sorted
+            if source != real_path and not os.path.lexists(source):
+                os.makedirs(os.path.dirname(source), exist_ok=True)
+                os.symlink(real_path, source)
+            return True
+        except OSError as e:
+            logging.warning('Could not revert "{}" to "{}": {}'.format(target, source, e))
+            return False
+
+    def _remove_reverted_from_databases(self, entries):
+        targets_by_storage = collections.defaultdict(list)
+        for entry in entries:
+            targets_by_storage[entry['storage']].append(entry['target'])
+
+        for storage, targets in targets_by_storage.items():
+            if storage == self.storage_root_path:
+                database = self.database
+            elif os.path.isdir(storage):
+                database = Database(storage, self.settings)
+                database.original = False
+                database.read()
             else:
-                shutil.copy(real_path, new_movie_path)
+                continue
+            for target in targets:
+                database.del_movie(target)
+            database.write()
+            if database is not self.database:
+                database.close()
+
+    def _prune_directories(self, entries):
+        """ Remove the sorted directories left empty, up to their storage, deepest first """
+        directories = {os.path.dirname(entry['target']): entry['storage'] for entry in entries}
+        for directory in sorted(directories, key=len, reverse=True):
+            storage = directories[directory]
+            while directory.startswith(storage + os.sep) and os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
 
-    def revert(self):
+    def _revert_by_database(self):
         storage_path, old_storage_name = os.path.split(self.storage_root_path)
         sorted_path = os.path.join(storage_path, old_storage_name + self.SORTED_STORAGE_SUFFIX)
         if not os.path.exists(sorted_path):
@@ -245,7 +966,7 @@ class KinkSorter:
             sorted_movie_path = os.path.join(sorted_site_path, movie_name)
             if os.path.exists(sorted_movie_path):
                 os.makedirs(os.path.dirname(path_), exist_ok=True)
-                shutil.move(sorted_movie_path, path_)
+                fileops.move_file(sorted_movie_path, path_)
 
                 if not os.listdir(sorted_site_path):
                     os.rmdir(sorted_site_path)
@@ -276,14 +997,37 @@ if __name__ == '__main__':
                            help='Merge given storage(s) into the root-storage.')
     argparser.add_argument('-t', '--tested', action="store_true",
                            help="Move movies instead of symlinking/listing them")
+    argparser.add_argument('-l', '--hardlinks', action="store_true",
+                           help="Hardlink the movies instead of symlinking them, where on the same filesystem")
     argparser.add_argument('-i', '--interactive', action="store_true",
                            help="Confirm each action and query fails manually")
     argparser.add_argument('-r', '--revert', action="store_true",
                            help="Revert the sorted movies back to their original state in the database")
+    argparser.add_argument('--revert_site', metavar='SITE',
+                           help="Revert only the sorted movies of this site")
+    argparser.add_argument('--revert_run', metavar='RUN',
+                           help="Revert only the movies sorted by this run (as logged when sorting), or 'last'")
     argparser.add_argument('-s', '--shootid_template_dir', default=path.join(path.dirname(__file__), 'apis/templates'),
                            help="Set the template-directory for finding the Shoot ID")
     argparser.add_argument('-d', '--use_direct', action='store_true',
                            help="Query the sites directly instead of using the API")
+    argparser.add_argument('-j', '--jobs', type=int, default=1,
+                           help="Tag movies with this many parallel workers")
+    argparser.add_argument('--database_backend', choices=Database.STORAGES.keys(), default='json',
+                           help="Store the database as JSON or in SQLite")
+    argparser.add_argument('--migrate_database', choices=Database.STORAGES.keys(),
+                           help="Convert the database from this backend into the one of --database_backend and exit")
+    argparser.add_argument('-p', '--pipeline', action='store_true',
+                           help="Sort every movie right after it is tagged, while the archive is still scanned")
+    argparser.add_argument('-w', '--watch', action='store_true',
+                           help="Keep running and sort new movies as soon as they are completely written")
+    argparser.add_argument('--plan', metavar='PLAN_FILE',
+                           help="Only save how the storage would be sorted to this file, to review it")
+    argparser.add_argument('--apply', metavar='PLAN_FILE',
+                           help="Sort as planned in this file, without scanning or tagging. Resumes an interrupted one")
+    argparser.add_argument('--dedupe', nargs='?', const='', metavar='REPORT_FILE',
+                           help="Only report the movies with the same content and how many bytes they waste, "
+                                "with every group of duplicates in REPORT_FILE if given")
     argparser.add_argument('-v', '--verbose', action='store_true',
                            help="Be more verbose")
 
@@ -298,10 +1042,32 @@ if __name__ == '__main__':
     else:
         logging.basicConfig(format='%(message)s',
                             level=logging.INFO)
+    if args.migrate_database:
+        database = Database(args.storage_root_path, settings)
+        database.migrate(args.migrate_database)
+        database.close()
+        import sys
+        sys.exit(0)
+
     m = KinkSorter(args.storage_root_path, settings)
 
-    if args.revert:
-        m.revert()
+    if args.revert or args.revert_site or args.revert_run:
+        m.revert(site=args.revert_site, run=args.revert_run)
+    elif args.apply:
+        m.apply_plan(args.apply)
+    elif args.watch:
+        m.watch(args.merge_addresses)
+    elif args.pipeline:
+        m.run_pipeline(args.merge_addresses)
+    elif args.dedupe is not None:
+        # The content is compared, no need to tag
+        for address in [args.storage_root_path] + args.merge_addresses:
+            m.scan_address(address)
+        m.report_duplicates(args.dedupe or None)
+        m.database.compact()
     else:
         m.update_database(args.merge_addresses)
-        m.sort()
+        if args.plan:
+            m.plan(args.plan)
+        else:
+            m.sort()
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+
+import cv2
+
+
+# Suffixes which are video containers for sure, no need to look into the file
+VIDEO_EXTENSIONS = {'.3gp', '.asf', '.avi', '.divx', '.f4v', '.flv', '.m2ts', '.m4v', '.mkv', '.mov', '.mp4',
+                    '.mpeg', '.mpg', '.mts', '.ogv', '.rm', '.rmvb', '.ts', '.vob', '.webm', '.wmv'}
+
+SNIFF_SIZE = 4096
+
+# Size of the chunks at the start, middle and end of a file which make up its fingerprint
+FINGERPRINT_CHUNK_SIZE = 2 << 20
+
+# ISO base media brands of audio-only files
+_AUDIO_FTYP_BRANDS = {b'M4A ', b'M4B ', b'M4P ', b'F4A ', b'F4B '}
+
+
+def is_video_file(file_path):
+    """ Check if the file is a video, by its extension or else by the magic bytes at its start """
+    if os.path.splitext(file_path)[1].lower() in VIDEO_EXTENSIONS:
+        return True
+
+    try:
+        with open(file_path, 'rb') as f:
+            header = f.read(SNIFF_SIZE)
+    except OSError as e:
+        logging.debug('Could not read file "{}": {}'.format(file_path, e))
+        return False
+
+    return sniff_video_type(header) is not None
+
+
+def sniff_video_type(header):
+    """ Get the mime-type of a video from the first bytes of the file, None if it is no (known) video """
+    if header[4:8] == b'ftyp':
+        if header[8:12] in _AUDIO_FTYP_BRANDS:
+            return None
+        return 'video/quicktime' if header[8:12] == b'qt  ' else 'video/mp4'
+    if header.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'video/webm' if b'webm' in header[:64] else 'video/x-matroska'
+    if header.startswith(b'RIFF') and header[8:12] == b'AVI ':
+        return 'video/x-msvideo'
+    if header.startswith(b'\x30\x26\xb2\x75\x8e\x66\xcf\x11'):
+        return 'video/x-ms-asf'
+    if header.startswith(b'FLV\x01'):
+        return 'video/x-flv'
+    if header.startswith(b'.RMF'):
+        return 'application/vnd.rn-realmedia'
+    if header.startswith(b'\x00\x00\x01\xba') or header.startswith(b'\x00\x00\x01\xb3'):
+        return 'video/mpeg'
+    if header[4:8] in (b'moov', b'mdat', b'wide', b'free', b'skip'):
+        # Old QuickTime files without a ftyp-atom
+        return 'video/quicktime'
+    if len(header) > 376 and header[0] == header[188] == header[376] == 0x47:
+        return 'video/MP2T'
+    if header.startswith(b'OggS') and b'theora' in header[:128]:
+        return 'video/ogg'
+    return None
+
+
+def fingerprint(file_path, chunk_size=FINGERPRINT_CHUNK_SIZE):
+    """ Identify the content of a file cheaply, by its size and hashes of its start, middle and end.
+
+    Stays the same when the file is moved, renamed or copied, None if the file is not readable.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            hash_ = hashlib.blake2b(digest_size=16)
+            if size <= 3 * chunk_size:
+                hash_.update(f.read())
+            else:
+                for offset in (0, (size - chunk_size) // 2, size - chunk_size):
+                    f.seek(offset)
+                    hash_.update(f.read(chunk_size))
+    except OSError as e:
+        logging.debug('Could not read file "{}": {}'.format(file_path, e))
+        return None
+
+    return '{}-{}'.format(size, hash_.hexdigest())
+
+
+def probe(file_path):
+    """ Inspect a video once, for everything the later stages need to know about it.
+
+    Returns {'mime_type', 'container', 'duration', 'fps', 'frame_count', 'width', 'height', 'tags'} from ffprobe,
+    or from OpenCV if ffprobe is not installed (without container and tags). None if the file is not readable.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            header = f.read(SNIFF_SIZE)
+    except OSError as e:
+        logging.debug('Could not read file "{}": {}'.format(file_path, e))
+        return None
+
+    media_info = {'mime_type': sniff_video_type(header), 'container': None, 'duration': 0.0, 'fps': 0.0,
+                  'frame_count': 0, 'width': 0, 'height': 0, 'tags': {}}
+    if shutil.which('ffprobe'):
+        _probe_ffprobe(file_path, media_info)
+    else:
+        _probe_opencv(file_path, media_info)
+    return media_info
+
+
+def _probe_ffprobe(file_path, media_info):
+    o = subprocess.run(['ffprobe', '-v', 'quiet', '-of', 'json', '-show_format', '-show_streams',
+                        '-select_streams', 'v:0', file_path], stdout=subprocess.PIPE)
+    try:
+        json_output = json.loads(o.stdout.decode())
+    except (ValueError, json.JSONDecodeError):
+        return
+
+    format_ = json_output.get('format', {})
+    stream = (json_output.get('streams') or [{}])[0]
+    media_info['container'] = format_.get('format_name')
+    media_info['tags'] = format_.get('tags', {})
+    media_info['duration'] = _to_float(format_.get('duration', stream.get('duration')))
+    numerator, _, denominator = stream.get('avg_frame_rate', '0/0').partition('/')
+    media_info['fps'] = _to_float(numerator) / _to_float(denominator) if _to_float(denominator) else 0.0
+    media_info['width'] = int(stream.get('width', 0))
+    media_info['height'] = int(stream.get('height', 0))
+    media_info['frame_count'] = int(_to_float(stream.get('nb_frames'))) or \
+        int(media_info['duration'] * media_info['fps'])
+
+
+def _probe_opencv(file_path, media_info):
+    capture = cv2.VideoCapture(file_path)
+    try:
+        media_info['fps'] = max(0.0, capture.get(cv2.CAP_PROP_FPS))
+        media_info['frame_count'] = max(0, int(capture.get(cv2.CAP_PROP_FRAME_COUNT)))
+        media_info['width'] = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        media_info['height'] = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if media_info['fps']:
+            media_info['duration'] = media_info['frame_count'] / media_info['fps']
+    finally:
+        capture.release()
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
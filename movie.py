@@ -1,22 +1,52 @@
+import functools
 import re
 import logging
 import datetime
 import os
 
+import media
 import utils
 
+_UNLIKELY_QUALITIES = frozenset([360, 480, 720, 1080, 1440, 2160])
+_UNLIKELY_YEARS = frozenset(range(1970, 2030))
+# Numbers between non-digits. The following non-digit is only looked at, so it can precede the next number
+_SHOOTID_CANDIDATE_RE = re.compile(r'(\D)(\d{2,6})(?=(\D))')
+
+
+def _is_date(number):
+    """ Filter out 6-digit dates like 091224 or (20)150101 """
+    return number[0] in '01' and '01' <= number[2:4] <= '12' and '01' <= number[4:6] <= '31'
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _get_shootids_from_base_name(base_name):
+    """ The likely shootids in the name, only the one in brackets if there is one """
+    shootids = []
+    # \D does not match ^|$, so we pad it with something irrelevant
+    for pre_, k, post_ in _SHOOTID_CANDIDATE_RE.findall('%' + base_name + '%'):
+        shootid = int(k)
+        if shootid < 200 or shootid in _UNLIKELY_YEARS:
+            continue
+        if len(k) == 6 and _is_date(k):
+            logging.debug('Most likely no shootid ({}), but a date. Skipping...'.format(k))
+            continue
+        if shootid in _UNLIKELY_QUALITIES and (pre_ != '(' or post_ != ')'):
+            logging.debug('Most likely no shootid ({}{}{}), but a quality. Skipping...'.format(pre_, k, post_))
+            continue
+        if pre_ in '([' and post_ in ')]':
+            return shootid,
+
+        shootids.append(shootid)
+    return tuple(shootids)
+
 
 class Movie:
-    UNLIKELY_NUMBERS = {'quality': [360, 480, 720, 1080, 1440, 2160],
-                        'date': list(range(1970, 2030))}
+    UNLIKELY_NUMBERS = {'quality': _UNLIKELY_QUALITIES, 'date': _UNLIKELY_YEARS}
     settings = None
+    # Tens of thousands are loaded with the database, so movies and their properties have no __dict__
+    __slots__ = ('api', 'file_properties', 'scene_properties')
 
     def __init__(self, file_properties, api=None, scene_properties=None):
-        # Filter out dates like 091224 or (20)150101
-        self._unlikely_shootid_date_re = re.compile('([01]\d)({})({})'.format(
-            '|'.join(['{:02}'.format(i) for i in range(1, 13)]),
-            '|'.join(['{:02}'.format(i) for i in range(1, 32)])
-        ))
         self.api = api
 
         if type(file_properties) is dict:
@@ -44,12 +74,13 @@ class Movie:
             logging.info('"{}" - No API, skipped.'.format(self.file_properties.print_base_name()))
             return
 
-        result = None
         shootid, sure = self.get_shootid(self.file_properties.file_path)
-        if shootid:
-            results = self.api.query('shoots', 'shootid', shootid)
-            result = self.interactive_confirm(results, sure=sure)
+        results = self.api.query('shoots', 'shootid', shootid) if shootid else []
+        self.apply_results(results, sure=sure)
 
+    def apply_results(self, results, sure=False):
+        """ Confirm the query results (or query interactively) and tag the movie with the chosen one """
+        result = self.interactive_confirm(results, sure=sure)
         if not result:
             logging.info('"{}" - No result found, going interactive...'.format(self.file_properties.print_base_name()))
             result = self.interactive_query()
@@ -59,16 +90,56 @@ class Movie:
         else:
             logging.info('"{}" - Nothing found, leaving untagged'.format(self.file_properties.print_base_name()))
 
-    def get_shootid(self, file_path):
+    @staticmethod
+    def recognize_shootids(api, file_path, media_info=None):
+        """ Get the shootids through image recognition and metadata of the file.
+
+        Does not touch the movie itself, so it can be run in a worker process.
+        """
+        if media_info is None:
+            media_info = media.probe(file_path)
         try:
-            shootid_cv = self.api.get_shootid_through_image_recognition(file_path)
+            # The shootids of the filename confirm what is read from unknown digits
+            shootid_cv = api.get_shootid_through_image_recognition(
+                file_path, media_info=media_info, confirming_shootids=Movie.get_shootids_from_filenames([file_path])[0])
         except AttributeError:
             shootid_cv = 0
         try:
-            shootid_md = self.api.get_shootid_through_metadata(file_path)
+            shootid_md = api.get_shootid_through_metadata(file_path, media_info=media_info)
         except AttributeError:
             shootid_md = 0
 
+        return shootid_cv, shootid_md
+
+    def get_fingerprint(self):
+        if self.file_properties.fingerprint is None:
+            self.file_properties.fingerprint = media.fingerprint(self.file_properties.file_path)
+        return self.file_properties.fingerprint
+
+    def get_media_info(self):
+        if self.file_properties.media_info is None:
+            self.file_properties.media_info = media.probe(self.file_properties.file_path)
+        return self.file_properties.media_info
+
+    def get_cached_recognition(self):
+        """ Get what was recognized for the content of this movie before, wherever it was """
+        if self.settings is None or self.api is None:
+            return None
+        return self.settings.recognition_cache.get(self.api.name, self.get_fingerprint())
+
+    def get_shootid(self, file_path, recognized_shootids=None):
+        cached = self.get_cached_recognition()
+        if cached is not None and cached['shootid'] > 0 and cached['sure']:
+            logging.debug('Chose shootid {} recognized before'.format(cached['shootid']))
+            return cached['shootid'], True
+
+        if recognized_shootids is None:
+            if cached is not None:
+                recognized_shootids = cached['shootid_cv'], cached['shootid_md']
+            else:
+                recognized_shootids = self.recognize_shootids(self.api, file_path, self.get_media_info())
+        shootid_cv, shootid_md = recognized_shootids
+
         shootid_nr = 0
         shootids_nr = self.get_shootids_from_filename(file_path)
         if len(shootids_nr) > 1:
@@ -102,44 +173,23 @@ class Movie:
 
             shootid = shootid_nr
         logging.debug('Chose shootid {}, sure: {}'.format(shootid, sure))
+        if self.settings is not None and self.api is not None:
+            self.settings.recognition_cache.put(self.api.name, self.get_fingerprint(), shootid_cv, shootid_md,
+                                                shootid=shootid, sure=sure)
         return shootid, sure
 
     def get_shootids_from_filename(self, file_path):
-        base_name = os.path.basename(file_path)
-        search_shootid = []
-
-        # \D does not match ^|$, so we pad it with something irrelevant
-        search_name = '%' + base_name + '%'
-
-        search_match = 1
-        while search_match:
-            search_name = search_name[search_match.end() - 1:] if search_match != 1 else search_name
-
-            # Search with re.search instead of re.findall, as pre/post can be interleaved and regexps capture
-            search_match = re.search(r"(\D)(\d{2,6})(\D)", search_name)
-            if search_match:
-                pre_, k, post_ = search_match.groups()
-                shootid = int(k)
-                if shootid in self.UNLIKELY_NUMBERS['date']:
-                    continue
-                if self._unlikely_shootid_date_re.search(k):
-                    logging.debug('Most likely no shootid ({}), but a date. Skipping...'.format(k))
-                    continue
-                if shootid < 200:
-                    continue
-                if shootid in self.UNLIKELY_NUMBERS['quality'] and (pre_ != '(' or post_ != ')'):
-                    logging.debug('Most likely no shootid ({}{}{}), but a quality. Skipping...'.format(pre_, k, post_))
-                    continue
-                if pre_ in ['(', '['] and post_ in [')', ']']:
-                    return [shootid]
-
-                search_shootid.append(shootid)
-
+        search_shootid = list(_get_shootids_from_base_name(os.path.basename(file_path)))
         if len(search_shootid) > 1:
             logging.info('Multiple Shoot IDs found')
 
         return search_shootid
 
+    @staticmethod
+    def get_shootids_from_filenames(file_paths):
+        """ The shootids of many filenames at once, see get_shootids_from_filename """
+        return [list(_get_shootids_from_base_name(os.path.basename(file_path))) for file_path in file_paths]
+
     def interactive_query(self):
         if not self.settings.interactive:
             return {}
@@ -0,0 +1,42 @@
+from os import path
+
+
+class BaseStorage:
+    name = 'BaseStorage'
+    file_name = ''
+    # Whether write() can be given only the changes since the last write
+    incremental = False
+    # Whether the incremental writes need to be folded into a full write from time to time
+    journaled = False
+
+    def __init__(self, database_dir):
+        self.path = path.join(database_dir, self.file_name)
+
+    def exists(self):
+        """ Check if there is a database to read """
+        return path.exists(self.path)
+
+    @NotImplementedError
+    def read(self):
+        """ Read the database, returns (original, {file_path: serialized movie}, {directory: entries}) or None """
+        return
+
+    @NotImplementedError
+    def write(self, original, movies, directories, full=True):
+        """ Write the serialized movies and directories, where None marks a deleted entry.
+
+        If not full, only the entries changed since the last write are given.
+        """
+        return
+
+    def wants_compaction(self):
+        """ Check if the storage should get a full write soon """
+        return False
+
+    def compact(self):
+        """ Fold everything written so far into the storage, e.g. on a clean exit """
+        return
+
+    def close(self):
+        """ Release everything held open by the storage """
+        return
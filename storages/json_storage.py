@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import time
+
+from storages.base_storage import BaseStorage
+
+
+class JSONStorage(BaseStorage):
+    """ A JSON-snapshot of the database, plus an append-only journal of the changes since the snapshot """
+    name = 'json'
+    file_name = '.kinksorter_db'
+    incremental = True
+    journaled = True
+    # Compact when the journal gets bigger than the snapshot, but not for every small one
+    MIN_COMPACTION_SIZE = 1 << 20
+    # Sync the journal in batches, a crash of the system loses at most the entries of the last seconds
+    SYNC_ENTRIES = 1000
+    SYNC_SECONDS = 5.0
+
+    def __init__(self, database_dir):
+        super().__init__(database_dir)
+        self.journal_path = self.path + '.journal'
+        self._journal = None  # Kept open for appending
+        self._unsynced_entries = 0
+        self._last_sync = time.monotonic()
+        self._snapshot_size = None
+
+    def exists(self):
+        return super().exists() or os.path.exists(self.journal_path)
+
+    def read(self):
+        self._close_journal()
+        snapshot = self._read_snapshot()
+        if snapshot is None and not os.path.exists(self.journal_path):
+            return None
+
+        original, movies, directories = snapshot if snapshot is not None else (False, {}, {})
+        tables = {'movie': movies, 'directory': directories}
+        valid_size = 0
+        with open(self.journal_path, 'rb') if os.path.exists(self.journal_path) else open(os.devnull, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('Entry without its end')
+                    op, key, value = json.loads(line.decode())
+                except ValueError:
+                    # Torn write of a crash, everything before is intact
+                    logging.warning("Journal '{}' ends in an incomplete entry, ignoring it".format(self.journal_path))
+                    break
+                valid_size += len(line)
+                if op == 'original':
+                    original = value
+                elif value is None:
+                    tables[op].pop(key, None)
+                else:
+                    tables[op][key] = value
+
+        if os.path.exists(self.journal_path) and valid_size < os.path.getsize(self.journal_path):
+            # Cut the torn entry, so new entries are not appended to it
+            os.truncate(self.journal_path, valid_size)
+
+        return original, movies, directories
+
+    def _read_snapshot(self):
+        if not os.path.exists(self.path):
+            return None
+
+        with open(self.path, 'r') as f:
+            _data = f.read()
+        self._snapshot_size = len(_data)
+
+        if not _data:
+            return None
+
+        _decoded = json.loads(_data)
+        original = _decoded.pop('original', False)
+        directories = _decoded.pop('directories', {})
+        return original, _decoded, directories
+
+    def write(self, original, movies, directories, full=True):
+        if full:
+            self._write_snapshot(original, movies, directories)
+        else:
+            self._append_journal(original, movies, directories)
+
+    def _write_snapshot(self, original, movies, directories):
+        """ Replace the snapshot atomically, then drop the journal which is contained in it now """
+        dict_to_write = {k_: m_ for k_, m_ in movies.items() if m_ is not None}
+        dict_to_write['original'] = original
+        dict_to_write['directories'] = {k_: d_ for k_, d_ in directories.items() if d_ is not None}
+        _encoded = json.dumps(dict_to_write)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(_encoded)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self._snapshot_size = len(_encoded)
+        # Contained in the snapshot, so not worth syncing anymore
+        self._close_journal(sync=False)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def _append_journal(self, original, movies, directories):
+        """ Append all changes as one batch, synced with the next batches once enough of them are unsynced """
+        entries = [('original', None, original)]
+        entries.extend(('movie', k_, m_) for k_, m_ in movies.items())
+        entries.extend(('directory', k_, d_) for k_, d_ in directories.items())
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a')
+        # Flushed right away, so a crash of the process loses nothing
+        self._journal.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+        self._journal.flush()
+        self._unsynced_entries += len(entries)
+        if self._unsynced_entries >= self.SYNC_ENTRIES or time.monotonic() - self._last_sync >= self.SYNC_SECONDS:
+            self._sync_journal()
+
+    def _sync_journal(self):
+        if self._journal is not None and self._unsynced_entries:
+            os.fsync(self._journal.fileno())
+        self._unsynced_entries = 0
+        self._last_sync = time.monotonic()
+
+    def _close_journal(self, sync=True):
+        if self._journal is not None:
+            if sync:
+                self._sync_journal()
+            self._journal.close()
+            self._journal = None
+        self._unsynced_entries = 0
+
+    def wants_compaction(self):
+        # Only the journal appended to since the last snapshot can have grown
+        if self._journal is None:
+            return False
+        if self._snapshot_size is None:
+            self._snapshot_size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return self._journal.tell() > max(self._snapshot_size, self.MIN_COMPACTION_SIZE)
+
+    def compact(self):
+        self._sync_journal()
+
+    def close(self):
+        self._close_journal()
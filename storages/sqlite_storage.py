@@ -0,0 +1,81 @@
+import json
+import logging
+import sqlite3
+from os import path
+
+from storages.base_storage import BaseStorage
+from storages.json_storage import JSONStorage
+
+
+class SQLiteStorage(BaseStorage):
+    name = 'sqlite'
+    file_name = '.kinksorter_db.sqlite'
+    incremental = True
+
+    def __init__(self, database_dir):
+        super().__init__(database_dir)
+        self._database_dir = database_dir
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            with self._connection:
+                self._connection.execute('CREATE TABLE IF NOT EXISTS movies (file_path TEXT PRIMARY KEY, movie TEXT)')
+                self._connection.execute('CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, entries TEXT)')
+                self._connection.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
+        return self._connection
+
+    def exists(self):
+        return super().exists() or JSONStorage(self._database_dir).exists()
+
+    def read(self):
+        if not path.exists(self.path):
+            # Transparently take over an existing JSON-database
+            legacy_storage = JSONStorage(self._database_dir)
+            if not legacy_storage.exists():
+                return None
+            logging.info("Importing JSON-database '{}' into '{}'".format(legacy_storage.path, self.path))
+            data = legacy_storage.read()
+            if data is not None:
+                self.write(*data)
+            return data
+
+        connection = self._connect()
+        original = connection.execute('SELECT value FROM settings WHERE key = ?', ('original',)).fetchone()
+        movies = {file_path: json.loads(movie) for file_path, movie in
+                  connection.execute('SELECT file_path, movie FROM movies')}
+        directories = {path_: json.loads(entries) for path_, entries in
+                       connection.execute('SELECT path, entries FROM directories')}
+        if original is None and not movies:
+            return None
+        return bool(original and json.loads(original[0])), movies, directories
+
+    def write(self, original, movies, directories, full=True):
+        connection = self._connect()
+        with connection:
+            if full:
+                connection.execute('DELETE FROM movies')
+                connection.execute('DELETE FROM directories')
+            connection.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', ('original', json.dumps(original)))
+            self._upsert(connection, 'movies', movies)
+            self._upsert(connection, 'directories', directories)
+
+    @staticmethod
+    def _upsert(connection, table, entries):
+        connection.executemany('INSERT OR REPLACE INTO {} VALUES (?, ?)'.format(table),
+                               ((k_, json.dumps(v_)) for k_, v_ in entries.items() if v_ is not None))
+        deleted = [(k_,) for k_, v_ in entries.items() if v_ is None]
+        if deleted:
+            key = 'file_path' if table == 'movies' else 'path'
+            connection.executemany('DELETE FROM {} WHERE {} = ?'.format(table, key), deleted)
+
+    def compact(self):
+        self._connect().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
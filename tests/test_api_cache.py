@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from datetime import date
+from unittest.mock import MagicMock, patch
+
+from apis.api_cache import APICache, QueryMemo
+from apis.kink_api import KinkAPI
+from hamcrest import *
+
+
+class APICacheShould(unittest.TestCase):
+
+    def setUp(self):
+        shoots = [{'shootid': 7675, 'exists': True, 'site': {'name': 'Device Bondage'}, 'date': 1261008000,
+                   'title': 'Holly Heart - Former collegiate athlete upside down, butt plugged, and made to cum!',
+                   'performers': [{'name': 'Holly Heart'}]},
+                  {'shootid': '1337', 'exists': True, 'site': {'name': 'Test Site'}, 'date': 1167609600,
+                   'title': 'Test - Tested thoroughly', 'performers': [{'name': 'Testy Mc. Test'}]},
+                  {'shootid': 1338, 'exists': True, 'site': {'name': 'Test Site'}, 'date': 1167609600,
+                   'title': None, 'performers': []}]
+        performers = [{'name': 'Holly Heart', 'number': 1}, {'name': 'Testy Mc. Test', 'number': 2}]
+        self.cache = APICache({'shoots': shoots, 'performers': performers}, KinkAPI._api_results_to_properties,
+                              indexes={'shoots': ['shootid', 'date', 'site']},
+                              text_indexes={'shoots': ['title'], 'performers': ['name']})
+
+    def test_equality(self):
+        assert_that([r_['shootid'] for r_ in self.cache.find('shoots', 'shootid', 7675)], contains_exactly(7675))
+        assert_that([r_['shootid'] for r_ in self.cache.find('shoots', 'shootid', 1337)], contains_exactly(1337))
+        assert_that([r_['shootid'] for r_ in self.cache.find('shoots', 'date', '1167609600')],
+                    contains_exactly(1337, 1338))
+        assert_that([r_['shootid'] for r_ in self.cache.find('shoots', 'site', 'Test Site')],
+                    contains_exactly(1337, 1338))
+        assert_that(self.cache.find('shoots', 'shootid', 1), equal_to([]))
+
+    def test_converted(self):
+        properties = self.cache.find('shoots', 'shootid', 7675)[0]
+        assert_that(properties['date'], equal_to(date.fromtimestamp(1261008000)))
+        assert_that(properties['performers'], contains_exactly('Holly Heart'))
+        assert_that(properties['site'], equal_to('Device Bondage'))
+
+    def test_text(self):
+        assert_that([r_['shootid'] for r_ in self.cache.find('shoots', 'title', 'ormer collegiate athlete up')],
+                    contains_exactly(7675))
+        assert_that([r_['shootid'] for r_ in self.cache.find('shoots', 'title', 'Test.*thorough')],
+                    contains_exactly(1337))
+        assert_that(self.cache.find('shoots', 'title', 'collegiate tested'), equal_to([]))
+        # Words shorter than a trigram, and words with trigrams no indexed word has
+        assert_that([r_['shootid'] for r_ in self.cache.find('shoots', 'title', 'up')], contains_exactly(7675))
+        assert_that(self.cache.find('shoots', 'title', 'thoroughness'), equal_to([]))
+        assert_that([r_['number'] for r_ in self.cache.find('performers', 'name', 'Mc. Test')], contains_exactly(2))
+
+    def test_copies(self):
+        self.cache.find('performers', 'name', 'Holly')[0]['name'] = 'changed'
+        assert_that(self.cache.find('performers', 'name', 'Holly'), has_length(1))
+
+
+class QueryMemoShould(unittest.TestCase):
+
+    def setUp(self):
+        self.memo = QueryMemo(max_size=2, ttls={'shoots': 60, 'sites': 0})
+
+    def test_lru(self):
+        self.memo.put('a', 'shoots', [{'shootid': 1, 'exists': True}])
+        self.memo.put('b', 'shoots', [{'shootid': 2, 'exists': True}])
+        self.memo.get('a')
+        self.memo.put('c', 'shoots', [{'shootid': 3, 'exists': True}])
+        assert_that(self.memo.get('a'), has_length(1))
+        assert_that(self.memo.get('b'), equal_to(None))
+        assert_that(self.memo.get_statistics(), starts_with('2 hits, 1 misses'))
+
+    def test_ttl(self):
+        self.memo.put('sites', 'sites', ['Test Site'])
+        assert_that(self.memo.get('sites'), equal_to(None))
+
+        self.memo.NEGATIVE_TTL = -1
+        self.memo.put('missing', 'shoots', [{'shootid': 1, 'exists': False}])
+        self.memo.put('empty', 'shoots', [])
+        assert_that(self.memo.get('missing'), equal_to(None))
+        assert_that(self.memo.get('empty'), equal_to(None))
+
+    def test_persistence(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(temp_dir.name, 'memo')
+        key = ('api', 'shoots', 'shootid', '1')
+        self.memo.put(key, 'shoots', [{'shootid': 1, 'exists': True, 'date': date(2007, 1, 1)}])
+        self.memo.save(path)
+        # Plain JSON, nothing executed when loading it
+        with gzip.open(path, 'rt') as f:
+            assert_that(json.load(f)[0][0], equal_to(list(key)))
+
+        memo_2 = QueryMemo()
+        memo_2.load(path)
+        assert_that(memo_2.get(key)[0]['date'], equal_to(date(2007, 1, 1)))
+        temp_dir.cleanup()
+
+
+class KinkAPIMemoShould(unittest.TestCase):
+
+    def setUp(self):
+        self.api = KinkAPI([])
+
+    def test_not_remember_failures(self):
+        for response in (None, MagicMock(status_code=502, text='<html>Bad Gateway</html>'),
+                         MagicMock(status_code=200, text='<html>Captive portal</html>')):
+            with patch.object(self.api, '_make_request', return_value=response):
+                assert_that(self.api.query_api('shoots', 'shootid', 1234), equal_to([]))
+            assert_that(self.api._memo.get(('api', 'shoots', 'shootid', '1234')), equal_to(None))
+
+    def test_remember_answers(self):
+        response = MagicMock(status_code=200, text='{"errors": false, "results": []}')
+        with patch.object(self.api, '_make_request', return_value=response):
+            self.api.query_api('shoots', 'shootid', 1234)
+        assert_that(self.api._memo.get(('api', 'shoots', 'shootid', '1234')), equal_to([]))
+
+
+class APIDumpShould(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.api = KinkAPI([], cache_dir=self.temp_dir.name)
+        self.shoots = [{'shootid': 1337, 'exists': True, 'site': {'name': 'Test Site'}, 'date': 1167609600,
+                        'title': 'Test', 'performers': [{'name': 'Testy Mc. Test'}]}]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _update_cache(self, response):
+        with patch.object(self.api, '_make_request', return_value=response):
+            self.api._update_cache()
+
+    def _read_persisted_dumps(self):
+        with gzip.open(self.api._get_persisted_cache_path(), 'rt') as f:
+            return json.load(f)['dumps']
+
+    def test_keep_dumps_on_errors(self):
+        self._update_cache(MagicMock(status_code=200, text=json.dumps({'results': self.shoots}), headers={}))
+        assert_that(self._read_persisted_dumps()['shoots'], has_length(1))
+
+        for response in (MagicMock(status_code=502, text='<html>Bad Gateway</html>', headers={}),
+                         MagicMock(status_code=200, text='<html>Maintenance</html>', headers={}), None):
+            self._update_cache(response)
+            assert_that(self._read_persisted_dumps()['shoots'], has_length(1))
+            assert_that(self.api._cache_dumps['shoots'], has_length(1))
+            assert_that(self.api.query_cache('shoots', 'shootid', 1337), has_length(1))
+
+    def test_query_without_dumps(self):
+        self._update_cache(None)
+        assert_that(self.api.query_cache('shoots', 'shootid', 1337), equal_to([]))
+        self.api._cache = None
+        assert_that(self.api.query_cache('shoots', 'shootid', 1337), equal_to([]))
+
+
+if __name__ == "__main__":
+    unittest.main()
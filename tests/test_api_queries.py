@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
+import http.server
+import json
 import socket
+import tempfile
+import threading
 import unittest
 from datetime import date
 
@@ -8,6 +12,104 @@ from apis.kink_api import KinkAPI
 from hamcrest import *
 
 
+class StubAPIHandler(http.server.BaseHTTPRequestHandler):
+    """ Answers /kinkcom/shoot_shootid/<id> like the API, fails the first request of every id ending in 7 """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    failed = set()
+    dump_requests = []
+
+    def do_GET(self):
+        shootid = self.path.split('/')[-1]
+        if shootid.startswith('dump_'):
+            self._dump(shootid)
+            return
+        if shootid.endswith('7') and shootid not in self.failed:
+            self.failed.add(shootid)
+            body = b''
+        else:
+            body = json.dumps({'errors': False, 'results': [
+                {'shootid': shootid, 'exists': True, 'site': {'name': 'Test Site'}, 'title': 'test',
+                 'performers': [{'name': 'Testy Mc. Test'}], 'date': 1167609600}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dump(self, dump):
+        self.dump_requests.append(dump)
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        results = [{'shootid': 1337, 'title': 'test'}] if dump == 'dump_shoots' else [{'name': 'Testy Mc. Test'}]
+        body = json.dumps({'results': results}).encode()
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class BaseAPIShould(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubAPIHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.api = KinkAPI([], pool_size=4)
+        self.api.api_url = 'http://127.0.0.1:{}/kinkcom'.format(self.server.server_port)
+        self.api.request_backoff = 0.01
+
+    def test_retry(self):
+        properties = self.api.query_api('shoots', 'shootid', 1337)
+        assert_that(properties[0].get('shootid'), equal_to(1337))
+
+    def test_memoization(self):
+        self.api.query_api('shoots', 'shootid', 4242)
+        self.api.query_api('shoots', 'shootid', 4242)
+        self.api.query('shoots', 'shootid', 4242)
+        self.api.query('shoots', 'shootid', 4241)
+        assert_that(self.api._memo.hits, equal_to(2))
+        assert_that(self.api._memo.misses, equal_to(2))
+
+    def test_query_many(self):
+        shootids = list(range(1000, 1020))
+        results = self.api.query_many([('shoots', 'shootid', shootid) for shootid in shootids])
+        assert_that([r_[0].get('shootid') for r_ in results], equal_to(shootids))
+
+    def test_persisted_cache(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        StubAPIHandler.dump_requests.clear()
+        self.api._cache_dir = cache_dir.name
+        self.api.use_cache()
+        self.api._cache_thread.join()
+        assert_that(self.api.query_cache('shoots', 'shootid', 1337), has_length(1))
+        assert_that(StubAPIHandler.dump_requests, has_length(2))
+
+        api_2 = KinkAPI([], cache_dir=cache_dir.name)
+        api_2.api_url = self.api.api_url
+        api_2.use_cache(download=False)
+        assert_that(api_2._cache_thread, equal_to(None))
+        assert_that(api_2.query('shoots', 'shootid', 1337), has_length(1))
+
+        api_3 = KinkAPI([], cache_dir=cache_dir.name)
+        api_3.api_url = self.api.api_url
+        api_3.cache_max_age = 0
+        api_3.use_cache()
+        api_3._cache_thread.join()
+        assert_that(api_3.query('shoots', 'shootid', 1337), has_length(1))
+        assert_that(StubAPIHandler.dump_requests, has_length(4))
+        cache_dir.cleanup()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
 class KinkAPIShould(unittest.TestCase):
 
     def setUp(self):
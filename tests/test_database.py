@@ -5,10 +5,11 @@ from hamcrest import *
 import os
 import tempfile
 import datetime
+from unittest.mock import patch
 
 from database import Database
 from movie import Movie
-from utils import Settings
+from utils import Settings, FileProperties
 
 
 class DatabaseShould(unittest.TestCase):
@@ -39,6 +40,151 @@ class DatabaseShould(unittest.TestCase):
         assert_that(database_instance_2.movies.get(self.temp_movie_file.name),
                     equal_to(self.database.movies.get(self.temp_movie_file.name)))
 
+    def test_update_movie(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        database = Database(temp_dir.name, self.settings)
+        properties_ = {'title': 'test', 'performers': ['Testy Mc. Test'],
+                       'date': datetime.date(2007, 1, 1), 'site': 'Test Site', 'shootid': 1337}
+        m1 = Movie(FileProperties('/tmp/foo/movie1.mp4'), None, properties_)
+        m2 = Movie(FileProperties('/tmp/foo/movie2.mp4'), None, {})
+        for m_ in [m1, m2]:
+            database.add_movie(m_)
+        database.write()
+
+        m2.scene_properties.update(properties_)
+        database.update_movie(m2)
+        database.update_movie(Movie(FileProperties('/tmp/foo/unknown.mp4'), None, properties_))
+        database.write()
+        database_instance_2 = Database(temp_dir.name, self.settings)
+        database_instance_2.read()
+        assert_that(database_instance_2.movies.keys(), contains_exactly('/tmp/foo/movie1.mp4', '/tmp/foo/movie2.mp4'))
+        assert_that([m_.scene_properties.shootid for m_ in database_instance_2.movies.values()],
+                    only_contains(1337))
+        temp_dir.cleanup()
+
+    def test_sqlite_storage(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        properties_ = {'title': 'test', 'performers': ['Testy Mc. Test'],
+                       'date': datetime.date(2007, 1, 1), 'site': 'Test Site', 'shootid': 1337}
+        json_database = Database(temp_dir.name, self.settings)
+        json_database.add_movie(Movie(FileProperties('/tmp/foo/movie1.mp4'), None, properties_))
+        json_database.add_movie(Movie(FileProperties('/tmp/foo/movie2.mp4'), None, {}))
+        json_database.write()
+
+        sqlite_settings = Settings({'database_backend': 'sqlite'})
+        sqlite_database = Database(temp_dir.name, sqlite_settings)
+        sqlite_database.read()
+        assert_that(sqlite_database.movies.keys(), contains_exactly('/tmp/foo/movie1.mp4', '/tmp/foo/movie2.mp4'))
+
+        sqlite_database.movies['/tmp/foo/movie2.mp4'].scene_properties.update(properties_)
+        sqlite_database.update_movie(sqlite_database.movies['/tmp/foo/movie2.mp4'])
+        sqlite_database.del_movie('/tmp/foo/movie1.mp4')
+        sqlite_database.write()
+        sqlite_database.close()
+
+        sqlite_database_2 = Database(temp_dir.name, sqlite_settings)
+        sqlite_database_2.read()
+        assert_that(sqlite_database_2.movies.keys(), contains_exactly('/tmp/foo/movie2.mp4'))
+        assert_that(sqlite_database_2.movies['/tmp/foo/movie2.mp4'].scene_properties.shootid, equal_to(1337))
+        sqlite_database_2.close()
+        temp_dir.cleanup()
+
+    def test_inspection(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        database = Database(temp_dir.name, self.settings)
+        movie = Movie(FileProperties('/tmp/foo/movie1.mp4', signature=(1, 2, 3)), None, {})
+        database.add_movie(movie)
+        database.write()
+
+        movie.file_properties.fingerprint = '2-abcd'
+        movie.file_properties.media_info = {'width': 1280, 'height': 720}
+        database.update_movie(movie)
+        database.write()
+        database_instance_2 = Database(temp_dir.name, self.settings)
+        database_instance_2.read()
+        file_properties = database_instance_2.movies['/tmp/foo/movie1.mp4'].file_properties
+        assert_that(file_properties.fingerprint, equal_to('2-abcd'))
+        assert_that(file_properties.media_info, equal_to({'width': 1280, 'height': 720}))
+
+        # The file changed, so the inspection is not valid anymore
+        database_instance_2.set_signature(database_instance_2.movies['/tmp/foo/movie1.mp4'], (1, 4, 5))
+        assert_that(file_properties.fingerprint, equal_to(None))
+        assert_that(file_properties.media_info, equal_to(None))
+        temp_dir.cleanup()
+
+    def test_journal(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        properties_ = {'title': 'test', 'performers': ['Testy Mc. Test'],
+                       'date': datetime.date(2007, 1, 1), 'site': 'Test Site', 'shootid': 1337}
+        database = Database(temp_dir.name, self.settings)
+        database.add_movie(Movie(FileProperties('/tmp/foo/movie1.mp4'), None, {}))
+        database.write()
+        snapshot_size = os.stat(database._path).st_size
+
+        database.add_movie(Movie(FileProperties('/tmp/foo/movie2.mp4'), None, {}))
+        database.write()
+        database.movies['/tmp/foo/movie1.mp4'].scene_properties.update(properties_)
+        database.update_movie(database.movies['/tmp/foo/movie1.mp4'])
+        database.write()
+        assert_that(os.stat(database._path).st_size, equal_to(snapshot_size))
+
+        # A crash while appending leaves an incomplete entry
+        with open(database._path + '.journal', 'a') as f:
+            f.write('["movie", "/tmp/foo/movie3.mp4", {"file_pro')
+
+        database_instance_2 = Database(temp_dir.name, self.settings)
+        database_instance_2.read()
+        assert_that(database_instance_2.movies.keys(), contains_exactly('/tmp/foo/movie1.mp4', '/tmp/foo/movie2.mp4'))
+        assert_that(database_instance_2.movies['/tmp/foo/movie1.mp4'].scene_properties.shootid, equal_to(1337))
+
+        database_instance_2.del_movie('/tmp/foo/movie2.mp4')
+        database_instance_2.write()
+        database_instance_2.compact()
+        assert_that(not os.path.exists(database._path + '.journal'))
+
+        database_instance_3 = Database(temp_dir.name, self.settings)
+        database_instance_3.read()
+        assert_that(database_instance_3.movies.keys(), contains_exactly('/tmp/foo/movie1.mp4'))
+        temp_dir.cleanup()
+
+    def test_journal_torn_first_entry(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        database = Database(temp_dir.name, self.settings)
+        database.add_movie(Movie(FileProperties('/tmp/foo/movie1.mp4'), None, {}))
+        database.write()
+        with open(database._path + '.journal', 'a') as f:
+            f.write('["movie", "/tmp/foo/movie2.mp4", {"file_pro')
+
+        database_instance_2 = Database(temp_dir.name, self.settings)
+        database_instance_2.read()
+        database_instance_2.add_movie(Movie(FileProperties('/tmp/foo/movie3.mp4'), None, {}))
+        database_instance_2.write()
+
+        database_instance_3 = Database(temp_dir.name, self.settings)
+        database_instance_3.read()
+        assert_that(database_instance_3.movies.keys(), contains_inanyorder('/tmp/foo/movie1.mp4',
+                                                                           '/tmp/foo/movie3.mp4'))
+        temp_dir.cleanup()
+
+    def test_journal_batched_syncs(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        database = Database(temp_dir.name, self.settings)
+        database.write()
+        with patch('os.fsync') as fsync:
+            for i in range(3):
+                database.add_movie(Movie(FileProperties('/tmp/foo/movie{}.mp4'.format(i)), None, {}))
+                database.write()
+            assert_that(fsync.call_count, equal_to(0))
+            # Appended right away nevertheless
+            database_instance_2 = Database(temp_dir.name, self.settings)
+            database_instance_2.read()
+            assert_that(database_instance_2.movies, has_length(3))
+
+            database._storage.compact()
+            assert_that(fsync.call_count, equal_to(1))
+        database.close()
+        temp_dir.cleanup()
+
     def tearDown(self):
         self.temp_database_file.close()
 
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import os
+import unittest
+from hamcrest import *
+
+import dedupe
+import media
+from helpers import TempDirTestCase
+
+
+class DedupeShould(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.executor = concurrent.futures.ThreadPoolExecutor(4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        super().tearDown()
+
+    def _files(self, *paths):
+        return {path: (None, None) for path in paths}
+
+    def test_find_duplicates(self):
+        a = self._write('a.mp4', b'\x01' * 1000)
+        b = self._write('b.mp4', b'\x01' * 1000)
+        c = self._write('c.mp4', b'\x02' * 1000)
+        d = self._write('d.mp4', b'\x01' * 999)
+        a_link = os.path.join(self.temp_dir.name, 'a_link.mp4')
+        os.link(a, a_link)
+
+        duplicates, fingerprints = dedupe.find_duplicates(self._files(a, b, c, d, a_link))
+        assert_that(duplicates, contains_exactly(contains_exactly(1000, contains_inanyorder(a, b))))
+        assert_that(dedupe.reclaimable_bytes(duplicates), equal_to(1000))
+        assert_that(fingerprints[a], equal_to(media.fingerprint(a)))
+
+    def test_confirm_with_full_hash(self):
+        content = os.urandom(3 * media.FINGERPRINT_CHUNK_SIZE + 1000)
+        a = self._write('a.mp4', content)
+        b = self._write('b.mp4', content)
+        # Between the start and the middle, where the fingerprint does not look
+        offset = media.FINGERPRINT_CHUNK_SIZE + 10
+        c = self._write('c.mp4', content[:offset] + bytes([content[offset] ^ 1]) + content[offset + 1:])
+        assert_that(media.fingerprint(c), equal_to(media.fingerprint(a)))
+
+        duplicates, _ = dedupe.find_duplicates(self._files(a, b, c), executor=self.executor)
+        assert_that(duplicates, contains_exactly(contains_exactly(len(content), contains_inanyorder(a, b))))
+
+    def test_find_duplicates_of(self):
+        a = self._write('a.mp4', b'\x01' * 1000)
+        b = self._write('b.mp4', b'\x01' * 1000)
+        c = self._write('c.mp4', b'\x02' * 1000)
+        d = self._write('d.mp4', b'\x02' * 1000)
+        files = self._files(a, b, c, d)
+        # Known sizes and fingerprints are not read again
+        files[a] = (1000, media.fingerprint(a))
+
+        duplicates, fingerprints = dedupe.find_duplicates(files, of=[b, c, d], executor=self.executor)
+        assert_that(duplicates, contains_exactly(contains_exactly(1000, contains_inanyorder(a, b))))
+        assert_that(fingerprints, not_(has_key(a)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import errno
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from hamcrest import *
+
+import fileops
+
+
+def _raise(errno_):
+    def raise_(*args, **kwargs):
+        raise OSError(errno_, os.strerror(errno_))
+    return raise_
+
+
+class FileOpsShould(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, 'source.mp4')
+        self.target = os.path.join(self.directory.name, 'target.mp4')
+        self.content = os.urandom(fileops.CHUNK_SIZE + 12345)
+        with open(self.source, 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_copy(self):
+        progress = []
+        fileops.copy_file(self.source, self.target, progress=progress.append)
+        assert_that(self._read(self.target) == self.content)
+        assert_that(sum(progress), equal_to(len(self.content)))
+
+    @patch('fileops._reflink', lambda *args: False)
+    def test_copy_without_copy_file_range_or_sendfile(self):
+        with patch('os.copy_file_range', _raise(errno.EXDEV), create=True), \
+                patch('os.sendfile', _raise(errno.EINVAL), create=True):
+            fileops.copy_file(self.source, self.target)
+        assert_that(self._read(self.target) == self.content)
+
+    @patch('fileops._reflink', lambda *args: False)
+    def test_not_leave_partial_copies(self):
+        with patch('fileops._copy_content', _raise(errno.ENOSPC)):
+            assert_that(calling(fileops.copy_file).with_args(self.source, self.target), raises(OSError))
+        assert_that(os.listdir(self.directory.name), contains_exactly('source.mp4'))
+
+    def test_move_across_filesystems(self):
+        with patch('os.rename', _raise(errno.EXDEV)):
+            fileops.move_file(self.source, self.target)
+        assert_that(os.path.exists(self.source), equal_to(False))
+        assert_that(self._read(self.target) == self.content)
+
+    @patch('fileops._reflink', lambda *args: False)
+    def test_not_move_short_copies(self):
+        # copy_file_range copying nothing is retried with the next method
+        with patch('os.copy_file_range', lambda *args: 0, create=True):
+            fileops.copy_file(self.source, self.target)
+        assert_that(self._read(self.target) == self.content)
+        os.remove(self.target)
+
+        nothing_copied = lambda *args: 0
+        with patch('os.rename', _raise(errno.EXDEV)), patch('fileops._copy_chunk_range', nothing_copied), \
+                patch('fileops._copy_chunk_sendfile', nothing_copied), \
+                patch('fileops._copy_chunk_read', nothing_copied):
+            assert_that(calling(fileops.move_file).with_args(self.source, self.target), raises(OSError))
+        assert_that(self._read(self.source) == self.content)
+        assert_that(os.listdir(self.directory.name), contains_exactly('source.mp4'))
+
+    def test_hardlink(self):
+        fileops.link_file(self.source, self.target, hard=True)
+        assert_that(os.path.islink(self.target), equal_to(False))
+        assert_that(os.path.samefile(self.source, self.target))
+
+        os.remove(self.target)
+        with patch('os.link', _raise(errno.EXDEV)):
+            fileops.link_file(self.source, self.target, hard=True)
+        assert_that(os.path.islink(self.target))
+
+
+if __name__ == '__main__':
+    unittest.main()
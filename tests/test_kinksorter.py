@@ -1,17 +1,56 @@
 #!/usr/bin/env python3
 
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from hamcrest import *
 import os
 import shutil
 import tempfile
 import datetime
+import json
 import logging
 
 from movie import Movie
-from utils import Settings
+from utils import Settings, FileProperties
+from database import Database
 from kinksorter import KinkSorter
+from watcher import PollingWatcher
+
+
+class FakeAPI:
+    """ Picklable stand-in for an API, to be usable by worker processes """
+    name = 'Fake'
+
+    @staticmethod
+    def get_shootid_through_metadata(file_path, media_info=None):
+        return 1337
+
+    @staticmethod
+    def query(type_, by_property_, value_):
+        return [{'shootid': value_, 'title': 'test', 'performers': ['Testy Mc. Test'],
+                 'date': datetime.date(2007, 1, 1), 'site': 'Test Site', 'exists': True}]
+
+
+class CountedFakeAPI(FakeAPI):
+    """ Counts how often it is handed over to worker processes """
+    handovers = 0
+
+    def __getstate__(self):
+        CountedFakeAPI.handovers += 1
+        return self.__dict__
+
+
+class NumberedFakeAPI(FakeAPI):
+    """ Tags every movie differently, by the size of its file """
+
+    @staticmethod
+    def get_shootid_through_metadata(file_path, media_info=None):
+        return 1000 + os.path.getsize(file_path)
+
+    @staticmethod
+    def query(type_, by_property_, value_):
+        return [{'shootid': value_, 'title': 'test {}'.format(value_), 'performers': ['Testy Mc. Test'],
+                 'date': datetime.date(2007, 1, 1), 'site': 'Test Site', 'exists': True}]
 
 
 class KinksorterShould(unittest.TestCase):
@@ -34,6 +73,340 @@ class KinksorterShould(unittest.TestCase):
         self.kinksorter.scan_address(self.kinksorter.storage_root_path)
         assert_that(len(self.kinksorter.database.movies), equal_to(3))
 
+    def test_scan_incremental(self):
+        self.kinksorter.scan_address(self.kinksorter.storage_root_path)
+        self.kinksorter.database.movies[self.file1.name].scene_properties.set_shootid(1337)
+
+        self.kinksorter._is_video_file.reset_mock()
+        self.kinksorter.scan_address(self.kinksorter.storage_root_path)
+        assert_that(self.kinksorter._is_video_file.call_count, equal_to(0))
+
+        moved_path = os.path.join(self.dir3.name, 'moved')
+        os.rename(self.file1.name, moved_path)
+        os.remove(self.file2.name)
+        self.kinksorter.database.original = False
+        self.kinksorter.scan_address(self.kinksorter.storage_root_path)
+        self.kinksorter._remove_deleted()
+        assert_that(self.kinksorter._is_video_file.call_count, equal_to(1))
+        assert_that(self.kinksorter.database.movies.keys(), contains_inanyorder(moved_path, self.file3.name))
+        assert_that(self.kinksorter.database.movies[moved_path].scene_properties.shootid, equal_to(1337))
+        os.rename(moved_path, self.file1.name)
+        open(self.file2.name, 'w').close()
+
+    def test_scan_moved_movie(self):
+        self.kinksorter.scan_address(self.kinksorter.storage_root_path)
+        self.kinksorter.database.movies[self.file1.name].scene_properties.set_shootid(1337)
+        moved_path = os.path.join(self.dir3.name, 'moved')
+        os.rename(self.file1.name, moved_path)
+
+        moved_movie = self.kinksorter._scan_file(moved_path, self.kinksorter.storage_root_path)
+        assert_that(moved_movie.scene_properties.shootid, equal_to(1337))
+        # Tagging the moved movie does not change the entry of the old path
+        moved_movie.scene_properties.set_shootid(4242)
+        assert_that(self.kinksorter.database.movies[self.file1.name].scene_properties.shootid, equal_to(1337))
+        os.rename(moved_path, self.file1.name)
+
+    def test_update_parallel(self):
+        self.kinksorter.settings.jobs = 2
+        api = CountedFakeAPI()
+        for file_ in [self.file1, self.file2, self.file3]:
+            self.kinksorter.database.add_movie(Movie(FileProperties(file_.name), api))
+
+        CountedFakeAPI.handovers = 0
+        with patch.dict(self.kinksorter.settings.apis, {api.name: api}):
+            self.kinksorter.update_all_movies()
+        assert_that(all(self.kinksorter.database.movies.values()))
+        assert_that([m.scene_properties.shootid for m in self.kinksorter.database.movies.values()],
+                    only_contains(1337))
+        # Once per worker at most, not with every movie
+        assert_that(CountedFakeAPI.handovers, less_than_or_equal_to(2))
+
+    def test_update_parallel_recognized_before(self):
+        self.kinksorter.settings.jobs = 2
+        for file_ in [self.file1, self.file2, self.file3]:
+            movie = Movie(FileProperties(file_.name), FakeAPI())
+            self.kinksorter.database.add_movie(movie)
+            self.kinksorter.settings.recognition_cache.put(FakeAPI.name, movie.get_fingerprint(), 4242, 0,
+                                                           shootid=4242, sure=True)
+            movie.file_properties.fingerprint = None
+
+        self.kinksorter.update_all_movies()
+        assert_that([m.scene_properties.shootid for m in self.kinksorter.database.movies.values()],
+                    only_contains(4242))
+
+    def test_pipeline(self):
+        self.kinksorter.settings.simulation = True
+        for i, file_ in enumerate([self.file1, self.file2, self.file3]):
+            file_.write(b'\x00' * i)
+            file_.flush()
+            self.kinksorter.database.add_movie(Movie(FileProperties(file_.name, self.root_storage.name),
+                                                     NumberedFakeAPI()))
+
+        events = []
+        scan_file, sort_movie = self.kinksorter._scan_file, self.kinksorter._sort_movie
+        self.kinksorter._scan_file = lambda *args: events.append('scan') or scan_file(*args)
+        self.kinksorter._sort_movie = lambda *args: events.append('sort') or sort_movie(*args)
+        self.kinksorter.run_pipeline([])
+
+        sorted_site_path = os.path.join(self.kinksorter.storage_root_path + '_kinksorted_linked', 'Test Site')
+        assert_that(len(os.listdir(sorted_site_path)), equal_to(3))
+        # Sorting started before the scan was done
+        assert_that(events.index('sort'), less_than(len(events) - 1 - events[::-1].index('scan')))
+
+    def test_watch(self):
+        self.kinksorter.settings.simulation = True
+        os.mkdir(os.path.join(self.root_storage.name, 'site'))
+        self.kinksorter._watched_site_apis['site'] = NumberedFakeAPI()
+        new_path = os.path.join(self.root_storage.name, 'site', 'new.mp4')
+
+        def create_watcher(directories, excluded=()):
+            watcher_ = PollingWatcher(directories, excluded=excluded, debounce=0.2)
+            with open(new_path, 'wb') as f:
+                f.write(b'\x00' * 5)
+            get_completed_files = watcher_.get_completed_files
+            # Stop after the first movie
+            watcher_.get_completed_files = MagicMock(side_effect=[get_completed_files(timeout=5), KeyboardInterrupt])
+            return watcher_
+
+        with patch('watcher.create_watcher', create_watcher):
+            self.kinksorter.watch([])
+
+        assert_that(self.kinksorter.database.movies[new_path].scene_properties.shootid, equal_to(1005))
+        sorted_site_path = os.path.join(self.kinksorter.storage_root_path + '_kinksorted_linked', 'Test Site')
+        assert_that(os.listdir(sorted_site_path), has_item(contains_string('1005')))
+
+    def test_watch_in_place(self):
+        self.kinksorter.settings.simulation = False
+        os.mkdir(os.path.join(self.root_storage.name, 'site'))
+        self.kinksorter._watched_site_apis['site'] = NumberedFakeAPI()
+        new_path = os.path.join(self.root_storage.name, 'site', 'new.mp4')
+
+        def create_watcher(directories, excluded=()):
+            watcher_ = PollingWatcher(directories, excluded=excluded, debounce=0.2)
+            with open(new_path, 'wb') as f:
+                f.write(b'\x00' * 5)
+            get_completed_files = watcher_.get_completed_files
+            # The new movie, then the movie just sorted, which is not sorted again
+            timeouts = [5, 2]
+            watcher_.get_completed_files = lambda timeout=None: get_completed_files(timeout=timeouts.pop(0)) \
+                if timeouts else self._raise(KeyboardInterrupt)
+            return watcher_
+
+        with patch('watcher.create_watcher', create_watcher):
+            self.kinksorter.watch([])
+
+        assert_that(os.path.exists(new_path), equal_to(False))
+        sorted_site_path = os.path.join(self.kinksorter.storage_root_path, 'Test Site')
+        sorted_names = [n_ for n_ in os.listdir(sorted_site_path) if '1005' in n_]
+        assert_that(sorted_names, has_length(1))
+        # Known by its new path only, also to the database written
+        assert_that(self.kinksorter.database.movies, not_(has_key(new_path)))
+        assert_that(self.kinksorter.database.movies[os.path.join(sorted_site_path, sorted_names[0])]
+                    .scene_properties.shootid, equal_to(1005))
+        database = Database(self.root_storage.name, self.kinksorter.settings)
+        database.read()
+        assert_that(database.movies.keys(), contains_inanyorder(*self.kinksorter.database.movies.keys()))
+
+    def test_pipeline_in_place(self):
+        self.kinksorter.settings.simulation = False
+        for i, file_ in enumerate([self.file1, self.file2, self.file3]):
+            file_.write(b'\x00' * i)
+            file_.flush()
+        # The database and the manifest are written into the storage scanned again
+        self.kinksorter._is_video_file = lambda path_: not os.path.basename(path_).startswith('.kinksorter')
+        self.kinksorter._current_site_api = NumberedFakeAPI()
+        self.kinksorter.scan_address(self.kinksorter.storage_root_path)
+        self.kinksorter.database.compact()
+
+        # Interrupted after the first movie is sorted
+        sort_movie, sorted_movies = self.kinksorter._sort_movie, []
+
+        def sort_first_movie(*args):
+            if sorted_movies:
+                raise KeyboardInterrupt
+            sorted_movies.append(sort_movie(*args))
+
+        self.kinksorter._sort_movie = sort_first_movie
+        assert_that(self.kinksorter.run_pipeline([]), equal_to(False))
+
+        database = Database(self.root_storage.name, self.kinksorter.settings)
+        database.read()
+        assert_that(database.movies, has_length(3))
+        sorted_site_path = os.path.join(self.root_storage.name, 'Test Site')
+        assert_that([p_ for p_ in database.movies if p_.startswith(sorted_site_path)], has_length(1))
+
+    @staticmethod
+    def _raise(exception):
+        raise exception
+
+    def test_sort_duplicates(self):
+        self.kinksorter.settings.simulation = False
+        scene_properties = {'title': 'test', 'performers': ['Testy Mc. Test'], 'date': datetime.date(2007, 1, 1),
+                            'site': 'Test Site', 'shootid': 1337}
+        for i, file_ in enumerate([self.file1, self.file2, self.file3]):
+            file_.write(b'\x00' * (1 + i % 2))
+            file_.flush()
+            self.kinksorter.database.add_movie(Movie(FileProperties(file_.name, self.root_storage.name), None,
+                                                     scene_properties=scene_properties))
+
+        new_storage_path = self.kinksorter._build_new_storage_path()
+        movies = list(self.kinksorter.database.movies.values())
+        placements = self.kinksorter._plan_placements(movies, new_storage_path)
+        assert_that([p_['action'] for p_ in placements],
+                    contains_inanyorder('move', 'skip-duplicate', 'skip-duplicate'))
+
+        self.kinksorter.sort()
+        sorted_movies = os.listdir(os.path.join(new_storage_path, 'Test Site'))
+        assert_that(sorted_movies, has_length(1))
+        assert_that(os.path.getsize(os.path.join(new_storage_path, 'Test Site', sorted_movies[0])), equal_to(2))
+        # The duplicates are gone, and with them the directory of file3
+        assert_that(os.path.exists(self.file1.name) or os.path.exists(self.file3.name), equal_to(False))
+        assert_that(os.path.exists(self.dir3.name), equal_to(False))
+
+    def test_plan_single_movie(self):
+        self.kinksorter.settings.simulation = True
+        self.file1.write(b'\x00' * 5)
+        self.file1.flush()
+        movie = Movie(FileProperties(self.file1.name, self.root_storage.name), None,
+                      scene_properties={'title': 'test', 'site': 'Test Site'})
+        new_storage_path = self.kinksorter._build_new_storage_path()
+        target = self.kinksorter._build_new_movie_path(movie, new_storage_path)
+        os.makedirs(os.path.dirname(target))
+        open(target, 'w').close()
+
+        # The pipeline plans every movie alone, without listing its whole site-directory
+        self.kinksorter._list_directory = MagicMock(return_value=set())
+        placements = self.kinksorter._plan_placements([movie], new_storage_path)
+        assert_that(self.kinksorter._list_directory.call_count, equal_to(0))
+        assert_that(placements, contains_exactly(has_entries(action='link', replace=True)))
+
+    def test_plan_vanished_movie(self):
+        self.kinksorter.settings.simulation = True
+        self.kinksorter.scan_address(self.kinksorter.storage_root_path)
+        for movie in self.kinksorter.database.movies.values():
+            movie.scene_properties.update({'title': movie.file_properties.base_name, 'site': 'Test Site'})
+        os.remove(self.file2.name)
+
+        movies = list(self.kinksorter.database.movies.values())
+        placements = self.kinksorter._plan_placements(movies, self.kinksorter._build_new_storage_path(create=False))
+        assert_that([p_['source'] for p_ in placements], contains_inanyorder(self.file1.name, self.file3.name))
+        open(self.file2.name, 'w').close()
+
+    def test_plan_and_apply(self):
+        self.kinksorter.settings.simulation = True
+        for i, file_ in enumerate([self.file1, self.file2, self.file3]):
+            file_.write(b'\x00' * i)
+            file_.flush()
+            self.kinksorter.database.add_movie(Movie(FileProperties(file_.name, self.root_storage.name),
+                                                     NumberedFakeAPI(), scene_properties={
+                    'title': 'test {}'.format(i), 'performers': ['Testy Mc. Test'],
+                    'date': datetime.date(2007, 1, 1), 'site': 'Test Site', 'shootid': 1000 + i}))
+        self.kinksorter.database._own_movies = self.kinksorter.database.movies.copy()
+        plan_path = os.path.join(self.root_storage.name, 'plan.jsonl')
+        self.kinksorter.plan(plan_path)
+        sorted_path = self.kinksorter.storage_root_path + KinkSorter.LINKED_SORTED_STORAGE_SUFFIX
+        # Planning does not touch the storage
+        assert_that(os.path.exists(sorted_path), equal_to(False))
+        # Applied by another run, which did not scan
+        self.kinksorter = KinkSorter(self.root_storage.name, self.kinksorter.settings)
+
+        # Interrupted after the first placement, then resumed
+        place_movie = self.kinksorter._place_movie
+        self.kinksorter._place_movie = MagicMock(side_effect=[place_movie(p_) if i_ == 0 else KeyboardInterrupt()
+                                                              for i_, p_ in enumerate(self._read_plan(plan_path))])
+        with self.assertRaises(KeyboardInterrupt):
+            self.kinksorter.apply_plan(plan_path)
+        self.kinksorter._place_movie = place_movie
+        self.kinksorter.apply_plan(plan_path)
+
+        assert_that(os.listdir(os.path.join(sorted_path, 'Test Site')), has_length(3))
+        sorted_database = Database(sorted_path, self.kinksorter.settings)
+        sorted_database.read()
+        assert_that(sorted_database.movies, has_length(3))
+        # Our own movies are no files to get
+        assert_that(self.kinksorter.database.merge_diff_list, empty())
+
+    def test_sort_read_only_source(self):
+        self.kinksorter.settings.simulation = False
+        self.file1.write(b'\x00' * 5)
+        self.file1.flush()
+        movie = Movie(FileProperties(self.file1.name, self.root_storage.name), None,
+                      scene_properties={'title': 'test', 'site': 'Test Site'})
+        new_storage_path = self.kinksorter._build_new_storage_path()
+        new_storage_database = Database(new_storage_path, self.kinksorter.settings)
+        placements = self.kinksorter._plan_placements([movie], new_storage_path)
+        placements[0]['action'] = 'copy'
+
+        self.kinksorter._remove_old_movie = MagicMock(side_effect=PermissionError(13, 'Permission denied'))
+        self.kinksorter._apply_placements(placements, new_storage_database)
+        assert_that(os.path.getsize(placements[0]['target']), equal_to(5))
+        assert_that(new_storage_database.movies, has_key(placements[0]['target']))
+        assert_that(self.kinksorter.manifest.read(), has_length(1))
+
+        # A resumed apply does not copy it again
+        self.kinksorter._transfer_movie = MagicMock()
+        assert_that(self.kinksorter._place_movie(placements[0]), equal_to(os.path.realpath(self.file1.name)))
+        assert_that(self.kinksorter._transfer_movie.call_count, equal_to(0))
+
+    def test_sort_hardlinks(self):
+        self.kinksorter.settings.simulation = True
+        self.kinksorter.settings.hardlinks = True
+        self.kinksorter.database.add_movie(Movie(FileProperties(self.file1.name, self.root_storage.name), None,
+                                                 scene_properties={'title': 'test', 'site': 'Test Site'}))
+        self.kinksorter.sort()
+
+        sorted_site_path = os.path.join(self.kinksorter.storage_root_path + '_kinksorted_linked', 'Test Site')
+        sorted_movie_path = os.path.join(sorted_site_path, os.listdir(sorted_site_path)[0])
+        assert_that(os.path.islink(sorted_movie_path), equal_to(False))
+        assert_that(os.path.samefile(sorted_movie_path, self.file1.name))
+
+    def test_revert_by_manifest(self):
+        self.kinksorter.settings.simulation = False
+        for i, file_ in enumerate([self.file1, self.file3]):
+            self.kinksorter.database.add_movie(Movie(FileProperties(file_.name, self.root_storage.name), None,
+                                                     scene_properties={'title': 'test', 'site': 'Site {}'.format(i)}))
+        self.kinksorter.sort()
+        new_storage_path = self.kinksorter._build_new_storage_path()
+        assert_that(os.path.exists(self.file3.name), equal_to(False))
+        assert_that(self.kinksorter.manifest.read(), has_length(2))
+
+        self.kinksorter.revert(site='Site 1')
+        assert_that(os.path.exists(self.file3.name))
+        assert_that(os.path.exists(os.path.join(new_storage_path, 'Site 1')), equal_to(False))
+        assert_that(os.path.exists(self.file1.name), equal_to(False))
+        assert_that(self.kinksorter.manifest.read(), has_length(1))
+
+        self.kinksorter.revert(run='last')
+        assert_that(os.path.exists(self.file1.name))
+        assert_that(os.path.exists(os.path.join(new_storage_path, 'Site 0')), equal_to(False))
+        assert_that(self.kinksorter.manifest.read(), empty())
+
+    def test_duplicates_by_content(self):
+        for file_, content in ((self.file1, b'\x01' * 100), (self.file2, b'\x01' * 100), (self.file3, b'\x02' * 100)):
+            file_.write(content)
+            file_.flush()
+            self.kinksorter.database.add_movie(Movie(FileProperties(file_.name, self.root_storage.name), None,
+                                                     scene_properties={'title': file_.name, 'site': 'Test Site'}))
+
+        report_path = os.path.join(self.root_storage.name, 'duplicates.jsonl')
+        duplicates = self.kinksorter.report_duplicates(report_path)
+        assert_that(duplicates, contains_exactly(contains_exactly(100, contains_inanyorder(self.file1.name,
+                                                                                          self.file2.name))))
+        with open(report_path) as f:
+            assert_that(json.loads(f.readline()), has_entries(size=100, reclaimable=100))
+        assert_that(self.kinksorter.database.movies[self.file1.name].file_properties.fingerprint, not_none())
+
+        # file2 and file3 are merged from another archive, file2 is owned already
+        self.kinksorter.database._own_movies = {self.file1.name: self.kinksorter.database.movies[self.file1.name]}
+        self.kinksorter._remove_owned_duplicates()
+        assert_that(self.kinksorter.database.movies, not_(has_key(self.file2.name)))
+        assert_that(self.kinksorter.database.movies, has_key(self.file3.name))
+
+    @staticmethod
+    def _read_plan(plan_path):
+        with open(plan_path) as f:
+            return [json.loads(line) for line in f.readlines()[1:]]
+
     def test_sort(self):
         properties_ = {'title': 'test', 'performers': ['Testy Mc. Test'],
                        'date': datetime.date(2007, 1, 1), 'site': 'Test Site', 'id': 1337}
@@ -79,9 +452,10 @@ class KinksorterShould(unittest.TestCase):
         self.root_storage.cleanup()
         if os.path.exists(self.kinksorter.database._path):
             os.remove(self.kinksorter.database._path)
-        sorted_path = self.kinksorter.storage_root_path + '_kinksorted'
-        if os.path.exists(sorted_path):
-            shutil.rmtree(sorted_path)
+        for suffix in (KinkSorter.SORTED_STORAGE_SUFFIX, KinkSorter.LINKED_SORTED_STORAGE_SUFFIX):
+            sorted_path = self.kinksorter.storage_root_path + suffix
+            if os.path.exists(sorted_path):
+                shutil.rmtree(sorted_path)
 
 
 if __name__ == "__main__":
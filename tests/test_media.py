@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import os
+import unittest
+
+import cv2
+import numpy as np
+
+import media
+from hamcrest import *
+from helpers import TempDirTestCase
+
+
+class IsVideoFileShould(TempDirTestCase):
+
+    def test_extension(self):
+        assert_that(media.is_video_file(self._write('movie.MP4', b'')), equal_to(True))
+        assert_that(media.is_video_file(self._write('movie.wmv', b'')), equal_to(True))
+
+    def test_magic_bytes(self):
+        assert_that(media.is_video_file(self._write('mp4', b'\x00\x00\x00\x18ftypisom\x00\x00\x02\x00')),
+                    equal_to(True))
+        assert_that(media.is_video_file(self._write('mkv', b'\x1a\x45\xdf\xa3\x01\x00')), equal_to(True))
+        assert_that(media.is_video_file(self._write('avi', b'RIFF\x00\x00\x00\x00AVI LIST')), equal_to(True))
+        assert_that(media.is_video_file(self._write('wmv', b'\x30\x26\xb2\x75\x8e\x66\xcf\x11\xa6\xd9')),
+                    equal_to(True))
+        assert_that(media.is_video_file(self._write('rm', b'.RMF\x00\x00\x00\x12')), equal_to(True))
+
+    def test_no_video(self):
+        assert_that(media.is_video_file(self._write('text.txt', b'Shoot ID: 1337')), equal_to(False))
+        assert_that(media.is_video_file(self._write('m4a', b'\x00\x00\x00\x18ftypM4A \x00\x00\x02\x00')),
+                    equal_to(False))
+        assert_that(media.is_video_file(self._write('empty', b'')), equal_to(False))
+        assert_that(media.is_video_file(os.path.join(self.temp_dir.name, 'missing')), equal_to(False))
+
+
+class FingerprintShould(TempDirTestCase):
+
+    def test_same_content(self):
+        content = os.urandom(10000)
+        assert_that(media.fingerprint(self._write('movie.mp4', content), chunk_size=1000),
+                    equal_to(media.fingerprint(self._write('renamed.avi', content), chunk_size=1000)))
+
+    def test_sampled_chunks(self):
+        content = bytearray(10000)
+        fingerprint = media.fingerprint(self._write('movie.mp4', content), chunk_size=1000)
+        # Start, middle and end are hashed, the rest is not
+        content[2000] = 1
+        assert_that(media.fingerprint(self._write('movie.mp4', content), chunk_size=1000), equal_to(fingerprint))
+        for position in (0, 5000, 9999):
+            changed = bytearray(10000)
+            changed[position] = 1
+            assert_that(media.fingerprint(self._write('changed.mp4', changed), chunk_size=1000),
+                        is_not(equal_to(fingerprint)))
+        assert_that(media.fingerprint(self._write('longer.mp4', content + b'\x00'), chunk_size=1000),
+                    is_not(equal_to(fingerprint)))
+
+    def test_unreadable(self):
+        assert_that(media.fingerprint(os.path.join(self.temp_dir.name, 'missing')), equal_to(None))
+
+
+class ProbeShould(TempDirTestCase):
+
+    def test_video(self):
+        path = os.path.join(self.temp_dir.name, 'movie.avi')
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 10, (320, 240), isColor=True)
+        for _ in range(20):
+            writer.write(np.zeros((240, 320, 3), np.uint8))
+        writer.release()
+
+        media_info = media.probe(path)
+        assert_that(media_info, has_entries({'mime_type': 'video/x-msvideo', 'width': 320, 'height': 240,
+                                             'fps': close_to(10, 0.01), 'frame_count': 20,
+                                             'duration': close_to(2, 0.1)}))
+
+    def test_no_video(self):
+        assert_that(media.probe(self._write('text.txt', b'Shoot ID: 1337')),
+                    has_entries({'mime_type': None, 'frame_count': 0}))
+        assert_that(media.probe(os.path.join(self.temp_dir.name, 'missing')), equal_to(None))
+
+
+if __name__ == "__main__":
+    unittest.main()
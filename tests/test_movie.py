@@ -2,6 +2,7 @@
 
 import tempfile
 import unittest
+from unittest.mock import MagicMock, patch
 
 from apis.kink_api import KinkAPI
 from hamcrest import *
@@ -32,6 +33,10 @@ class MovieShould(unittest.TestCase):
         assert_that(self.movie.get_shootids_from_filename('123456789'), equal_to([]))
         assert_that(self.movie.get_shootids_from_filename('091224'), equal_to([]))
 
+    def test_recognize_kinkids_at_once(self):
+        assert_that(Movie.get_shootids_from_filenames(['/a/12345.mp4', '/a/091224 (720).mp4', '/b/2016-01-12.wmv']),
+                    equal_to([[12345], [720], []]))
+
     def test_logic_empty(self):
         assert_that(bool(self.movie), equal_to(False))
         assert_that(self.movie.scene_properties.is_empty(), equal_to(False))
@@ -48,6 +53,25 @@ class MovieShould(unittest.TestCase):
     def test_name(self):
         assert_that(self.movie.get_shootids_from_filename("Waterbondage - 2006-04-21 3546 - Ava.wmv"), contains(3546))
 
+    @patch.object(Movie, 'recognize_shootids', MagicMock(return_value=(0, 0)))
+    def test_recognition_cache(self):
+        Movie.settings.recognition_cache.put('Kink.com', self.movie.get_fingerprint(), 4242, 0, shootid=4242, sure=True)
+        assert_that(self.movie.get_shootid(self.temp_movie_file.name), equal_to((4242, True)))
+        assert_that(Movie.recognize_shootids.call_count, equal_to(0))
+
+        # Not sure about the choice, so only the recognition is reused
+        Movie.settings.recognition_cache.put('Kink.com', self.movie.get_fingerprint(), 0, 0, shootid=1234, sure=False)
+        assert_that(self.movie.get_shootid('/tmp/Movie 4711.mp4'), equal_to((4711, True)))
+        assert_that(Movie.recognize_shootids.call_count, equal_to(0))
+
+    def test_slots(self):
+        # No __dict__ per movie, and sites are shared
+        assert_that(hasattr(self.movie, '__dict__'), equal_to(False))
+        assert_that(hasattr(self.movie.file_properties, '__dict__'), equal_to(False))
+        other = SceneProperties(site=''.join(['Test ', 'Site']))
+        self.movie.scene_properties.set_site('Test Site')
+        assert_that(other.site, same_instance(self.movie.scene_properties.site))
+
     def tearDown(self):
         del self.movie
 
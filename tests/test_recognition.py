@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import cv2
+import numpy as np
+from hamcrest import *
+
+from apis.digit_recognizer import DigitRecognizer
+from apis.kink_api import KinkAPI
+import media
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apis', 'templates')
+
+
+def render_shootid_frame(shootid, width=1280, height=720):
+    """ A black end-frame with the shootid template and the digits in the lower right, like Kink.com shows it """
+    frame = np.zeros((height, width, 3), np.uint8)
+    template = cv2.imread(os.path.join(TEMPLATE_DIR, 'shootid.jpeg'))
+    scale = height / 720.0
+    template = cv2.resize(template, (0, 0), fx=scale, fy=scale)
+    y, x = int(height * 0.8), int(width * 0.55)
+    frame[y:y + template.shape[0], x:x + template.shape[1]] = template
+    cv2.putText(frame, str(shootid), (x + template.shape[1] + int(10 * scale), y + int(35 * scale)),
+                cv2.FONT_HERSHEY_SIMPLEX, 1.3 * scale, (255, 255, 255), max(1, int(3 * scale)))
+    return frame
+
+
+def render_digits(text, scale=1.3):
+    """ White digits on black, like the crop right of the shootid template """
+    image = np.zeros((int(50 * scale), int(40 * scale) * len(text)), np.uint8)
+    cv2.putText(image, text, (int(5 * scale), int(40 * scale)), cv2.FONT_HERSHEY_SIMPLEX, scale, 255,
+                max(1, int(3 * scale)))
+    return image
+
+
+def write_test_movie(path, shootid=None, width=1280, height=720, fps=10, seconds=6):
+    """ A movie of bright frames, ending in a second of the shootid frame if a shootid is given """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    bright_frame = np.full((height, width, 3), 100, np.uint8)
+    shootid_frame = render_shootid_frame(shootid, width, height) if shootid is not None else bright_frame
+    for i in range(fps * seconds):
+        writer.write(shootid_frame if i >= fps * (seconds - 1) else bright_frame)
+    writer.release()
+
+
+class FrameSamplingShould(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.movie_path = os.path.join(self.temp_dir.name, 'movie.avi')
+        write_test_movie(self.movie_path, 4321)
+        self.api = KinkAPI([cv2.imread(os.path.join(TEMPLATE_DIR, 'shootid.jpeg'), 0)])
+
+    def test_seeking(self):
+        red_frame = self.api._get_fitting_frame_seeking(self.movie_path, media.probe(self.movie_path))
+        assert_that(red_frame.shape, equal_to((720, 1280)))
+        # Without knowing the frames beforehand
+        red_frame = self.api._get_fitting_frame_seeking(self.movie_path, {})
+        assert_that(red_frame.shape, equal_to((720, 1280)))
+
+    @unittest.skipUnless(shutil.which('ffmpeg') and shutil.which('ffprobe'), 'No ffmpeg')
+    def test_streaming(self):
+        red_frame = self.api._get_fitting_frame_streaming(self.movie_path, media.probe(self.movie_path))
+        assert_that(red_frame.shape, equal_to((720, 1280)))
+
+    def test_no_fitting_frame(self):
+        bright_path = os.path.join(self.temp_dir.name, 'bright.avi')
+        write_test_movie(bright_path)
+        assert_that(self.api._get_fitting_frame(bright_path), equal_to(None))
+
+    def test_image_recognition(self):
+        self.api.digit_recognizer.learn(render_digits('1234567890'), 1234567890)
+        assert_that(self.api.get_shootid_through_image_recognition(self.movie_path), equal_to(4321))
+
+    def test_learn_only_confirmed_digits(self):
+        image = render_digits('4321')
+        # tesseract misreads the unknown digits
+        with patch.object(KinkAPI, 'recognize_shootid_tesseract', return_value=4381):
+            assert_that(self.api.recognize_shootid(image, confirming_shootids=[4321]), equal_to(4381))
+            assert_that(bool(self.api.digit_recognizer), equal_to(False))
+        with patch.object(KinkAPI, 'recognize_shootid_tesseract', return_value=4321):
+            self.api.recognize_shootid(image, confirming_shootids=[4321])
+        assert_that(self.api.digit_recognizer.recognize(image), equal_to(4321))
+
+    def test_batch(self):
+        self.api.digit_recognizer.learn(render_digits('1234567890'), 1234567890)
+        other_path = os.path.join(self.temp_dir.name, 'other.avi')
+        write_test_movie(other_path, 98765, width=1920, height=1080)
+        broken_path = os.path.join(self.temp_dir.name, 'broken.avi')
+        with open(broken_path, 'wb') as f:
+            f.write(b'RIFF\x00\x00\x00\x00AVI ')
+
+        results = self.api.recognize_shootids_batch([self.movie_path, other_path, broken_path], jobs=2)
+        assert_that(dict(results), equal_to({self.movie_path: 4321, other_path: 98765, broken_path: -1}))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+
+class TemplateMatchingShould(unittest.TestCase):
+
+    def setUp(self):
+        self.api = KinkAPI([cv2.imread(os.path.join(TEMPLATE_DIR, name), 0)
+                            for name in ('shootid.jpeg', 'shootid_pre09.jpeg')])
+
+    def test_resolutions(self):
+        for width, height in [(854, 480), (1280, 720), (1920, 1080), (3840, 2160)]:
+            red_frame = render_shootid_frame(1234, width, height)[:, :, 2]
+            shootid_crop = self.api._crop_shootid(red_frame)
+            assert_that(shootid_crop, not_none())
+            assert_that(shootid_crop.shape[0], close_to(44 * height / 720, 2))
+
+    def test_no_match(self):
+        noise = np.random.RandomState(1337).randint(0, 256, (720, 1280), np.uint8)
+        assert_that(self.api._crop_shootid(noise), equal_to(None))
+        assert_that(self.api._crop_shootid(np.zeros((20, 30), np.uint8)), equal_to(None))
+
+    def test_templates_scaled_once(self):
+        assert_that(self.api._get_scaled_templates(1080), same_instance(self.api._get_scaled_templates(1080)))
+        assert_that(KinkAPI()._get_scaled_templates(1080), equal_to([]))
+
+
+class DigitRecognizerShould(unittest.TestCase):
+
+    def setUp(self):
+        self.recognizer = DigitRecognizer()
+        self.recognizer.learn(render_digits('1234567890'), 1234567890)
+
+    def test_recognize(self):
+        assert_that(self.recognizer.recognize(render_digits('9081')), equal_to(9081))
+        assert_that(self.recognizer.recognize(render_digits('31337', scale=0.8)), equal_to(31337))
+        assert_that(self.recognizer.recognize(render_digits('56', scale=2)), equal_to(56))
+
+    def test_unknown_glyphs(self):
+        assert_that(self.recognizer.recognize(render_digits('12A4')), equal_to(None))
+        assert_that(self.recognizer.recognize(np.zeros((50, 200), np.uint8)), equal_to(None))
+        assert_that(DigitRecognizer().recognize(render_digits('1234')), equal_to(None))
+
+    def test_learn(self):
+        assert_that(self.recognizer.learn(render_digits('1234567890'), 1234567890), equal_to(False))
+        # The number does not fit the glyphs
+        assert_that(DigitRecognizer().learn(render_digits('123'), 12), equal_to(False))
+
+    def test_glyph_templates(self):
+        recognizer = DigitRecognizer({int(d): [render_digits(d)] for d in '0123456789'})
+        assert_that(recognizer.recognize(render_digits('4711')), equal_to(4711))
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'digits.npz')
+            DigitRecognizer(path=path).learn(render_digits('1234567890'), 1234567890)
+            assert_that(DigitRecognizer(path=path).recognize(render_digits('2001')), equal_to(2001))
+
+
+if __name__ == "__main__":
+    unittest.main()
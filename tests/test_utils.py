@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import os
+import tempfile
 import unittest
 from datetime import date
 
@@ -44,5 +46,41 @@ class ScenePropertiesShould(unittest.TestCase):
     def test_(self):
         pass
 
+
+class RecognitionCacheShould(unittest.TestCase):
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, utils.RecognitionCache.file_name)
+            cache = utils.RecognitionCache(path)
+            cache.put('Kink.com', '1234-abcd', 1337, 0, shootid=1337, sure=True)
+            assert_that(cache.get('Kink.com', '1234-abcd'),
+                        equal_to({'shootid_cv': 1337, 'shootid_md': 0, 'shootid': 1337, 'sure': True}))
+            cache.save()
+
+            loaded = utils.RecognitionCache(path)
+            assert_that(loaded.get('Kink.com', '1234-abcd')['shootid'], equal_to(1337))
+            assert_that(loaded.get('Other', '1234-abcd'), equal_to(None))
+            assert_that(loaded.get('Kink.com', None), equal_to(None))
+
+
+class ManifestShould(unittest.TestCase):
+
+    def test_torn_entry(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            manifest = utils.Manifest(temp_dir)
+            manifest.append({'target': 'a'})
+            manifest.close()
+            # A crash while appending
+            with open(manifest.path, 'a') as f:
+                f.write('{"target": "b", "sou')
+
+            manifest = utils.Manifest(temp_dir)
+            assert_that(manifest.read(), contains_exactly({'target': 'a'}))
+            manifest.append({'target': 'c'})
+            manifest.close()
+            assert_that(manifest.read(), contains_exactly({'target': 'a'}, {'target': 'c'}))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import unittest
+from hamcrest import *
+import os
+import tempfile
+
+import watcher
+
+
+class WatcherShould(unittest.TestCase):
+    watcher_class = watcher.PollingWatcher
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.directory.name, 'site'))
+        self.watcher = self.watcher_class([self.directory.name], debounce=0.2)
+
+    def tearDown(self):
+        self.watcher.close()
+        self.directory.cleanup()
+
+    def test_report_new_files(self):
+        path_ = os.path.join(self.directory.name, 'site', 'movie.mp4')
+        with open(path_, 'wb') as f:
+            f.write(b'\x00' * 10)
+        assert_that(self.watcher.get_completed_files(timeout=5), contains_exactly(path_))
+        assert_that(self.watcher.get_completed_files(timeout=0.5), empty())
+
+    def test_report_moved_directories(self):
+        source = tempfile.TemporaryDirectory()
+        with open(os.path.join(source.name, 'movie.mp4'), 'wb') as f:
+            f.write(b'\x00' * 10)
+        path_ = os.path.join(self.directory.name, 'site', 'new')
+        os.rename(source.name, path_)
+        assert_that(self.watcher.get_completed_files(timeout=5), contains_exactly(os.path.join(path_, 'movie.mp4')))
+
+    def test_wait_for_written_files(self):
+        path_ = os.path.join(self.directory.name, 'movie.mp4')
+        with open(path_, 'wb') as f:
+            f.write(b'\x00' * 10)
+            f.flush()
+            assert_that(self.watcher.get_completed_files(timeout=0.1), empty())
+            f.write(b'\x00' * 10)
+        assert_that(self.watcher.get_completed_files(timeout=5), contains_exactly(path_))
+
+    def test_ignore_excluded_files(self):
+        with open(os.path.join(self.directory.name, '.kinksorter_db.journal'), 'wb') as f:
+            f.write(b'\x00')
+        assert_that(self.watcher.get_completed_files(timeout=0.5), empty())
+
+
+@unittest.skipUnless(os.path.exists('/proc/sys/fs/inotify'), 'No inotify')
+class InotifyWatcherShould(WatcherShould):
+    watcher_class = watcher.InotifyWatcher
+
+
+if __name__ == '__main__':
+    unittest.main()
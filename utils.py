@@ -1,6 +1,10 @@
+import gzip
+import json
 import logging
 import os
 import re
+import sys
+import threading
 import tqdm
 from cv2 import imread
 from ftplib import FTP
@@ -30,11 +34,19 @@ class Settings:
     RECURSION_DEPTH = 10
     interactive = False
     simulation = True
+    hardlinks = False
+    jobs = 1
+    database_backend = 'json'
     apis = {'Default': None}
 
     def __init__(self, args):
         self.interactive = args.get('interactive', False)
         self.simulation = not args.get('tested', False)
+        self.hardlinks = args.get('hardlinks', False)
+        self.jobs = max(1, args.get('jobs', None) or 1)
+        self.database_backend = args.get('database_backend', None) or self.database_backend
+        # API-dumps and other caches are persisted next to the database
+        self.cache_dir = args.get('storage_root_path', None)
         use_api = not args.get('use_direct', False)
 
         kink_templates_sorted = []
@@ -48,26 +60,163 @@ class Settings:
             for template_ in sorted(kink_templates_):
                 kink_templates_sorted.append(imread(template_, 0))
 
-        self.apis[KinkAPI.name] = KinkAPI(kink_templates_sorted, use_api=use_api)
+        # Glyphs of the shootid-digits, named like "digits/4_1080p.jpeg"
+        kink_digit_templates = {}
+        digit_dir = os.path.join(template_dir, 'digits') if template_dir else None
+        if digit_dir and os.path.exists(digit_dir):
+            for template_ in sorted(os.scandir(digit_dir), key=lambda e: e.name):
+                if template_.name.endswith('.jpeg') and template_.name[0].isdigit():
+                    kink_digit_templates.setdefault(int(template_.name[0]), []).append(imread(template_.path, 0))
+
+        self.apis[KinkAPI.name] = KinkAPI(kink_templates_sorted, use_api=use_api, pool_size=max(10, self.jobs),
+                                          cache_dir=self.cache_dir, digit_templates=kink_digit_templates)
+        recognition_cache_path = os.path.join(self.cache_dir, RecognitionCache.file_name) if self.cache_dir else None
+        self.recognition_cache = RecognitionCache(recognition_cache_path)
+
         if self.interactive:
             # Default to most probable API only if interactive, so the results are validated by user
             self.apis['Default'] = self.apis[KinkAPI.name]
 
-    def apis_use_cache(self):
+    def save_caches(self):
+        """ Persist the caches for the next run """
+        for api in set(self.apis.values()):
+            if api is not None:
+                api.save_memo()
+        self.recognition_cache.save()
+
+    def apis_use_cache(self, download=True):
         for api in self.apis.values():
             if api is not None:
-                api.use_cache()
+                api.use_cache(download=download)
+
+
+class RecognitionCache:
+    """ The recognized shootids of movies by the fingerprint of their content, to not recognize them again when
+    they were moved, renamed or are part of another (merged) archive
+    """
+    file_name = '.kinksorter_recognitions.json.gz'
+
+    def __init__(self, path=None):
+        self._path = path
+        self._entries = {}  # api name:{fingerprint:{'shootid_cv', 'shootid_md', 'shootid', 'sure'}}
+        self._lock = threading.Lock()
+        self._changed = False
+        self.load()
+
+    def get(self, api_name, fingerprint):
+        if fingerprint is None:
+            return None
+        with self._lock:
+            return self._entries.get(api_name, {}).get(fingerprint)
+
+    def put(self, api_name, fingerprint, shootid_cv, shootid_md, shootid=0, sure=False):
+        if fingerprint is None:
+            return
+        with self._lock:
+            self._entries.setdefault(api_name, {})[fingerprint] = {'shootid_cv': shootid_cv, 'shootid_md': shootid_md,
+                                                                   'shootid': shootid, 'sure': sure}
+            self._changed = True
+
+    def load(self):
+        if self._path is None or not os.path.exists(self._path):
+            return
+        try:
+            with gzip.open(self._path, 'rt') as f:
+                entries = json.load(f)
+        except Exception as e:
+            logging.warning('Recognition-cache "{}" possibly corrupted (Error: "{}"), ignoring it'.format(
+                self._path, e))
+            return
+        with self._lock:
+            for api_name, recognitions in entries.items():
+                self._entries.setdefault(api_name, {}).update(recognitions)
+
+    def save(self):
+        if self._path is None or not self._changed:
+            return
+        with self._lock:
+            encoded = json.dumps(self._entries)
+            self._changed = False
+        temp_path = self._path + '.tmp'
+        try:
+            with gzip.open(temp_path, 'wt', compresslevel=1) as f:
+                f.write(encoded)
+            os.replace(temp_path, self._path)
+        except OSError as e:
+            logging.warning('Could not persist the recognition-cache to "{}": {}'.format(self._path, e))
+
+
+class Manifest:
+    """ The journal of the movies placed by sorting, to revert them in reverse order, or only those of a site or run.
+
+    An entry is {'run', 'site', 'action', 'source', 'real_path', 'target', 'storage'}, appended when the placement
+    is done, so it is complete even if sorting is interrupted.
+    """
+    file_name = '.kinksorter_manifest.jsonl'
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, self.file_name)
+        self._file = None
+
+    def append(self, entry):
+        if self._file is None:
+            self._cut_incomplete_entry()
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line.decode()))
+                except ValueError:
+                    logging.warning("Manifest '{}' has an incomplete entry, ignoring it".format(self.path))
+        return entries
+
+    def _cut_incomplete_entry(self):
+        """ Cut the end of an entry interrupted by a crash, so the next entry starts on a line of its own """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            end = f.seek(0, os.SEEK_END)
+            position = end
+            # Back to the last newline, block by block
+            while position > 0:
+                block_start = max(0, position - (1 << 16))
+                f.seek(block_start)
+                newline = f.read(position - block_start).rfind(b'\n')
+                if newline >= 0:
+                    position = block_start + newline + 1
+                    break
+                position = block_start
+            if position < end:
+                f.truncate(position)
+
+    def rewrite(self, entries):
+        """ Replace the entries, e.g. without the reverted ones """
+        self.close()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+        os.replace(temp_path, self.path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
 
 class FileProperties:
-    file_path = None
-    base_name = None
-    extension = None
-    relative_path = None
-    subdirectory_path = None
-    storage_root_path = None
-
-    def __init__(self, file_path, storage_root_path='/', **kwargs):
+    __slots__ = ('file_path', 'base_name', 'extension', 'relative_path', 'subdirectory_path', 'storage_root_path',
+                 'signature', 'fingerprint', 'media_info')
+
+    def __init__(self, file_path, storage_root_path='/', signature=None, fingerprint=None, media_info=None,
+                 **kwargs):
         if file_path.startswith(storage_root_path):
             self.relative_path = file_path[len(storage_root_path):]
         else:
@@ -81,15 +230,23 @@ class FileProperties:
             self.relative_path = self.relative_path[1:]
 
         self.file_path = file_path
-        self.storage_root_path = storage_root_path
-        t_, self.extension = os.path.splitext(self.relative_path)
-        self.subdirectory_path, self.base_name = os.path.split(t_)
+        # Shared by many movies, so interned to be stored only once
+        self.storage_root_path = sys.intern(storage_root_path)
+        # (inode, size, mtime) of the file when it was scanned, to recognize it when unchanged or moved
+        self.signature = tuple(signature) if signature else None
+        # media.fingerprint() and media.probe() of the content, valid as long as the signature is
+        self.fingerprint = fingerprint
+        self.media_info = media_info
+        t_, extension = os.path.splitext(self.relative_path)
+        subdirectory_path, self.base_name = os.path.split(t_)
+        self.extension, self.subdirectory_path = sys.intern(extension), sys.intern(subdirectory_path)
 
         if not self.base_name:
             print('no base name', file_path, storage_root_path)
 
     def serialize(self):
-        return {'file_path': self.file_path, 'storage_root_path': self.storage_root_path}
+        return {'file_path': self.file_path, 'storage_root_path': self.storage_root_path,
+                'signature': self.signature, 'fingerprint': self.fingerprint, 'media_info': self.media_info}
 
     def print_base_name(self):
         return self.base_name[:50]
@@ -97,11 +254,7 @@ class FileProperties:
 
 class SceneProperties:
     """ The properties of a scene. Takes care that there is always a non-true default value."""
-    title = None
-    performers = None
-    site = None
-    date = None
-    shootid = None
+    __slots__ = ('title', 'performers', 'site', '_date', '_epoch', 'shootid')
 
     def __init__(self, title=None, performers=None, site=None, date=None, shootid=None, **kwargs):
         self.set_title(title)
@@ -110,6 +263,16 @@ class SceneProperties:
         self.set_date(date)
         self.set_shootid(shootid)
 
+    @property
+    def date(self):
+        return self._date
+
+    @date.setter
+    def date(self, date):
+        self._date = date
+        # The seconds since the epoch, used by every check of the date
+        self._epoch = int(date.strftime('%s'))
+
     def set_title(self, title):
         if title is not None and type(title) is str:
             self.title = title
@@ -118,7 +281,8 @@ class SceneProperties:
             
     def set_site(self, site):
         if site is not None and type(site) is str:
-            self.site = site
+            # The few sites and performers are shared by many scenes, so interned to be stored only once
+            self.site = sys.intern(site)
         else:
             self.site = ''
             
@@ -130,7 +294,7 @@ class SceneProperties:
             
     def set_performers(self, performers):
         if performers is not None and type(performers) is list:
-            self.performers = performers
+            self.performers = [sys.intern(p_) if type(p_) is str else p_ for p_ in performers]
         else:
             self.performers = []
 
@@ -149,20 +313,20 @@ class SceneProperties:
 
     def serialize(self):
         return {'title': self.title, 'site': self.site, 'shootid': self.shootid,
-                'performers': self.performers, 'date': int(self.date.strftime('%s'))}
+                'performers': self.performers, 'date': self._epoch}
 
     def is_filled(self):
         return bool(self.title
                     and self.performers
                     and self.site
-                    and int(self.date.strftime("%s")) > 0
+                    and self._epoch > 0
                     and self.shootid > 0)
 
     def is_empty(self):
         return bool(self.title is ''
                     and self.performers == []
                     and self.site is ''
-                    and int(self.date.strftime('%s')) <= 0
+                    and self._epoch <= 0
                     and self.shootid is 0)
 
     def __bool__(self):
@@ -173,7 +337,7 @@ class SceneProperties:
             return ''
         return '{site} - {date} - {title} [{perfs}] ({shootid})'.format(
             site=self.site.replace(' ', '') if self.site else None,
-            date=self.date if int(self.date.strftime('%s')) > 0 else None,
+            date=self.date if self._epoch > 0 else None,
             title=self.title if self.title else None,
             perfs=', '.join((str(i) for i in self.performers)) if self.performers else None,
             shootid=self.shootid if self.shootid > 0 else None)
@@ -0,0 +1,224 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+
+# inotify(7)
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def create_watcher(directories, excluded=(), debounce=None):
+    """ Watch with inotify if the system has it, else by polling """
+    try:
+        return InotifyWatcher(directories, excluded=excluded, debounce=debounce)
+    except OSError as e:
+        logging.info('No inotify ({}), polling the directories for new files instead'.format(e))
+        return PollingWatcher(directories, excluded=excluded, debounce=debounce)
+
+
+class Watcher:
+    """ Reports the files created in or moved into the watched directory trees, once they are complete.
+
+    Files count as complete when they had no event and did not change their size for the debounce-time, so
+    downloads still being written are not reported.
+    """
+    DEBOUNCE_SECONDS = 2.0
+    # Written by kinksorter itself
+    IGNORED_PREFIX = '.kinksorter'
+
+    def __init__(self, directories, excluded=(), debounce=None):
+        self.directories = [os.path.abspath(d_) for d_ in directories]
+        self.excluded = [os.path.join(os.path.abspath(e_), '') for e_ in excluded]
+        self.debounce = self.DEBOUNCE_SECONDS if debounce is None else debounce
+        # Events were lost, the directories have to be scanned to know what changed
+        self.overflowed = False
+        self._pending = {}  # path:(time of the last event, size then)
+
+    def get_completed_files(self, timeout=None):
+        """ Wait up to timeout seconds (forever if None) for files to complete, returns their paths """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            completed = self._pop_completed()
+            if completed or self.overflowed:
+                return completed
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                return []
+            wait = [deadline - now] if deadline is not None else []
+            if self._pending:
+                wait.append(min(t_ for t_, _ in self._pending.values()) + self.debounce - now)
+            self._wait_for_events(max(0.0, min(wait)) if wait else None)
+
+    def close(self):
+        pass
+
+    @NotImplementedError
+    def _wait_for_events(self, timeout):
+        """ Wait up to timeout seconds (forever if None) for events and touch the files they are about """
+        return
+
+    def _is_ignored(self, path):
+        return os.path.basename(path).startswith(self.IGNORED_PREFIX) or \
+            any(path.startswith(excluded) for excluded in self.excluded)
+
+    def _touch(self, path):
+        """ Something happened to the file, restart its debounce """
+        if not self._is_ignored(path):
+            self._pending[path] = (time.monotonic(), self._get_size(path))
+
+    def _touch_tree(self, directory):
+        """ A directory appeared, with files already in it """
+        for root_, _, file_names in os.walk(directory):
+            for name in file_names:
+                self._touch(os.path.join(root_, name))
+
+    @staticmethod
+    def _get_size(path):
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return None
+
+    def _pop_completed(self):
+        now = time.monotonic()
+        completed = []
+        for path, (last_event, size) in list(self._pending.items()):
+            if now - last_event < self.debounce:
+                continue
+            current_size = self._get_size(path)
+            if current_size is None:
+                # Gone again, e.g. a temporary file of a download
+                del self._pending[path]
+            elif current_size != size:
+                self._pending[path] = (now, current_size)
+            else:
+                del self._pending[path]
+                completed.append(path)
+        return completed
+
+
+class InotifyWatcher(Watcher):
+    """ Watches with inotify(7) of Linux, through the libc, so it is notified of every change in no time """
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, directories, excluded=(), debounce=None):
+        super().__init__(directories, excluded=excluded, debounce=debounce)
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('libc without inotify')
+        self._libc = libc
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self._watches = {}  # watch descriptor:directory
+        for directory in self.directories:
+            self._add_tree(directory)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _add_tree(self, directory):
+        for root_, directory_names, _ in os.walk(directory):
+            if self._is_ignored(root_ + os.sep):
+                directory_names.clear()
+                continue
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(root_), self.MASK)
+            if wd < 0:
+                logging.warning('Cannot watch directory "{}": {}'.format(root_, os.strerror(ctypes.get_errno())))
+                continue
+            self._watches[wd] = root_
+
+    def _wait_for_events(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            data = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip(b'\0'))
+            offset += _EVENT_HEADER.size + length
+            self._handle_event(wd, mask, name)
+
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logging.warning('Too many changes at once, some were lost')
+            self.overflowed = True
+            return
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+
+        directory = self._watches.get(wd)
+        if directory is None or not name:
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO) and not self._is_ignored(path + os.sep):
+                self._add_tree(path)
+                self._touch_tree(path)
+        else:
+            self._touch(path)
+
+
+class PollingWatcher(Watcher):
+    """ Watches by looking at the modification times of the directories, so only changed ones are listed """
+    POLL_SECONDS = 1.0
+
+    def __init__(self, directories, excluded=(), debounce=None):
+        super().__init__(directories, excluded=excluded, debounce=debounce)
+        self._directories = {}  # directory:(mtime, {file names}, {directory names})
+        for directory in self.directories:
+            self._poll_tree(directory, report=False)
+
+    def _wait_for_events(self, timeout):
+        time.sleep(self.POLL_SECONDS if timeout is None else min(timeout, self.POLL_SECONDS))
+        for directory in self.directories:
+            self._poll_tree(directory)
+        # Files still being written change their size, but not the mtime of their directory
+        for path, (_, size) in list(self._pending.items()):
+            if self._get_size(path) != size:
+                self._touch(path)
+
+    def _poll_tree(self, directory, report=True):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            self._directories.pop(directory, None)
+            return
+
+        known = self._directories.get(directory)
+        if known is None or known[0] != mtime:
+            file_names, directory_names = set(), set()
+            try:
+                for entry in os.scandir(directory):
+                    (directory_names if entry.is_dir() else file_names).add(entry.name)
+            except OSError:
+                return
+            if report:
+                for name in file_names.difference(known[1] if known is not None else ()):
+                    self._touch(os.path.join(directory, name))
+            self._directories[directory] = (mtime, file_names, directory_names)
+        else:
+            directory_names = known[2]
+
+        for name in directory_names:
+            path = os.path.join(directory, name)
+            if not self._is_ignored(path + os.sep):
+                self._poll_tree(path, report=report)